@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the restbackup and chlorocrypt libraries.
+
+Runs each benchmark case in a separate process, so the peak memory of
+one case does not affect the next, and prints the results as JSON.
+Save the output of two runs and compare them to find throughput
+regressions between commits:
+
+  python bench-restbackup.py -o before.json
+  (check out another commit)
+  python bench-restbackup.py -o after.json
+  python bench-restbackup.py --compare before.json after.json
+
+Compare read sizes with the -r option, eg. for decryption:
+
+  python bench-restbackup.py -s 64k -r 1,16,4k,64k,1m decrypt padding
+
+The encrypt-tiny, decrypt-tiny, and mac-tiny cases ignore the read size
+and read 1 to 17 bytes at a time, like tarfile reading headers and small
+files.
+
+The put and get cases upload to and download from the stand-in HTTP
+server of stubserver.py, which runs in a separate process, so their CPU
+times and throughput measure only the client.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+USAGE = "bench-restbackup.py [OPTIONS] [CASE ...]"
+
+DEFAULT_SIZES = "1k,64k,1m,16m"
+DEFAULT_READ_SIZES = "65536"
+SIZE_SUFFIXES = {'':1, 'k':1024, 'm':1024*1024, 'g':1024*1024*1024}
+
+def parse_size(size):
+    size = size.strip().lower()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(size[:-1]) * SIZE_SUFFIXES[size[-1]]
+    return int(size)
+
+def format_size(size):
+    for suffix in ('g', 'm', 'k'):
+        if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+            return "%s%s" % (size / SIZE_SUFFIXES[suffix], suffix)
+    return str(size)
+
+
+# Benchmark cases.  Each bench_* function performs the untimed setup
+# for one payload size and read size and returns a run() function.
+# The run() function is timed and returns the number of bytes
+# processed.
+
+def make_payload(size):
+    import restbackup
+    class RepeatingReader(restbackup.RewindableSizedInputStream):
+        """Yields size bytes of a repeated random block without
+        holding the whole payload in memory."""
+        __slots__ = ('block', 'position')
+
+        def __init__(self, size):
+            restbackup.RewindableSizedInputStream.__init__(self, size)
+            self.block = os.urandom(min(size, 1024*1024)) or 'x'
+            self.rewind()
+
+        def read_once(self, size):
+            remaining = self.stream_length - self.position
+            offset = self.position % len(self.block)
+            chunk = self.block[offset:offset + min(size, remaining)]
+            self.position += len(chunk)
+            return chunk
+
+        def read(self, size=-1):
+            if size < 0:
+                size = self.stream_length - self.position
+            chunks = []
+            while size > 0:
+                chunk = self.read_once(size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size -= len(chunk)
+            return ''.join(chunks)
+
+        def rewind(self):
+            self.position = 0
+    return RepeatingReader(size)
+
+def drain(stream, read_size):
+    total = 0
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+# Read sizes of the tiny read cases, like the small reads of tarfile
+TINY_READ_SIZES = range(1, 18)
+
+def drain_tiny(stream):
+    total = 0
+    while True:
+        for read_size in TINY_READ_SIZES:
+            chunk = stream.read(read_size)
+            if not chunk:
+                return total
+            total += len(chunk)
+
+TEST_KEY = 'k' * 32
+TEST_SALT = 's' * 16
+TEST_IV = 'i' * 16
+
+def bench_encrypt(size, read_size):
+    import chlorocrypt
+    payload = make_payload(size)
+    encrypted = chlorocrypt.EncryptingReader(payload, 'passphrase', TEST_SALT,
+                                             TEST_IV, TEST_KEY)
+    def run():
+        drain(encrypted, read_size)
+        return size
+    return run
+
+def bench_encrypt_tiny(size, read_size):
+    """Compresses and encrypts with reads of 1 to 17 bytes, ignoring
+    read_size"""
+    import chlorocrypt
+    payload = make_payload(size)
+    encrypted = chlorocrypt.EncryptingReader(payload, 'passphrase', TEST_SALT,
+                                             TEST_IV, TEST_KEY, 'zlib')
+    def run():
+        drain_tiny(encrypted)
+        return size
+    return run
+
+def encrypt_to_file(size, compression=None):
+    """Returns a FileObjectReader of an encrypted payload"""
+    import chlorocrypt
+    import restbackup
+    import tempfile
+    payload = make_payload(size)
+    encrypted = chlorocrypt.EncryptingReader(payload, 'passphrase', TEST_SALT,
+                                             TEST_IV, TEST_KEY, compression)
+    f = tempfile.TemporaryFile(prefix='bench-restbackup.')
+    while True:
+        chunk = encrypted.read(1024*1024)
+        if not chunk:
+            break
+        f.write(chunk)
+    encrypted_size = f.tell()
+    f.seek(0)
+    return restbackup.FileObjectReader(f, encrypted_size)
+
+def bench_decrypt(size, read_size):
+    import chlorocrypt
+    # Encrypt to a temporary file so only decryption is timed
+    reader = encrypt_to_file(size)
+    def run():
+        decrypted = chlorocrypt.DecryptingReader(reader, 'passphrase', TEST_KEY)
+        return drain(decrypted, read_size)
+    return run
+
+def bench_decrypt_tiny(size, read_size):
+    """Decrypts and decompresses with reads of 1 to 17 bytes, ignoring
+    read_size"""
+    import chlorocrypt
+    reader = encrypt_to_file(size, 'zlib')
+    def run():
+        decrypted = chlorocrypt.DecryptingReader(reader, 'passphrase', TEST_KEY)
+        return drain_tiny(decrypted)
+    return run
+
+def make_mac_bench(mac_block_size):
+    def bench_mac(size, read_size):
+        """Adds and checks the MACs of a payload, without encryption,
+        so the cost of computing a MAC for each block dominates."""
+        import chlorocrypt
+        payload = make_payload(size)
+        def run():
+            payload.rewind()
+            with_macs = chlorocrypt.MacAddingReader(
+                payload, 'passphrase', TEST_SALT, TEST_KEY, '', mac_block_size)
+            checked = chlorocrypt.MacCheckingReader(
+                with_macs, 'passphrase', TEST_KEY, '', mac_block_size)
+            return drain(checked, read_size)
+        return run
+    return bench_mac
+
+def bench_mac_tiny(size, read_size):
+    """Adds and checks MACs with reads of 1 to 17 bytes, ignoring
+    read_size.  Without encryption, the cost of each read dominates."""
+    import chlorocrypt
+    payload = make_payload(size)
+    def run():
+        with_macs = chlorocrypt.MacAddingReader(
+            payload, 'passphrase', TEST_SALT, TEST_KEY)
+        checked = chlorocrypt.MacCheckingReader(
+            with_macs, 'passphrase', TEST_KEY)
+        return drain_tiny(checked)
+    return run
+
+def bench_padding(size, read_size):
+    """Adds and strips padding without encryption, so the cost of
+    copying data between the padding readers dominates."""
+    import chlorocrypt
+    payload = make_payload(size)
+    def run():
+        payload.rewind()
+        padded = chlorocrypt.PaddingAddingReader(payload)
+        return drain(chlorocrypt.PaddingStrippingReader(padded), read_size)
+    return run
+
+def bench_copy(size, read_size):
+    """Checks MACs and writes the data to a temporary file with
+    copy_stream(), like restoring a file.  Ignores read_size."""
+    import chlorocrypt
+    import restbackup
+    import tempfile
+    payload = make_payload(size)
+    with_macs = chlorocrypt.MacAddingReader(payload, 'passphrase', TEST_SALT,
+                                            TEST_KEY)
+    f = tempfile.TemporaryFile(prefix='bench-restbackup.')
+    while True:
+        chunk = with_macs.read(1024*1024)
+        if not chunk:
+            break
+        f.write(chunk)
+    encrypted_size = f.tell()
+    f.seek(0)
+    def run():
+        reader = restbackup.FileObjectReader(f, encrypted_size)
+        checked = chlorocrypt.MacCheckingReader(reader, 'passphrase', TEST_KEY)
+        output = tempfile.TemporaryFile(prefix='bench-restbackup.')
+        try:
+            return restbackup.copy_stream(checked, output)[0]
+        finally:
+            output.close()
+    return run
+
+def bench_pbkdf2(size, read_size):
+    """Size and read_size are ignored.  Run() returns the number of
+    key derivations."""
+    import chlorocrypt
+    def run():
+        count = 10
+        for n in xrange(count):
+            chlorocrypt.pbkdf2_256bit('passphrase', TEST_SALT)
+        return count
+    return run
+
+def make_aes_bench(aes_module_name):
+    def bench_aes(size, read_size):
+        AES = __import__(aes_module_name, fromlist=['new'])
+        block = os.urandom(min(read_size - read_size % 16, size) or 16)
+        def run():
+            aes = AES.new(TEST_KEY, AES.MODE_CBC, TEST_IV)
+            done = 0
+            while done < size:
+                aes.encrypt(block)
+                done += len(block)
+            return done
+        return run
+    return bench_aes
+
+def make_aes_new_bench(aes_module_name):
+    def bench_aes_new(size, read_size):
+        """Creates CBC ciphers with the same key, as a retried upload
+        does.  Size and read_size are ignored.  Run() returns the
+        number of ciphers created."""
+        AES = __import__(aes_module_name, fromlist=['new'])
+        def run():
+            count = 1000
+            for n in xrange(count):
+                AES.new(TEST_KEY, AES.MODE_CBC, TEST_IV)
+            return count
+        return run
+    return bench_aes_new
+
+def start_server():
+    """Starts a stand-in RestBackup server in a separate process, so
+    that its CPU time is not counted with the client's.  It discards
+    uploads and serves downloads of /SIZE with SIZE bytes of data.
+    Returns a BackupApiCaller for the server."""
+    import restbackup
+    import stubserver
+    (process, access_url) = stubserver.start_server_process()
+    return restbackup.BackupApiCaller(access_url, 'bench-restbackup/1.0')
+
+def bench_put(size, read_size):
+    backup_api = start_server()
+    payload = make_payload(size)
+    def run():
+        backup_api.put('/upload', payload)
+        return size
+    return run
+
+def bench_get(size, read_size):
+    backup_api = start_server()
+    def run():
+        return drain(backup_api.get('/%s' % size), read_size)
+    return run
+
+# Number of objects transferred by each run of the small-object cases
+SMALL_OBJECT_COUNT = 200
+SMALL_OBJECT_MAX_SIZE = 64 * 1024
+
+def bench_small_put(size, read_size):
+    """Run() returns the number of objects uploaded."""
+    import restbackup
+    backup_api = start_server()
+    data = os.urandom(size)
+    def run():
+        for n in xrange(SMALL_OBJECT_COUNT):
+            backup_api.put('/upload', restbackup.StringReader(data))
+        return SMALL_OBJECT_COUNT
+    return run
+
+def bench_small_get(size, read_size):
+    """Run() returns the number of objects downloaded."""
+    backup_api = start_server()
+    def run():
+        for n in xrange(SMALL_OBJECT_COUNT):
+            drain(backup_api.get('/%s' % size), read_size)
+        return SMALL_OBJECT_COUNT
+    return run
+
+def stream_chain_size(stream):
+    """Returns the bytes used by the stream objects in a chain of
+    streams, not counting the data they hold."""
+    total = 0
+    seen = set()
+    while stream != None and id(stream) not in seen:
+        seen.add(id(stream))
+        total += sys.getsizeof(stream)
+        if hasattr(stream, '__dict__'):
+            total += sys.getsizeof(stream.__dict__)
+        stream = getattr(stream, 'stream', None)
+    return total
+
+def bench_stream_chain(size, read_size):
+    """Encrypts and decrypts small objects in memory, so the cost of
+    building the chains of streams dominates.  Run() returns the
+    number of objects."""
+    import chlorocrypt
+    import restbackup
+    data = os.urandom(size)
+    def run():
+        for n in xrange(SMALL_OBJECT_COUNT):
+            encrypted = chlorocrypt.EncryptingReader(
+                restbackup.StringReader(data), 'passphrase', TEST_SALT,
+                TEST_IV, TEST_KEY)
+            decrypted = chlorocrypt.DecryptingReader(
+                restbackup.StringReader(encrypted.read()), 'passphrase',
+                TEST_KEY)
+            drain(decrypted, read_size)
+        return SMALL_OBJECT_COUNT
+    return run
+
+def stream_chain_memory():
+    """Returns the bytes of stream objects per encrypted upload and
+    per decrypted download."""
+    import chlorocrypt
+    import restbackup
+    encrypted = chlorocrypt.EncryptingReader(restbackup.StringReader(''),
+                                             'passphrase', TEST_SALT, TEST_IV,
+                                             TEST_KEY)
+    decrypted = chlorocrypt.DecryptingReader(
+        restbackup.StringReader(encrypted.read()), 'passphrase', TEST_KEY)
+    encrypted.rewind()
+    return {'encrypt_chain_bytes':stream_chain_size(encrypted),
+            'decrypt_chain_bytes':stream_chain_size(decrypted)}
+
+# Modules imported by the command line tools at startup
+ENTRY_POINT_MODULES = ['restbackupcli', 'restbackuptar', 'chlorocrypt']
+
+def bench_startup(size, read_size):
+    """Starts a new interpreter that imports each command line tool.
+    Size and read_size are ignored.  Run() returns the number of
+    interpreters started."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def run():
+        for module_name in ENTRY_POINT_MODULES:
+            subprocess.check_call([sys.executable, '-c',
+                                   'import %s' % module_name], cwd=directory)
+        return len(ENTRY_POINT_MODULES)
+    return run
+
+CASES = [
+    ('encrypt', bench_encrypt),
+    ('decrypt', bench_decrypt),
+    ('encrypt-tiny', bench_encrypt_tiny),
+    ('decrypt-tiny', bench_decrypt_tiny),
+    ('padding', bench_padding),
+    ('copy', bench_copy),
+    ('mac-16k', make_mac_bench(16 * 1024)),
+    ('mac', make_mac_bench(64 * 1024)),
+    ('mac-256k', make_mac_bench(256 * 1024)),
+    ('mac-1m', make_mac_bench(1024 * 1024)),
+    ('mac-tiny', bench_mac_tiny),
+    ('pbkdf2', bench_pbkdf2),
+    ('aes-pyaes', make_aes_bench('pyaes')),
+    ('aes-pycrypto', make_aes_bench('Crypto.Cipher.AES')),
+    ('aes-new-pyaes', make_aes_new_bench('pyaes')),
+    ('aes-new-pycrypto', make_aes_new_bench('Crypto.Cipher.AES')),
+    ('put', bench_put),
+    ('get', bench_get),
+    ('small-put', bench_small_put),
+    ('small-get', bench_small_get),
+    ('stream-chain', bench_stream_chain),
+    ('startup', bench_startup),
+    ]
+
+# Cases that do not depend on the payload size or read size
+UNSIZED_CASES = ['pbkdf2', 'aes-new-pyaes', 'aes-new-pycrypto', 'startup']
+
+# Cases that report objects per second, run only with payload sizes
+# up to SMALL_OBJECT_MAX_SIZE
+SMALL_OBJECT_CASES = ['small-put', 'small-get', 'stream-chain']
+
+
+def run_case(name, size, read_size):
+    """Runs one case in this process and returns the result dict."""
+    import resource
+    make_bench = dict(CASES)[name]
+    try:
+        run = make_bench(size, read_size)
+    except ImportError, e:
+        return {'case':name, 'size':size, 'read_size':read_size,
+                'skipped':str(e)}
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.time()
+    processed = run()
+    seconds = time.time() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime +
+                   usage_after.ru_stime - usage_before.ru_stime)
+    result = {'case':name, 'size':size, 'read_size':read_size,
+              'seconds':seconds, 'cpu_seconds':cpu_seconds,
+              # Kilobytes on Linux, bytes on Mac
+              'peak_rss':usage_after.ru_maxrss}
+    if name in UNSIZED_CASES or name in SMALL_OBJECT_CASES:
+        result['per_second'] = processed / seconds
+    else:
+        result['mb_per_second'] = processed / seconds / (1024*1024)
+    if name == 'stream-chain':
+        result.update(stream_chain_memory())
+    return result
+
+def run_case_in_subprocess(name, size, read_size):
+    args = [sys.executable, os.path.abspath(__file__), '--run-case',
+            name, str(size), str(read_size)]
+    child = subprocess.Popen(args, stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        return {'case':name, 'size':size, 'read_size':read_size,
+                'error':'exit status %s' % child.returncode}
+    return json.loads(output)
+
+def git_revision():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        child = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=directory,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = child.communicate()[0].strip()
+        if child.returncode == 0:
+            return output
+    except OSError:
+        pass
+    return None
+
+def aes_implementation():
+    try:
+        import Crypto.Cipher.AES
+        return 'PyCrypto'
+    except ImportError:
+        return 'pyaes'
+
+def run_benchmarks(case_names, sizes, read_sizes):
+    results = []
+    for name in case_names:
+        case_sizes = sizes
+        case_read_sizes = read_sizes
+        if name in UNSIZED_CASES:
+            case_sizes = [0]
+            case_read_sizes = [0]
+        if name in SMALL_OBJECT_CASES:
+            case_sizes = [size for size in sizes
+                          if size <= SMALL_OBJECT_MAX_SIZE]
+        for size in case_sizes:
+            for read_size in case_read_sizes:
+                result = run_case_in_subprocess(name, size, read_size)
+                print >>sys.stderr, format_result(result)
+                results.append(result)
+    return {'revision':git_revision(),
+            'python':sys.version.split()[0],
+            'platform':sys.platform,
+            'aes':aes_implementation(),
+            'time':time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'results':results}
+
+def result_key(result):
+    return "%s size=%s read_size=%s" % (result['case'],
+                                        format_size(result['size']),
+                                        format_size(result['read_size']))
+
+def result_rate(result):
+    if 'mb_per_second' in result:
+        return result['mb_per_second']
+    return result.get('per_second')
+
+def format_result(result):
+    if 'skipped' in result:
+        return "%-40s skipped: %s" % (result_key(result), result['skipped'])
+    if 'error' in result:
+        return "%-40s error: %s" % (result_key(result), result['error'])
+    if 'mb_per_second' in result:
+        rate = "%10.2f MB/s" % result['mb_per_second']
+    else:
+        rate = "%10.2f /s  " % result['per_second']
+    line = "%-40s %s cpu=%.2fs peak_rss=%s" % (result_key(result), rate,
+                                               result['cpu_seconds'],
+                                               result['peak_rss'])
+    if 'encrypt_chain_bytes' in result:
+        line += " encrypt_chain=%sB decrypt_chain=%sB" % (
+            result['encrypt_chain_bytes'], result['decrypt_chain_bytes'])
+    return line
+
+def compare(old_filename, new_filename):
+    with open(old_filename) as f:
+        old = json.load(f)
+    with open(new_filename) as f:
+        new = json.load(f)
+    old_rates = dict([(result_key(r), result_rate(r)) for r in old['results']])
+    print "%-40s %12s %12s %8s" % ('case', 'old', 'new', 'change')
+    for result in new['results']:
+        key = result_key(result)
+        old_rate = old_rates.get(key)
+        new_rate = result_rate(result)
+        if not old_rate or not new_rate:
+            print "%-40s %12s %12s" % (key, old_rate, new_rate)
+            continue
+        change = (new_rate - old_rate) / old_rate * 100
+        print "%-40s %12.2f %12.2f %+7.1f%%" % (key, old_rate, new_rate, change)
+    return 0
+
+def main(args):
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option("-s", "--sizes", default=DEFAULT_SIZES,
+                      help="comma-separated payload sizes, eg. 1k,1m,4g, "
+                      "default %s" % DEFAULT_SIZES)
+    parser.add_option("-r", "--read-sizes", default=DEFAULT_READ_SIZES,
+                      help="comma-separated read sizes, default %s"
+                      % DEFAULT_READ_SIZES)
+    parser.add_option("-o", "--output", help="write JSON results to file")
+    parser.add_option("--compare", action="store_true",
+                      help="compare two JSON result files")
+    parser.add_option("--run-case", action="store_true",
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option("-l", "--list", action="store_true",
+                      help="list the benchmark cases")
+    (options, args) = parser.parse_args(args)
+
+    if options.run_case:
+        (name, size, read_size) = args
+        print json.dumps(run_case(name, int(size), int(read_size)))
+        return 0
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two result files")
+        return compare(*args)
+    if options.list:
+        for (name, make_bench) in CASES:
+            print name
+        return 0
+
+    case_names = args or [name for (name, make_bench) in CASES]
+    for name in case_names:
+        if name not in dict(CASES):
+            parser.error("Unknown case %r" % name)
+    sizes = [parse_size(size) for size in options.sizes.split(',')]
+    read_sizes = [parse_size(size) for size in options.read_sizes.split(',')]
+    report = run_benchmarks(case_names, sizes, read_sizes)
+    output = json.dumps(report, indent=1, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print output
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -3,7 +3,8 @@
 Command-line tool and library for encrypting and decrypting files.
 Uses AES in CBC mode for confidentiality.  The passphrase is converted
 to a key using the PBKDF2 algorithm (rfc2898) and HMAC-SHA-256.  File
-integrity is verified with SHA-256 HMAC.
+integrity is verified with SHA-256 HMAC.  Data may optionally be
+compressed with zlib or bz2 before encryption.
 
 Tested under Python 2.7.
 
@@ -14,33 +15,121 @@ http://www.voidspace.org.uk/python/modules.shtml#pycrypto
 
 __author__ = 'Michael Leonhard'
 __license__ = 'Copyright (C) 2011 Rest Backup LLC.  Use of this software is subject to the RestBackup.com Terms of Use, http://www.restbackup.com/terms'
-__version__ = '1.8'
+__version__ = '2.0'
 
-import getpass
-import hmac
 import hashlib
 import os
-from restbackup import FileObjectReader
 from restbackup import FileReader
+from restbackup import PipeReader
 from restbackup import RestBackupException
 from restbackup import RewindableSizedInputStream
 from restbackup import SizedInputStream
+from restbackup import copy_stream
+from restbackup import format_throughput
+from restbackup import known_length
 import struct
 import sys
-import unittest
+import zlib
 
 try:
     from Crypto.Cipher import AES
 except ImportError:
     import pyaes as AES
 
+def python_constant_time_equal(a, b):
+    """Returns True if the byte strings are equal, taking the same time
+    wherever they differ, to avoid timing attacks.
+    http://seb.dbzteam.org/crypto/python-oauth-timing-hmac.pdf"""
+    if len(a) != len(b):
+        return False
+    diff = 0
+    for (x, y) in zip(a, b):
+        diff |= ord(x) ^ ord(y)
+    return diff == 0
+
+try:
+    from hmac import compare_digest as constant_time_equal
+except ImportError: # Python 2.7.6 and earlier
+    constant_time_equal = python_constant_time_equal
+
 class DataDamagedException(IOError): pass
 
 class DataTruncatedException(DataDamagedException): pass
 
 class BadMacException(DataDamagedException): pass
 
+# MAC block size of version 1 and 2 streams, and the default
 MAC_BLOCK_SIZE = 64 * 1024
+MIN_MAC_BLOCK_SIZE = 1024
+MAX_MAC_BLOCK_SIZE = 16 * 1024 * 1024
+# Sizes chosen by choose_mac_block_size().  On the mac benchmarks, 256 KB
+# blocks are as fast as 64 KB blocks, 1 MB blocks are slower and use more
+# memory, and 16 KB blocks are about 5% slower.
+LARGE_MAC_BLOCK_SIZE = 256 * 1024
+LARGE_STREAM_LENGTH = 64 * 1024 * 1024
+# Bytes of MAC blocks that the MAC readers process at once
+MAC_BATCH_SIZE = 256 * 1024
+# Smallest number of bytes that the AES readers encrypt or decrypt at
+# once, so that tiny reads do not call the cipher for every 16 bytes
+MIN_CIPHER_CHUNK_SIZE = 16 * 1024
+
+HMAC_INNER_PAD = ''.join([chr(x ^ 0x36) for x in xrange(256)])
+HMAC_OUTER_PAD = ''.join([chr(x ^ 0x5C) for x in xrange(256)])
+
+# Format header that precedes the MAC salt.  Streams without the header
+# use format version 1: no compression and 64 KB MAC blocks.  Version 2
+# headers name the compression codec.  Version 3 headers also hold the
+# MAC block size.
+FORMAT_MAGIC = '\x89chloro\n'
+FORMAT_VERSION = 3
+FORMAT_HEADER_LENGTH = len(FORMAT_MAGIC) + 6
+V2_FORMAT_HEADER_LENGTH = len(FORMAT_MAGIC) + 2
+CODECS = {'none':0, 'zlib':1, 'bz2':2}
+ADAPTIVE_SAMPLE_SIZE = 64 * 1024
+ADAPTIVE_MIN_SAVINGS = 0.1
+COMPRESSION_CHUNK_SIZE = 64 * 1024
+
+class HmacSha256(object):
+    """Computes SHA-256 HMACs (rfc2104) with one key.
+    
+    Hashes the padded key into the inner and outer hash states once,
+    and copies those states for each MAC.  This is faster than hmac.new
+    when computing many MACs with the same key, as PBKDF2 does, and
+    when taking the MAC of a growing message many times.
+    """
+    __slots__ = ('inner', 'outer')
+    
+    def __init__(self, key):
+        """Key is a byte string."""
+        if len(key) > 64:
+            key = hashlib.sha256(key).digest()
+        key = key + '\x00' * (64 - len(key))
+        self.inner = hashlib.sha256(key.translate(HMAC_INNER_PAD))
+        self.outer = hashlib.sha256(key.translate(HMAC_OUTER_PAD))
+    
+    def digest(self, data):
+        """Returns the 32-byte MAC of data."""
+        inner = self.inner.copy()
+        inner.update(data)
+        outer = self.outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+    
+    def start(self, data=''):
+        """Returns a hash object for a message that begins with data.
+        Add to the message with the object's update() method, and get
+        the MAC of the message so far with finish()."""
+        inner = self.inner.copy()
+        inner.update(data)
+        return inner
+    
+    def finish(self, inner):
+        """Returns the 32-byte MAC of the message in the hash object
+        returned by start().  The hash object is not changed."""
+        outer = self.outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
 
 class MacAddingReader(RewindableSizedInputStream):
     """Adds a SHA-256 HMAC to the stream to authenticate the data and
@@ -48,60 +137,92 @@ class MacAddingReader(RewindableSizedInputStream):
     
     Prefixes the stream with a 16-byte salt.  Generates a 256-bit key
     using PBKDF2 with 4096 rounds of HMAC-SHA-256.  Inserts 32-byte
-    SHA-256 MACs into the stream every 64 KB.  Verify the MACs with
-    MacCheckingReader.
+    SHA-256 MACs into the stream after every block of mac_block_size
+    bytes, 64 KB by default.  Verify the MACs with MacCheckingReader.
+    
+    When a header is provided, the stream is prefixed with the header
+    before the salt and every MAC also authenticates the header.
     
     Production code should not provide values for the
     testing_only_salt or test_only_key parameters.  These are for
     testing purposes only.
     """
+    __slots__ = ('stream', 'header', 'mac_block_size', 'salt', 'hmac',
+                 'prefix', 'prefix_offset', 'mac', 'stream_at_start',
+                 'stream_at_eof')
+    
     def __init__(self, stream, passphrase,
-                 testing_only_salt=None, testing_only_key=None):
-        """Stream must be a RewindableSizedInputStream object.
-        Passphrase is a byte stream."""
-        num_full_blocks = len(stream) / MAC_BLOCK_SIZE
-        num_partial_blocks = 0 if len(stream) % MAC_BLOCK_SIZE == 0 else 1
-        num_blocks = num_full_blocks + num_partial_blocks
-        num_macs = max(1, num_blocks)
-        stream_length = 16 + len(stream) + 32 * num_macs
+                 testing_only_salt=None, testing_only_key=None, header='',
+                 mac_block_size=MAC_BLOCK_SIZE):
+        """Stream must be a RewindableSizedInputStream object or an
+        InputStream of unknown length.  Passphrase is a byte stream.
+        Header is a byte string."""
+        stream_length = None
+        if known_length(stream) != None:
+            num_full_blocks = len(stream) / mac_block_size
+            num_partial_blocks = 0 if len(stream) % mac_block_size == 0 else 1
+            num_blocks = num_full_blocks + num_partial_blocks
+            num_macs = max(1, num_blocks)
+            stream_length = len(header) + 16 + len(stream) + 32 * num_macs
         RewindableSizedInputStream.__init__(self, stream_length)
         self.stream = stream
+        self.header = header
+        self.mac_block_size = mac_block_size
         self.salt = testing_only_salt or os.urandom(16)
-        self.key = testing_only_key or pbkdf2_256bit(passphrase, self.salt)
-        self.rewind()
+        key = testing_only_key or pbkdf2_256bit(passphrase, self.salt)
+        self.hmac = HmacSha256(key)
+        self.reset()
     
     def read_once(self, size):
         if not self.stream:
             raise IOError("The stream is closed")
         if size < 1:
             raise ValueError("size must be greater than zero")
-        if self.prefix:
-            chunk = self.prefix[:size]
-            self.prefix = self.prefix[size:]
-            return chunk
-        if not self.stream_at_eof:
-            chunk = self.stream.read(MAC_BLOCK_SIZE)
-            if len(chunk) != MAC_BLOCK_SIZE:
+        while True:
+            prefix = self.prefix
+            offset = self.prefix_offset
+            if offset < len(prefix):
+                self.prefix_offset = offset + size
+                return prefix[offset:offset + size]
+            if self.stream_at_eof:
+                return ''
+            # Read as many whole blocks as the caller wants, up to a batch
+            mac_block_size = self.mac_block_size
+            batch_size = mac_block_size * max(
+                1, min(size, MAC_BATCH_SIZE) / mac_block_size)
+            chunk = self.stream.read(batch_size)
+            chunk_length = len(chunk)
+            if chunk_length != batch_size:
                 self.stream_at_eof = True
-            if len(chunk) == 0 and self.stream_at_start:
-                self.prefix = self.mac.digest()
-            if len(chunk) != 0:
+            hmac = self.hmac
+            mac = self.mac
+            parts = []
+            if not chunk and self.stream_at_start:
+                parts.append(hmac.finish(mac))
+            if chunk:
                 self.stream_at_start = False
-                self.mac.update(chunk)
-                self.prefix = chunk + self.mac.digest()
-            return self.read_once(size)
-        return ''
+            for start in xrange(0, chunk_length, mac_block_size):
+                block = chunk[start:start + mac_block_size]
+                mac.update(block)
+                parts.append(block)
+                parts.append(hmac.finish(mac))
+            self.prefix = ''.join(parts)
+            self.prefix_offset = 0
     
     def rewind(self):
-        self.prefix = self.salt
-        self.mac = hmac.new(self.key, digestmod=hashlib.sha256)
         self.stream.rewind()
+        self.reset()
+    
+    def reset(self):
+        self.prefix = self.header + self.salt
+        self.prefix_offset = 0
+        self.mac = self.hmac.start(self.header)
         self.stream_at_start = True
         self.stream_at_eof = False
     
     def close(self):
         self.salt = None
-        self.key = None
+        self.hmac = None
         self.mac = None
         self.prefix = None
         self.stream.close()
@@ -120,29 +241,43 @@ class MacCheckingReader(SizedInputStream):
     expected header and MACs.
     
     Removes the 16-byte salt prefix and verifies the 32-byte SHA-256
-    HMACs which appear in the stream every 64 KB.  Verifies data
-    before returning it.  Create such a stream with MacAddingReader.
+    HMACs which appear in the stream after every block of
+    mac_block_size bytes.  Verifies data before returning it, reading
+    about MAC_BATCH_SIZE bytes of blocks at a time.  Create such a
+    stream with MacAddingReader.
     
     Production code should not provide a value for the
     testing_only_key parameter.  This is for testing purposes only.
     """
-    def __init__(self, stream, passphrase, testing_only_key=None):
-        """Stream must be a SizedInputStream object.  Passphrase must
-        be a byte string."""
-        blocks_len = len(stream) - 16
-        num_full_blocks = blocks_len / (MAC_BLOCK_SIZE + 32)
-        num_partial_blocks = 0 if blocks_len % (MAC_BLOCK_SIZE + 32) == 0 else 1
-        num_blocks = num_full_blocks + num_partial_blocks
-        num_macs = max(1, num_blocks)
-        stream_length = blocks_len - 32 * num_macs
+    __slots__ = ('stream', 'mac_block_size', 'hmac', 'mac', 'buffer',
+                 'buffer_offset', 'error', 'stream_at_start', 'stream_at_eof')
+    
+    def __init__(self, stream, passphrase, testing_only_key=None, header='',
+                 mac_block_size=MAC_BLOCK_SIZE):
+        """Stream must be a SizedInputStream object or an InputStream
+        of unknown length.  Passphrase must be a byte string.  Header
+        is the format header that preceded the salt, which the caller
+        has already read from the stream."""
+        stream_length = None
+        if known_length(stream) != None:
+            blocks_len = len(stream) - len(header) - 16
+            num_full_blocks = blocks_len / (mac_block_size + 32)
+            num_partial_blocks = 0 if blocks_len % (mac_block_size + 32) == 0 else 1
+            num_blocks = num_full_blocks + num_partial_blocks
+            num_macs = max(1, num_blocks)
+            stream_length = blocks_len - 32 * num_macs
         SizedInputStream.__init__(self, stream_length)
         self.stream = stream
+        self.mac_block_size = mac_block_size
         salt = stream.read(16)
         if len(salt) != 16:
             raise DataTruncatedException("File does not contain full MAC salt.")
         key = testing_only_key or pbkdf2_256bit(passphrase, salt)
-        self.mac = hmac.new(key, digestmod=hashlib.sha256)
+        self.hmac = HmacSha256(key)
+        self.mac = self.hmac.start(header)
         self.buffer = ''
+        self.buffer_offset = 0
+        self.error = None
         self.stream_at_start = True
         self.stream_at_eof = False
     
@@ -151,82 +286,123 @@ class MacCheckingReader(SizedInputStream):
             raise IOError("The stream is closed")
         if size < 1:
             raise ValueError("size must be greater than zero")
-        if self.buffer:
-            chunk = self.buffer[:size]
-            self.buffer = self.buffer[size:]
-            return chunk
-        if self.stream_at_eof:
-            return ''
-        chunk = self.stream.read(MAC_BLOCK_SIZE + 32)
-        if len(chunk) == 0:
-            if self.stream_at_start:
-                raise DataTruncatedException("Found no data and no MAC")
-            else:
+        while True:
+            buffer = self.buffer
+            offset = self.buffer_offset
+            if offset < len(buffer):
+                # Slicing the batch buffer at an offset copies only the
+                # returned bytes
+                self.buffer_offset = offset + size
+                return buffer[offset:offset + size]
+            if self.error:
+                raise self.error
+            if self.stream_at_eof:
+                return ''
+            record_size = self.mac_block_size + 32
+            batch_size = record_size * max(
+                1, MAC_BATCH_SIZE / self.mac_block_size)
+            chunk = self.stream.read(batch_size)
+            chunk_length = len(chunk)
+            if chunk_length == 0:
+                if self.stream_at_start:
+                    raise DataTruncatedException("Found no data and no MAC")
                 return ''
-        if len(chunk) > 0:
             self.stream_at_start = False
-        if len(chunk) < 32:
-            raise DataTruncatedException("File is missing MAC at end of file")
-        if len(chunk) != MAC_BLOCK_SIZE + 32:
-            self.stream_at_eof = True
-        self.buffer = chunk[:-32]
-        self.mac.update(self.buffer)
-        expected_digest = chunk[-32:]
-        calculated_digest = self.mac.digest()
-        # Avoid timing attacks when comparing MAC
-        # http://seb.dbzteam.org/crypto/python-oauth-timing-hmac.pdf
-        diff = 0
-        for n in xrange(32):
-            diff |= ord(expected_digest[n]) ^ ord(calculated_digest[n])
-        if diff != 0:
-            raise BadMacException("The passphrase is incorrect or the file is damaged.")
-        return self.read_once(size)
+            if chunk_length != batch_size:
+                self.stream_at_eof = True
+            hmac = self.hmac
+            mac = self.mac
+            blocks = []
+            for start in xrange(0, chunk_length, record_size):
+                end = min(start + record_size, chunk_length)
+                if end - start < 32:
+                    self.error = DataTruncatedException(
+                        "File is missing MAC at end of file")
+                    break
+                block = chunk[start:end - 32]
+                mac.update(block)
+                if not constant_time_equal(chunk[end - 32:end],
+                                           hmac.finish(mac)):
+                    self.error = BadMacException(
+                        "The passphrase is incorrect or the file is damaged.")
+                    break
+                blocks.append(block)
+            # Return the blocks verified before an error, then raise the error
+            self.buffer = ''.join(blocks)
+            self.buffer_offset = 0
     
     def close(self):
+        self.hmac = None
         self.mac = None
         self.stream.close()
         self.stream = None
         self.buffer = None
 
 
+def pkcs5_padding(data_length):
+    """Returns the padding for data of the specified length.  Always
+    adds padding to make sure that last block has 16 bytes.  Uses the
+    PKCS#5 format: '\x01', '\x02\x02', '\x03\x03\x03', etc.  See
+    section 6.3 of http://www.ietf.org/rfc/rfc3852.txt"""
+    padding_bytes_needed = 16 - data_length % 16 or 16
+    return chr(padding_bytes_needed) * padding_bytes_needed
+
+
+def strip_pkcs5_padding(data):
+    """Returns data without the PKCS#5 padding at its end.  Raises
+    DataDamagedException if data does not end with valid padding."""
+    # Leaks timing info for Padding Oracle attacks
+    if len(data) < 1:
+        raise DataDamagedException("Did not find valid padding at end of file")
+    num_bytes = ord(data[-1])
+    if num_bytes < 1 or num_bytes > 16 or len(data) < num_bytes:
+        raise DataDamagedException("Did not find valid padding at end of file")
+    if data[-num_bytes:] != data[-1] * num_bytes:
+        raise DataDamagedException("Did not find valid padding at end of file")
+    return data[:-num_bytes]
+
+
 class PaddingAddingReader(RewindableSizedInputStream):
     """Adds padding so the resulting stream size is a multiple of 16
-    bytes."""
+    bytes.  Passes the stream's chunks through unchanged and returns
+    the padding after them, so the data is not copied."""
+    __slots__ = ('stream', 'stream_keep', 'suffix', 'bytes_read')
+    
     def __init__(self, stream):
-        """Stream must be a RewindableSizedInputStream."""
-        # Always add padding to make sure that last block has 16
-        # bytes.  Use the PKCS#5 format: '\x01', '\x02\x02',
-        # '\x03\x03\x03', etc.  See section 6.3 of
-        # http://www.ietf.org/rfc/rfc3852.txt
-        padding_bytes_needed = 16 - len(stream) % 16 or 16
-        self.padding = chr(padding_bytes_needed) * padding_bytes_needed
-        stream_length = len(stream) + len(self.padding)
-        assert(stream_length % 16 == 0)
+        """Stream must be a RewindableSizedInputStream or an
+        InputStream of unknown length."""
+        stream_length = None
+        if known_length(stream) != None:
+            stream_length = len(stream) + len(pkcs5_padding(len(stream)))
+            assert(stream_length % 16 == 0)
         RewindableSizedInputStream.__init__(self, stream_length)
-        self.stream = stream
         self.stream_keep = stream
-        self.rewind()
+        self.reset()
     
     def read_once(self, size):
         if size < 1:
             raise ValueError("size must be greater than zero")
-        if self.stream:
-            chunk = self.stream.read(size)
-            if len(chunk) == size:
+        stream = self.stream
+        if stream:
+            chunk = stream.read_once(size)
+            if chunk:
+                self.bytes_read += len(chunk)
                 return chunk
-            else: # EOF
-                self.stream = None
-                self.suffix = chunk + self.suffix
-                return self.read_once(size)
-        else:
-            chunk = self.suffix[:size]
-            self.suffix = self.suffix[size:]
-            return chunk
+            # EOF
+            self.stream = None
+            self.suffix = pkcs5_padding(self.bytes_read)
+        suffix = self.suffix
+        self.suffix = suffix[size:]
+        return suffix[:size]
 
     def rewind(self):
-        self.suffix = self.padding
+        self.stream_keep.rewind()
+        self.reset()
+    
+    def reset(self):
+        self.suffix = ''
+        self.bytes_read = 0
         self.stream = self.stream_keep
-        self.stream.rewind()
     
     def close(self):
         self.suffix = None
@@ -243,59 +419,61 @@ class PaddingStrippingReader(SizedInputStream):
     Raises DataDamagedException if no padding is found at end of
     stream.
     
+    When the stream's length is known and a multiple of 16, passes its
+    chunks through unchanged up to the last 16 bytes, which hold the
+    padding.  Otherwise holds back the last 16 bytes read, since they
+    may be the padding.
+    
     Be sure to use MacCheckingReader to authenticate your data before
     decrypting and checking padding.  When used with
     AesCbcDecryptingReader alone, this class can make your software
     vulnerable to a padding oracle attack.  When in doubt, just use
     DecryptingReader.
     """
+    __slots__ = ('stream', 'stream_keep', 'bytes_read', 'tail')
+    
     def __init__(self, stream):
-        """Stream must be a SizedInputStream."""
-        SizedInputStream.__init__(self, len(stream))
+        """Stream must be a SizedInputStream or an InputStream of
+        unknown length."""
+        SizedInputStream.__init__(self, known_length(stream))
         self.stream = stream
         self.stream_keep = stream
-        self.buffer = ''
+        self.bytes_read = 0
+        self.tail = ''
     
     def read_once(self, size):
         if size < 1:
             raise ValueError("size must be greater than zero")
-        
-        if len(self.buffer) >= size + 16:
-            chunk = self.buffer[:size]
-            self.buffer = self.buffer[size:]
-            return chunk
-        if self.stream:
-            bytes_needed = size + 16 - len(self.buffer)
-            chunk = self.stream.read(bytes_needed)
-            if len(chunk) == bytes_needed:
-                self.buffer = self.buffer + chunk
-                result = self.buffer[:size]
-                self.buffer = self.buffer[size:]
-                assert(len(self.buffer) == 16)
-                return result
-            else: # EOF
-                self.stream = None
-                self.buffer = self.buffer + chunk
-                # strip padding, leaks timing info for Padding Oracle
-                # attacks
-                if len(self.buffer) < 1:
-                    raise DataDamagedException("Did not find valid padding at end of file")
-                num_bytes = ord(self.buffer[-1])
-                if num_bytes > 16 or len(self.buffer) < num_bytes:
-                    raise DataDamagedException("Did not find valid padding at end of file")
-                padding_bytes = self.buffer[-num_bytes:]
-                if not all([ord(byte) == num_bytes for byte in padding_bytes]):
-                    raise DataDamagedException("Did not find valid padding at end of file")
-                self.buffer = self.buffer[:-num_bytes]
-                return self.read_once(size)
-        if self.buffer:
-            chunk = self.buffer[:size]
-            self.buffer = self.buffer[size:]
-            return chunk
-        return ''
+        stream = self.stream
+        if stream:
+            tail = self.tail
+            stream_length = self.stream_length
+            if stream_length != None and stream_length % 16 == 0:
+                bytes_before_tail = stream_length - 16 - self.bytes_read
+                if bytes_before_tail > 0:
+                    chunk = stream.read_once(min(size, bytes_before_tail))
+                    self.bytes_read += len(chunk)
+                    if chunk:
+                        return chunk
+                tail = stream.read()
+            else:
+                while True:
+                    chunk = stream.read_once(size)
+                    if not chunk:
+                        break
+                    tail += chunk
+                    if len(tail) > 16:
+                        self.tail = tail[-16:]
+                        return tail[:-16]
+            # EOF
+            self.tail = strip_pkcs5_padding(tail)
+            self.stream = None
+        tail = self.tail
+        self.tail = tail[size:]
+        return tail[:size]
     
     def close(self):
-        self.buffer = None
+        self.tail = None
         self.stream_keep.close()
         self.stream_keep = None
         self.stream = None
@@ -316,15 +494,20 @@ class AesCbcEncryptingReader(RewindableSizedInputStream):
     testing_only_salt, testing_only_iv, or test_only_key parameters.
     These are for testing purposes only.
     """
+    __slots__ = ('stream', 'stream_keep', 'salt', 'iv', 'key', 'aes', 'buffer',
+                 'buffer_offset')
+    
     def __init__(self, stream, passphrase, 
                  testing_only_salt=None, testing_only_iv=None, testing_only_key=None):
-        """Stream must be a RewindableSizedInputStream.  Passphrase
-        must be a byte string."""
-        if len(stream) % 16:
-            raise ValueError("Stream length must be a multiple of 16")
-        stream_length = 16 + 16 + len(stream)
+        """Stream must be a RewindableSizedInputStream or an
+        InputStream of unknown length.  Passphrase must be a byte
+        string."""
+        stream_length = None
+        if known_length(stream) != None:
+            if len(stream) % 16:
+                raise ValueError("Stream length must be a multiple of 16")
+            stream_length = 16 + 16 + len(stream)
         RewindableSizedInputStream.__init__(self, stream_length)
-        self.stream = stream
         self.stream_keep = stream
         self.salt = testing_only_salt or os.urandom(16)
         # For a discussion of CBC mode and how to choose IVs, see
@@ -333,33 +516,40 @@ class AesCbcEncryptingReader(RewindableSizedInputStream):
         # http://csrc.nist.gov/publications/nistpubs/800-38a/sp800-38a.pdf
         self.iv = testing_only_iv or os.urandom(16)
         self.key = testing_only_key or pbkdf2_256bit(passphrase, self.salt)
-        self.rewind()
+        self.reset()
     
     def read_once(self, size):
         if size < 1:
             raise ValueError("size must be greater than zero")
-        if self.buffer:
-            chunk = self.buffer[:size]
-            self.buffer = self.buffer[size:]
-            return chunk
-        if self.stream:
-            bytes_needed = size
+        while True:
+            buffer = self.buffer
+            offset = self.buffer_offset
+            if offset < len(buffer):
+                self.buffer_offset = offset + size
+                return buffer[offset:offset + size]
+            stream = self.stream
+            if not stream:
+                return ''
+            bytes_needed = max(size, MIN_CIPHER_CHUNK_SIZE)
             if bytes_needed % 16:
                 bytes_needed += 16 - bytes_needed % 16 # round up
-            chunk = self.stream.read(bytes_needed)
+            chunk = stream.read(bytes_needed)
             if len(chunk) != bytes_needed:
                 self.stream = None
             if len(chunk) % 16:
                 raise ValueError("Data ended in middle of block.")
             self.buffer = self.aes.encrypt(chunk)
-            return self.read_once(size)
-        return ''
+            self.buffer_offset = 0
     
     def rewind(self):
+        self.stream_keep.rewind()
+        self.reset()
+    
+    def reset(self):
         self.aes = AES.new(self.key, AES.MODE_CBC, self.iv)
         self.buffer = self.salt + self.iv
+        self.buffer_offset = 0
         self.stream = self.stream_keep
-        self.stream.rewind()
     
     def close(self):
         self.buffer = None
@@ -381,12 +571,17 @@ class AesCbcDecryptingReader(SizedInputStream):
     Production code should not provide a value for the
     testing_only_key parameter.  This is for testing purposes only.
     """
+    __slots__ = ('stream', 'stream_keep', 'aes', 'buffer', 'buffer_offset',
+                 'error')
+    
     def __init__(self, stream, passphrase, testing_only_key=None):
-        """Stream must be a SizedInputStream.  Passphrase must be a
-        byte string."""
-        if len(stream) < 32:
-            raise DataTruncatedException("File too short to contain header")
-        stream_length = -16 - 16 + len(stream)
+        """Stream must be a SizedInputStream or an InputStream of
+        unknown length.  Passphrase must be a byte string."""
+        stream_length = None
+        if known_length(stream) != None:
+            if len(stream) < 32:
+                raise DataTruncatedException("File too short to contain header")
+            stream_length = -16 - 16 + len(stream)
         SizedInputStream.__init__(self, stream_length)
         self.stream = stream
         self.stream_keep = stream
@@ -398,26 +593,37 @@ class AesCbcDecryptingReader(SizedInputStream):
         key = testing_only_key or pbkdf2_256bit(passphrase, salt)
         self.aes = AES.new(key, AES.MODE_CBC, iv)
         self.buffer = ''
+        self.buffer_offset = 0
+        self.error = None
     
     def read_once(self, size):
         if size < 1:
             raise ValueError("size must be greater than zero")
-        if self.buffer:
-            chunk = self.buffer[:size]
-            self.buffer = self.buffer[size:]
-            return chunk
-        if self.stream:
-            bytes_needed = size - len(self.buffer)
+        while True:
+            buffer = self.buffer
+            offset = self.buffer_offset
+            if offset < len(buffer):
+                self.buffer_offset = offset + size
+                return buffer[offset:offset + size]
+            if self.error:
+                raise self.error
+            stream = self.stream
+            if not stream:
+                return ''
+            bytes_needed = max(size, MIN_CIPHER_CHUNK_SIZE)
             if bytes_needed % 16:
                 bytes_needed += 16 - bytes_needed % 16 # round up
-            chunk = self.stream.read(bytes_needed)
+            chunk = stream.read(bytes_needed)
             if len(chunk) != bytes_needed: # EOF
                 self.stream = None
-            if len(chunk) % 16:
-                raise DataTruncatedException("Data ended in middle of block.")
-            self.buffer = self.buffer + self.aes.decrypt(chunk)
-            return self.read_once(size)
-        return ''
+            partial_length = len(chunk) % 16
+            if partial_length:
+                # Return the whole blocks, then raise the error
+                self.error = DataTruncatedException(
+                    "Data ended in middle of block.")
+                chunk = chunk[:-partial_length]
+            self.buffer = self.aes.decrypt(chunk)
+            self.buffer_offset = 0
     
     def close(self):
         self.buffer = None
@@ -427,23 +633,273 @@ class AesCbcDecryptingReader(SizedInputStream):
         self.stream = None
 
 
+class PrefixedReader(RewindableSizedInputStream):
+    """Yields a prefix that was already read from the stream, followed
+    by the rest of the stream.  Rewinding rewinds the stream and
+    discards the prefix."""
+    __slots__ = ('prefix', 'stream')
+    
+    def __init__(self, prefix, stream):
+        """Stream must be a SizedInputStream or an InputStream of
+        unknown length, with prefix read from its start."""
+        RewindableSizedInputStream.__init__(self, known_length(stream))
+        self.prefix = prefix
+        self.stream = stream
+    
+    def read_once(self, size):
+        prefix = self.prefix
+        if prefix:
+            self.prefix = prefix[size:]
+            return prefix[:size]
+        return self.stream.read(size)
+    
+    def rewind(self):
+        self.stream.rewind()
+        self.prefix = ''
+    
+    def close(self):
+        self.stream.close()
+        self.prefix = None
+
+
+def new_compressor(codec):
+    """Returns an object with compress(data) and flush() methods for
+    the codec named 'none', 'zlib', or 'bz2'."""
+    if codec == 'zlib':
+        return zlib.compressobj()
+    elif codec == 'bz2':
+        import bz2
+        return bz2.BZ2Compressor()
+    elif codec == 'none':
+        return NullCodec()
+    raise ValueError("Unknown compression codec %r" % codec)
+
+def new_decompressor(codec):
+    """Returns an object with a decompress(data) method for the codec
+    named 'none', 'zlib', or 'bz2'."""
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    elif codec == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+    elif codec == 'none':
+        return NullCodec()
+    raise ValueError("Unknown compression codec %r" % codec)
+
+class NullCodec(object):
+    __slots__ = ()
+    
+    def compress(self, data):
+        return data
+    
+    def decompress(self, data):
+        return data
+    
+    def flush(self):
+        return ''
+
+def choose_codec(sample):
+    """Returns 'zlib' if compressing the sample saves space, otherwise
+    'none'.  Used to skip compression of data that is already
+    compressed, such as gzip archives, JPEG images, and video."""
+    if not sample:
+        return 'none'
+    compressed_len = len(zlib.compress(sample, 1))
+    if compressed_len <= len(sample) * (1 - ADAPTIVE_MIN_SAVINGS):
+        return 'zlib'
+    return 'none'
+
+def choose_mac_block_size(stream_length):
+    """Returns the MAC block size for a stream of the specified length,
+    or of unknown length when stream_length is None.  Bulk data, such
+    as archives piped from tar, gets large blocks, which have fewer
+    MACs to compute and store.  Other streams get 64 KB blocks."""
+    if stream_length == None or stream_length >= LARGE_STREAM_LENGTH:
+        return LARGE_MAC_BLOCK_SIZE
+    return MAC_BLOCK_SIZE
+
+def check_mac_block_size(mac_block_size):
+    if not MIN_MAC_BLOCK_SIZE <= mac_block_size <= MAX_MAC_BLOCK_SIZE:
+        raise ValueError("MAC block size must be from %s to %s bytes"
+                         % (MIN_MAC_BLOCK_SIZE, MAX_MAC_BLOCK_SIZE))
+
+def format_header(codec, mac_block_size=MAC_BLOCK_SIZE):
+    """Returns the version 3 format header for the codec and MAC block
+    size."""
+    return (FORMAT_MAGIC + chr(FORMAT_VERSION) + chr(CODECS[codec]) +
+            struct.pack('!I', mac_block_size))
+
+def read_format_header(stream):
+    """Reads the format header from the start of the stream.  Returns a
+    tuple (header, codec, mac_block_size, stream).  For version 1
+    streams, which have no header, returns ('', None, MAC_BLOCK_SIZE,
+    stream) where stream is a new stream yielding the bytes that were
+    read to look for the header.  Raises DataDamagedException if the
+    header has an unsupported version, codec, or MAC block size."""
+    header = stream.read(V2_FORMAT_HEADER_LENGTH)
+    if not header.startswith(FORMAT_MAGIC):
+        return ('', None, MAC_BLOCK_SIZE, PrefixedReader(header, stream))
+    if len(header) != V2_FORMAT_HEADER_LENGTH:
+        raise DataTruncatedException("File does not contain full header")
+    version = ord(header[len(FORMAT_MAGIC)])
+    if version == 2:
+        mac_block_size = MAC_BLOCK_SIZE
+    elif version == 3:
+        header += stream.read(FORMAT_HEADER_LENGTH - V2_FORMAT_HEADER_LENGTH)
+        if len(header) != FORMAT_HEADER_LENGTH:
+            raise DataTruncatedException("File does not contain full header")
+        (mac_block_size,) = struct.unpack('!I', header[V2_FORMAT_HEADER_LENGTH:])
+        try:
+            check_mac_block_size(mac_block_size)
+        except ValueError, e:
+            raise DataDamagedException(str(e))
+    else:
+        raise DataDamagedException("Unsupported format version %s" % version)
+    codec_id = ord(header[len(FORMAT_MAGIC) + 1])
+    for (codec, value) in CODECS.items():
+        if value == codec_id:
+            return (header, codec, mac_block_size, stream)
+    raise DataDamagedException("Unsupported compression codec %s" % codec_id)
+
+
+class CompressingReader(RewindableSizedInputStream):
+    """Compresses the stream with the codec named 'none', 'zlib',
+    'bz2', or 'auto'.  The 'auto' codec compresses the first 64 KB
+    with fast zlib and chooses 'zlib' only if that saves space.  The
+    chosen codec is stored in the codec attribute.  The length of the
+    compressed stream is not known in advance, except with the 'none'
+    codec."""
+    __slots__ = ('codec', 'stream', 'compressor', 'buffer', 'buffer_offset')
+    
+    def __init__(self, stream, codec='auto'):
+        """Stream must be a RewindableSizedInputStream or an
+        InputStream of unknown length."""
+        if codec == 'auto':
+            sample = stream.read(ADAPTIVE_SAMPLE_SIZE)
+            codec = choose_codec(sample)
+            stream = PrefixedReader(sample, stream)
+        new_compressor(codec) # check codec name
+        stream_length = None
+        if codec == 'none':
+            stream_length = known_length(stream)
+        RewindableSizedInputStream.__init__(self, stream_length)
+        self.codec = codec
+        self.stream = stream
+        self.reset()
+    
+    def read_once(self, size):
+        if size < 1:
+            raise ValueError("size must be greater than zero")
+        while self.buffer_offset >= len(self.buffer) and self.compressor:
+            chunk = self.stream.read(COMPRESSION_CHUNK_SIZE)
+            if chunk:
+                self.buffer = self.compressor.compress(chunk)
+            else:
+                self.buffer = self.compressor.flush()
+                self.compressor = None
+            self.buffer_offset = 0
+        offset = self.buffer_offset
+        self.buffer_offset = offset + size
+        return self.buffer[offset:offset + size]
+    
+    def rewind(self):
+        self.stream.rewind()
+        self.reset()
+    
+    def reset(self):
+        self.compressor = new_compressor(self.codec)
+        self.buffer = ''
+        self.buffer_offset = 0
+    
+    def close(self):
+        self.stream.close()
+        self.compressor = None
+        self.buffer = None
+
+
+class DecompressingReader(SizedInputStream):
+    """Decompresses a stream made by CompressingReader.  Raises
+    DataDamagedException if the compressed data is invalid."""
+    __slots__ = ('stream', 'decompressor', 'buffer', 'buffer_offset')
+    
+    def __init__(self, stream, codec):
+        """Stream must be a SizedInputStream or an InputStream of
+        unknown length.  Codec is 'none', 'zlib', or 'bz2'."""
+        stream_length = None
+        if codec == 'none':
+            stream_length = known_length(stream)
+        SizedInputStream.__init__(self, stream_length)
+        self.stream = stream
+        self.decompressor = new_decompressor(codec)
+        self.buffer = ''
+        self.buffer_offset = 0
+    
+    def read_once(self, size):
+        if size < 1:
+            raise ValueError("size must be greater than zero")
+        while self.buffer_offset >= len(self.buffer) and self.decompressor:
+            chunk = self.stream.read(COMPRESSION_CHUNK_SIZE)
+            if not chunk:
+                self.decompressor = None
+                break
+            try:
+                self.buffer = self.decompressor.decompress(chunk)
+            except (zlib.error, IOError, EOFError), e:
+                raise DataDamagedException("Compressed data is damaged: %s" % e)
+            self.buffer_offset = 0
+        offset = self.buffer_offset
+        self.buffer_offset = offset + size
+        return self.buffer[offset:offset + size]
+    
+    def close(self):
+        self.stream.close()
+        self.decompressor = None
+        self.buffer = None
+
+
 class EncryptingReader(RewindableSizedInputStream):
     """Encrypts the stream with AES in CBC mode.
     
     This is a convenience class that transforms the plaintext into
     ciphertext using a pipeline of PaddingAddingReader,
-    AesCbcEncryptingReader, and MacAddingReader.
+    AesCbcEncryptingReader, and MacAddingReader.  When the plaintext
+    stream's length is not known, the ciphertext's length is not known
+    either and len() raises TypeError.
+    
+    When compression is 'zlib', 'bz2', 'none', or 'auto', the
+    plaintext is first compressed with CompressingReader.  When
+    compression or mac_block_size is given, the ciphertext starts with
+    a version 3 format header naming the codec and MAC block size.
+    Mac_block_size is a number of bytes, or 'auto' to choose one with
+    choose_mac_block_size().  Otherwise the ciphertext has the version
+    1 format, which older versions of this library can decrypt.
     
     Production code should not provide values for the
     testing_only_salt, testing_only_iv, or test_only_key parameters.
     These are for testing purposes only.
     """
+    __slots__ = ('stream',)
+    
     def __init__(self, stream, passphrase,
-                 testing_only_salt=None, testing_only_iv=None, testing_only_key=None):
+                 testing_only_salt=None, testing_only_iv=None, testing_only_key=None,
+                 compression=None, mac_block_size=None):
+        header = ''
+        if mac_block_size == 'auto':
+            mac_block_size = choose_mac_block_size(known_length(stream))
+        elif mac_block_size != None:
+            check_mac_block_size(mac_block_size)
+        if compression != None or mac_block_size != None:
+            mac_block_size = mac_block_size or MAC_BLOCK_SIZE
+            codec = 'none'
+            if compression != None:
+                stream = CompressingReader(stream, compression)
+                codec = stream.codec
+            header = format_header(codec, mac_block_size)
         s1 = PaddingAddingReader(stream)
         s2 = AesCbcEncryptingReader(s1, passphrase, testing_only_salt, testing_only_iv, testing_only_key)
-        s3 = MacAddingReader(s2, passphrase, testing_only_salt, testing_only_key)
-        RewindableSizedInputStream.__init__(self, len(s3))
+        s3 = MacAddingReader(s2, passphrase, testing_only_salt, testing_only_key, header,
+                             mac_block_size or MAC_BLOCK_SIZE)
+        RewindableSizedInputStream.__init__(self, known_length(s3))
         self.stream = s3
     
     def read_once(self, size):
@@ -464,16 +920,25 @@ class DecryptingReader(SizedInputStream):
     plaintext using a pipeline of MacCheckingReader,
     AesCbcDecryptingReader, and PaddingStrippingReader.  Due to
     padding, the stream may yield up to 16 bytes less than the value
-    of len(stream).
+    of len(stream).  Streams with a format header naming a codec
+    other than 'none' are also decompressed with DecompressingReader.
+    The length of a decompressed stream is not known and len() raises
+    TypeError.
     
     Production code should not provide a value for the
     testing_only_key parameter.  This is for testing purposes only.
     """
+    __slots__ = ('stream',)
+    
     def __init__(self, stream, passphrase, testing_only_key=None):
-        s1 = MacCheckingReader(stream, passphrase, testing_only_key)
+        (header, codec, mac_block_size, stream) = read_format_header(stream)
+        s1 = MacCheckingReader(stream, passphrase, testing_only_key, header,
+                               mac_block_size)
         s2 = AesCbcDecryptingReader(s1, passphrase, testing_only_key)
         s3 = PaddingStrippingReader(s2)
-        SizedInputStream.__init__(self, len(s3))
+        if codec not in (None, 'none'):
+            s3 = DecompressingReader(s3, codec)
+        SizedInputStream.__init__(self, known_length(s3))
         self.stream = s3
     
     def read_once(self, size):
@@ -492,11 +957,11 @@ def pbkdf2_256bit(passphrase, salt, rounds=4096):
     PBKDF2 with 4096 rounds of HMAC-SHA-256.  Passphrase and salt must
     be byte strings."""
     passphrase_bytes = passphrase.encode('utf-8')
-    prf = lambda p, data: hmac.new(p, data, digestmod=hashlib.sha256).digest()
-    block = prf(passphrase_bytes, salt + '\x00\x00\x00\x01')
+    prf = HmacSha256(passphrase_bytes).digest
+    block = prf(salt + '\x00\x00\x00\x01')
     (a,b,c,d) = struct.unpack('!QQQQ', block)
     for x in xrange(1, rounds):
-        block = prf(passphrase_bytes, block)
+        block = prf(block)
         (i,j,k,l) = struct.unpack('!QQQQ', block)
         a = a^i
         b = b^j
@@ -513,8 +978,9 @@ def main(args):
         elif passphrasefilename:
             passphrase = open(passphrasefilename, 'rb').read().strip()
         else:
+            import getpass
             passphrase = getpass.getpass('Passphrase: ')
-        infile_reader = FileObjectReader(sys.stdin, 1024)
+        infile_reader = PipeReader(sys.stdin)
         outfile = sys.stdout
         if infilename and infilename != '-':
             infile_reader = FileReader(infilename)
@@ -534,20 +1000,14 @@ def main(args):
 
 def encrypt(passphrase, infile_reader, outfile):
     encrypted = EncryptingReader(infile_reader, passphrase)
-    while True:
-        chunk = encrypted.read(65536)
-        if not chunk:
-            break
-        outfile.write(chunk)
+    (bytes_copied, seconds) = copy_stream(encrypted, outfile)
+    print >>sys.stderr, "Encrypted %s" % format_throughput(bytes_copied, seconds)
     return 0
 
 def decrypt(passphrase, infile_reader, outfile):
     decrypted = DecryptingReader(infile_reader, passphrase)
-    while True:
-        chunk = decrypted.read(65536)
-        if not chunk:
-            break
-        outfile.write(chunk)
+    (bytes_copied, seconds) = copy_stream(decrypted, outfile)
+    print >>sys.stderr, "Decrypted %s" % format_throughput(bytes_copied, seconds)
     return 0
 
 def entry_point():
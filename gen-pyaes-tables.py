@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Generates the lookup tables in pyaes.py and checks them.
+
+pyaes.py holds its tables as literals, so that importing it does not
+recompute them in every process.  This script computes the tables from
+their definitions with galois_multiply() and the S-box affine
+transformation.
+
+Usage:
+  python gen-pyaes-tables.py           print the table source for pyaes.py
+  python gen-pyaes-tables.py --check   compare pyaes.py with computed tables
+"""
+
+import sys
+
+# Constants of the GF(2^8) multiplication tables in pyaes.py
+GF_MULTIPLIERS = [2, 3, 9, 11, 13, 14]
+
+def galois_multiply(a, b):
+    """Galois Field multiplication for AES"""
+    p = 0
+    while b:
+        if b & 1:
+            p ^= a
+        a <<= 1
+        if a & 0x100:
+            a ^= 0x1b
+        b >>= 1
+    return p & 0xff
+
+def galois_inverse(a):
+    """Returns the multiplicative inverse of a, or 0 for 0"""
+    if a == 0:
+        return 0
+    for b in xrange(1, 256):
+        if galois_multiply(a, b) == 1:
+            return b
+
+def rotate_left(byte, bits):
+    return ((byte << bits) | (byte >> (8 - bits))) & 0xff
+
+def compute_sbox():
+    sbox = []
+    for x in xrange(256):
+        b = galois_inverse(x)
+        sbox.append(b ^ rotate_left(b, 1) ^ rotate_left(b, 2) ^
+                    rotate_left(b, 3) ^ rotate_left(b, 4) ^ 0x63)
+    return sbox
+
+def compute_inv_sbox(sbox):
+    inv_sbox = [0] * 256
+    for (x, y) in enumerate(sbox):
+        inv_sbox[y] = x
+    return inv_sbox
+
+def compute_rcon():
+    """Returns the 255 powers of 2, starting with 2**-1 like pyaes"""
+    rcon = [0x8d]
+    for n in xrange(254):
+        rcon.append(galois_multiply(rcon[-1], 2))
+    return rcon
+
+def compute_tables():
+    """Returns a list of (name, values) tuples"""
+    tables = []
+    for multiplier in GF_MULTIPLIERS:
+        tables.append(('gf_mul_by_%s' % multiplier,
+                       [galois_multiply(x, multiplier) for x in xrange(256)]))
+    sbox = compute_sbox()
+    tables.append(('aes_sbox', sbox))
+    tables.append(('aes_inv_sbox', compute_inv_sbox(sbox)))
+    tables.append(('aes_Rcon', compute_rcon()))
+    return tables
+
+def format_table(name, values):
+    """Returns the source of a table in the style of pyaes.py"""
+    data = ''.join([chr(v) for v in values]).encode('hex')
+    lines = ["    '%s'" % data[n:n + 32] for n in xrange(0, len(data), 32)]
+    lines[-1] += ".decode('hex')"
+    return "%s = array('B',\n%s\n)\n" % (name, "\n".join(lines))
+
+def check_tables():
+    """Returns a list of the names of the tables in pyaes.py that differ
+    from the computed tables."""
+    import pyaes
+    mismatched = []
+    for (name, values) in compute_tables():
+        if list(getattr(pyaes, name, None) or []) != values:
+            mismatched.append(name)
+    for multiplier in GF_MULTIPLIERS:
+        table = getattr(pyaes, 'gf_mul_by_%s' % multiplier, None) or []
+        if list(table) != [pyaes.galois_multiply(x, multiplier)
+                           for x in xrange(256)]:
+            mismatched.append('galois_multiply(x, %s)' % multiplier)
+    return mismatched
+
+def main(args):
+    if args == ['--check']:
+        mismatched = check_tables()
+        for name in mismatched:
+            print >>sys.stderr, "pyaes.%s is wrong" % name
+        if mismatched:
+            return 1
+        return 0
+    if args:
+        print >>sys.stderr, __doc__.strip()
+        return 1
+    for (name, values) in compute_tables():
+        print format_table(name, values)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
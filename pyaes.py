@@ -73,6 +73,12 @@ def new(key, mode, IV=None):
 
 #### AES cipher implementation
 
+# Expanded keys by key, so that creating many AES objects with the same key,
+# as when a stream is encrypted again on retry, expands the key only once.
+# Holds at most KEY_CACHE_SIZE keys.
+KEY_CACHE_SIZE = 64
+key_cache = {}
+
 class AES(object):
     block_size = 16
 
@@ -94,10 +100,22 @@ class AES(object):
         else:
             raise ValueError, "Key length must be 16, 24 or 32 bytes"
 
-        self.expand_key()
+        cached = key_cache.get(key)
+        if cached is None:
+            self.expand_key()
+            while len(key_cache) >= KEY_CACHE_SIZE:
+                try:
+                    key_cache.popitem()
+                except KeyError:
+                    break
+            key_cache[key] = (self.exkey, self.round_keys)
+        else:
+            self.exkey, self.round_keys = cached
 
     def expand_key(self):
-        """Performs AES key expansion on self.key and stores in self.exkey"""
+        """Performs AES key expansion on self.key and stores in self.exkey as a
+        flat list of ints, and in self.round_keys as a list of ints for each
+        round"""
 
         # The key schedule specifies how parts of the key are fed into the
         # cipher's round functions. "Key expansion" means performing this
@@ -159,16 +177,18 @@ class AES(object):
                     word[j] ^= exkey[-self.key_size + j]
                 exkey.extend(word)
 
-        self.exkey = exkey
+        # Lists of ints, since indexing a list is faster than indexing an array
+        self.exkey = exkey.tolist()
+        self.round_keys = tuple([self.exkey[offset : offset+16]
+                                 for offset in xrange(0, len(exkey), 16)])
 
     def add_round_key(self, block, round):
         """AddRoundKey step in AES. This is where the key is mixed into plaintext"""
 
-        offset = round * 16
-        exkey = self.exkey
+        round_key = self.round_keys[round]
 
         for i in xrange(16):
-            block[i] ^= exkey[offset + i]
+            block[i] ^= round_key[i]
 
         #print 'AddRoundKey:', block
 
@@ -412,14 +432,124 @@ def galois_multiply(a, b):
 
     return p & 0xff
 
-# Precompute the multiplication tables for encryption
-gf_mul_by_2  = array('B', [galois_multiply(x,  2) for x in range(256)])
-gf_mul_by_3  = array('B', [galois_multiply(x,  3) for x in range(256)])
+# Precomputed multiplication tables, generated by gen-pyaes-tables.py.  Each
+# gf_mul_by_N[x] == galois_multiply(x, N)
+
+# ... for encryption
+gf_mul_by_2 = array('B',
+    '00020406080a0c0e10121416181a1c1e'
+    '20222426282a2c2e30323436383a3c3e'
+    '40424446484a4c4e50525456585a5c5e'
+    '60626466686a6c6e70727476787a7c7e'
+    '80828486888a8c8e90929496989a9c9e'
+    'a0a2a4a6a8aaacaeb0b2b4b6b8babcbe'
+    'c0c2c4c6c8caccced0d2d4d6d8dadcde'
+    'e0e2e4e6e8eaeceef0f2f4f6f8fafcfe'
+    '1b191f1d131117150b090f0d03010705'
+    '3b393f3d333137352b292f2d23212725'
+    '5b595f5d535157554b494f4d43414745'
+    '7b797f7d737177756b696f6d63616765'
+    '9b999f9d939197958b898f8d83818785'
+    'bbb9bfbdb3b1b7b5aba9afada3a1a7a5'
+    'dbd9dfddd3d1d7d5cbc9cfcdc3c1c7c5'
+    'fbf9fffdf3f1f7f5ebe9efede3e1e7e5'.decode('hex')
+)
+
+gf_mul_by_3 = array('B',
+    '000306050c0f0a09181b1e1d14171211'
+    '303336353c3f3a39282b2e2d24272221'
+    '606366656c6f6a69787b7e7d74777271'
+    '505356555c5f5a59484b4e4d44474241'
+    'c0c3c6c5cccfcac9d8dbdeddd4d7d2d1'
+    'f0f3f6f5fcfffaf9e8ebeeede4e7e2e1'
+    'a0a3a6a5acafaaa9b8bbbebdb4b7b2b1'
+    '909396959c9f9a99888b8e8d84878281'
+    '9b989d9e97949192838085868f8c898a'
+    'aba8adaea7a4a1a2b3b0b5b6bfbcb9ba'
+    'fbf8fdfef7f4f1f2e3e0e5e6efece9ea'
+    'cbc8cdcec7c4c1c2d3d0d5d6dfdcd9da'
+    '5b585d5e57545152434045464f4c494a'
+    '6b686d6e67646162737075767f7c797a'
+    '3b383d3e37343132232025262f2c292a'
+    '0b080d0e07040102131015161f1c191a'.decode('hex')
+)
+
 # ... for decryption
-gf_mul_by_9  = array('B', [galois_multiply(x,  9) for x in range(256)])
-gf_mul_by_11 = array('B', [galois_multiply(x, 11) for x in range(256)])
-gf_mul_by_13 = array('B', [galois_multiply(x, 13) for x in range(256)])
-gf_mul_by_14 = array('B', [galois_multiply(x, 14) for x in range(256)])
+gf_mul_by_9 = array('B',
+    '0009121b242d363f48415a536c657e77'
+    '9099828bb4bda6afd8d1cac3fcf5eee7'
+    '3b3229201f160d04737a6168575e454c'
+    'aba2b9b08f869d94e3eaf1f8c7ced5dc'
+    '767f646d525b40493e372c251a130801'
+    'e6eff4fdc2cbd0d9aea7bcb58a839891'
+    '4d445f5669607b72050c171e2128333a'
+    'ddd4cfc6f9f0ebe2959c878eb1b8a3aa'
+    'ece5fef7c8c1dad3a4adb6bf8089929b'
+    '7c756e6758514a43343d262f1019020b'
+    'd7dec5ccf3fae1e89f968d84bbb2a9a0'
+    '474e555c636a71780f061d142b223930'
+    '9a938881beb7aca5d2dbc0c9f6ffe4ed'
+    '0a0318112e273c35424b5059666f747d'
+    'a1a8b3ba858c979ee9e0fbf2cdc4dfd6'
+    '3138232a151c070e79706b625d544f46'.decode('hex')
+)
+
+gf_mul_by_11 = array('B',
+    '000b161d2c273a3158534e45747f6269'
+    'b0bba6ad9c978a81e8e3fef5c4cfd2d9'
+    '7b706d66575c414a2328353e0f041912'
+    'cbc0ddd6e7ecf1fa9398858ebfb4a9a2'
+    'f6fde0ebdad1ccc7aea5b8b38289949f'
+    '464d505b6a617c771e1508033239242f'
+    '8d869b90a1aab7bcd5dec3c8f9f2efe4'
+    '3d362b20111a070c656e737849425f54'
+    'f7fce1eadbd0cdc6afa4b9b28388959e'
+    '474c515a6b607d761f1409023338252e'
+    '8c879a91a0abb6bdd4dfc2c9f8f3eee5'
+    '3c372a21101b060d646f727948435e55'
+    '010a171c2d263b3059524f44757e6368'
+    'b1baa7ac9d968b80e9e2fff4c5ced3d8'
+    '7a716c67565d404b2229343f0e051813'
+    'cac1dcd7e6edf0fb9299848fbeb5a8a3'.decode('hex')
+)
+
+gf_mul_by_13 = array('B',
+    '000d1a1734392e236865727f5c51464b'
+    'd0ddcac7e4e9fef3b8b5a2af8c81969b'
+    'bbb6a1ac8f829598d3dec9c4e7eafdf0'
+    '6b66717c5f524548030e1914373a2d20'
+    '6d60777a5954434e05081f12313c2b26'
+    'bdb0a7aa8984939ed5d8cfc2e1ecfbf6'
+    'd6dbccc1e2eff8f5beb3a4a98a87909d'
+    '060b1c11323f28256e6374795a57404d'
+    'dad7c0cdeee3f4f9b2bfa8a5868b9c91'
+    '0a07101d3e332429626f7875565b4c41'
+    '616c7b7655584f420904131e3d30272a'
+    'b1bcaba685889f92d9d4c3ceede0f7fa'
+    'b7baada0838e9994dfd2c5c8ebe6f1fc'
+    '676a7d70535e49440f0215183b36212c'
+    '0c01161b3835222f64697e73505d4a47'
+    'dcd1c6cbe8e5f2ffb4b9aea3808d9a97'.decode('hex')
+)
+
+gf_mul_by_14 = array('B',
+    '000e1c123836242a707e6c624846545a'
+    'e0eefcf2d8d6c4ca909e8c82a8a6b4ba'
+    'dbd5c7c9e3edfff1aba5b7b9939d8f81'
+    '3b352729030d1f114b455759737d6f61'
+    'ada3b1bf959b8987ddd3c1cfe5ebf9f7'
+    '4d43515f757b69673d33212f050b1917'
+    '76786a644e40525c06081a143e30222c'
+    '96988a84aea0b2bce6e8faf4ded0c2cc'
+    '414f5d537977656b313f2d230907151b'
+    'a1afbdb39997858bd1dfcdc3e9e7f5fb'
+    '9a948688a2acbeb0eae4f6f8d2dccec0'
+    '7a746668424c5e500a041618323c2e20'
+    'ece2f0fed4dac8c69c92808ea4aab8b6'
+    '0c02101e343a28267c72606e444a5856'
+    '37392b250f01131d47495b557f71636d'
+    'd7d9cbc5efe1f3fda7a9bbb59f91838d'.decode('hex')
+)
 
 ####
 
@@ -3,7 +3,6 @@ __author__ = 'Michael Leonhard'
 __license__ = 'Copyright (C) 2011 Rest Backup LLC.  Use of this software is subject to the RestBackup.com Terms of Use, http://www.restbackup.com/terms'
 __version__ = '1.1'
 
-import optparse
 import os.path
 import sys
 import time
@@ -13,11 +12,17 @@ import restbackup
 USAGE="""restbackup-cli [OPTIONS] COMMAND [args]
 
 Commands:
-  put LOCAL_FILE [REMOTE_FILE]   Upload LOCAL_FILE and store as REMOTE_FILE
+  put LOCAL_FILE [REMOTE_FILE]   Upload LOCAL_FILE and store as REMOTE_FILE,
+                                 use - for LOCAL_FILE to upload stdin
   get REMOTE_FILE [LOCAL_FILE]   Download REMOTE_FILE and save as LOCAL_FILE
-  list                           List uploaded files
+  list [PREFIX]                  List uploaded files, optionally only those
+                                 with names starting with PREFIX
   encrypt-and-put LOCAL [REMOTE] Encrypt LOCAL file and upload as REMOTE
   get-and-decrypt REMOTE [LOCAL] Download REMOTE, decrypt, and save as LOCAL
+  put-packed PREFIX FILE1 ...    Upload files and directories of small files
+                                 in packs named PREFIX-0001.pack, etc.
+  list-packed PREFIX             List the files in packs named PREFIX-*.pack
+  get-packed PACK FILE [LOCAL]   Download FILE from PACK and save as LOCAL
   make-random-passphrase         Generate a random 35-bit passphrase"""
 
 EXAMPLES="""
@@ -34,11 +39,19 @@ Examples:
   %(prog)s put data-20110615.tar.gz
   %(prog)s get /data-20110615.tar.gz ~/restored/data-20110615.tar.gz
   %(prog)s list
+  %(prog)s -c ~/.restbackup-listing-cache list /data-2011
+  %(prog)s --limit-rate 08:00-18:00=200k,18:00-08:00=2M put data.tar.gz
+  %(prog)s put-packed /etc-20110615 /etc
+  %(prog)s list-packed /etc-20110615
+  %(prog)s get-packed /etc-20110615-0001.pack /etc/hosts hosts
+  tar -cz data | %(prog)s put - /data-20110615.tar.gz
   
   %(prog)s make-random-passphrase >~/.restbackup-file-encryption-passphrase
   cat ~/.restbackup-file-encryption-passphrase
   (Write down the passphrase and keep a copy off-site!)
   %(prog)s encrypt-and-put data-20110615.tgz
+  %(prog)s -z auto encrypt-and-put database-20110615.sql
+  tar -cz data | %(prog)s encrypt-and-put - /data-20110615.tgz
   %(prog)s get-and-decrypt /data-20110615.tgz ~/restored-data-20110615.tgz"""
 
 DEFAULT_BACKUP_URL_FILE=os.path.join("~", ".restbackup-backup-api-access-url")
@@ -46,22 +59,47 @@ DEFAULT_PASS_FILE=os.path.join("~", ".restbackup-file-encryption-passphrase")
 USER_AGENT = "restbackup-cli/%s" % __version__
 
 def main(args):
+    import optparse
     parser = optparse.OptionParser(usage=USAGE, add_help_option=False)
     parser.set_defaults(backup_url_file=DEFAULT_BACKUP_URL_FILE,
                         passphrase_file=DEFAULT_PASS_FILE,
-                        access_url=None)
+                        access_url=None,
+                        cache_file=None,
+                        limit_rate=None,
+                        compression=None,
+                        mac_block_size=None,
+                        trace_file=None)
     parser.add_option("-b", action="store", type="string",
                       dest="backup_url_file",
                       help="file with backup api access url, default   %s" \
                           % DEFAULT_BACKUP_URL_FILE)
     parser.add_option("-u", action="store", type="string", dest="access_url",
                       help="access url, ignores -b and -m arguments")
+    parser.add_option("-c", action="store", type="string", dest="cache_file",
+                      help="cache the file listing in this file for %s "
+                      "seconds" % restbackup.DEFAULT_LISTING_CACHE_TTL_SECONDS)
     parser.add_option("-f", action="store_true", dest="force", 
                       help="allow overwrite of local file")
     parser.add_option("-p", action="store", type="string",
                       dest="passphrase_file",
                       help="file with encryption passphrase, default   %s" \
                           % DEFAULT_PASS_FILE)
+    parser.add_option("-z", action="store", type="choice",
+                      dest="compression", metavar="CODEC",
+                      choices=["zlib", "bz2", "auto"],
+                      help="compress before encrypting with zlib, bz2, or "
+                      "auto, which skips data that is already compressed")
+    parser.add_option("--mac-block-size", action="store", type="string",
+                      dest="mac_block_size", metavar="SIZE",
+                      help="authenticate encrypted data in blocks of SIZE "
+                      "bytes, eg. 16k or 1M, or auto to choose by file size")
+    parser.add_option("--limit-rate", action="store", type="string",
+                      dest="limit_rate", metavar="RATE",
+                      help="limit upload and download speed in bytes per "
+                      "second, eg. 200k, 2M, or 08:00-18:00=200k,18:00-08:00=2M")
+    parser.add_option("--trace", action="store", type="string",
+                      dest="trace_file", metavar="FILE",
+                      help="append timings of each request to FILE as JSON")
     parser.add_option("-h", "--help", action="store_true", dest="help", 
                       help="show the help message and usage examples")
     (options, args) = parser.parse_args()
@@ -71,6 +109,20 @@ def main(args):
         print >>sys.stdout, EXAMPLES % {'prog' : os.path.basename(sys.argv[0])}
         return 1
     
+    if options.limit_rate:
+        try:
+            set_rate_limit(options.limit_rate)
+        except ValueError, e:
+            parser.error(str(e))
+    if options.trace_file:
+        trace_requests(options.trace_file)
+    if options.mac_block_size:
+        try:
+            options.mac_block_size = parse_mac_block_size(
+                options.mac_block_size)
+        except ValueError, e:
+            parser.error(str(e))
+    
     try:
         command = args[0]
         params = args[1:]
@@ -78,21 +130,30 @@ def main(args):
         if command == "make-random-passphrase" and not params:
             return make_random_passphrase()
         elif command in ["put", "encrypt-and-put", "get", "get-and-decrypt",
-                         "list", "make-random-passphrase"]:
+                         "list", "make-random-passphrase", "put-packed",
+                         "list-packed", "get-packed"]:
             if access_url == None:
                 access_url = read_secret_from_file(options.backup_url_file)
             if command == "put" and len(params) in (1,2):
                 return put_file(access_url, None, *params)
             if command == "encrypt-and-put" and len(params) in (1,2):
                 passphrase = read_secret_from_file(options.passphrase_file)
-                return put_file(access_url, passphrase, *params)
+                return put_file(access_url, passphrase, *params,
+                                compression=options.compression,
+                                mac_block_size=options.mac_block_size)
             elif command == "get" and len(params) in (1,2):
                 return get_file(access_url, None, options.force, *params)
             elif command == "get-and-decrypt" and len(params) in (1,2):
                 passphrase = read_secret_from_file(options.passphrase_file)
                 return get_file(access_url, passphrase, options.force, *params)
-            elif command == "list" and not params:
-                return list_files(access_url)
+            elif command == "list" and len(params) in (0,1):
+                return list_files(access_url, options.cache_file, *params)
+            elif command == "put-packed" and len(params) >= 2:
+                return put_packed(access_url, params[0], params[1:])
+            elif command == "list-packed" and len(params) == 1:
+                return list_packed(access_url, *params)
+            elif command == "get-packed" and len(params) in (2,3):
+                return get_packed(access_url, options.force, *params)
             else:
                 parser.error("Incorrect number of arguments for %r command" \
                                  % command)
@@ -122,13 +183,48 @@ def make_random_passphrase():
         print password.capitalize() + prng.choice("0123456789"),
     return 0
 
+def set_rate_limit(rate_spec):
+    """Limits the upload and download speed of this process.  Raises
+    ValueError if rate_spec is not a valid RateSchedule spec."""
+    schedule = restbackup.RateSchedule(rate_spec)
+    restbackup.upload_rate_limiter.set_schedule(schedule)
+    restbackup.download_rate_limiter.set_schedule(schedule)
+
+def trace_requests(filename):
+    """Appends an event for each request attempt and download made by
+    this process to the file, as JSON lines."""
+    trace_file = open(os.path.expanduser(filename), "a")
+    exporter = restbackup.JsonLinesExporter(trace_file)
+    restbackup.default_observers.append(exporter)
+
+def parse_mac_block_size(size):
+    """Converts 'auto' or a size like '16k' or '1M' into the
+    mac_block_size argument of put_encrypted().  Raises ValueError if
+    the size is malformed or out of range."""
+    if size == 'auto':
+        return size
+    import chlorocrypt
+    try:
+        mac_block_size = restbackup.parse_size(size)
+    except ValueError:
+        raise ValueError("Invalid MAC block size %r" % size)
+    chlorocrypt.check_mac_block_size(mac_block_size)
+    return mac_block_size
+
 def read_secret_from_file(filename):
     with open(os.path.expanduser(filename), "rb") as f:
         return f.read().strip()
 
-def put_file(access_url, passphrase, local_file_name, remote_file_name=None):
+def put_file(access_url, passphrase, local_file_name, remote_file_name=None,
+             compression=None, mac_block_size=None):
     backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
-    reader = restbackup.FileReader(local_file_name)
+    if local_file_name == '-':
+        if remote_file_name == None:
+            print >>sys.stderr, "REMOTE_FILE is required when uploading stdin"
+            return 1
+        reader = restbackup.PipeReader(sys.stdin)
+    else:
+        reader = restbackup.FileReader(local_file_name)
     if remote_file_name == None:
         remote_file_name = os.path.basename(local_file_name)
     if not remote_file_name.startswith('/'):
@@ -138,7 +234,8 @@ def put_file(access_url, passphrase, local_file_name, remote_file_name=None):
             backup_api.put(name=remote_file_name, data=reader)
         else:
             backup_api.put_encrypted(passphrase, name=remote_file_name,
-                                     data=reader)
+                                     data=reader, compression=compression,
+                                     mac_block_size=mac_block_size)
         return 0
     except restbackup.RestBackup405MethodNotAllowed, e:
         print >>sys.stdout, "ERROR: %s (Cannot overwrite existing file)" % str(e)
@@ -159,20 +256,79 @@ def get_file(access_url, passphrase, force, remote_file_name,
     else:
         reader = backup_api.get_encrypted(passphrase, name=remote_file_name)
     with open(local_file_name, "wb") as local_file:
-        while True:
-            chunk = reader.read(65536)
-            if not chunk:
-                break
-            local_file.write(chunk)
+        (bytes_copied, seconds) = restbackup.copy_stream(reader, local_file)
+    print >>sys.stderr, "Retrieved %s" % restbackup.format_throughput(
+        bytes_copied, seconds)
     return 0
 
-def list_files(access_url):
+def list_files(access_url, cache_file=None, prefix=''):
     backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
-    for (name,size,createtime) in backup_api.list():
+    if cache_file == None:
+        files = (entry for entry in backup_api.iter_list()
+                 if entry[0].startswith(prefix))
+    else:
+        cache = restbackup.ListingCache(backup_api,
+                                        os.path.expanduser(cache_file))
+        files = cache.list(prefix)
+    for (name,size,createtime) in files:
         date = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(createtime))
         print date, size, name
     return 0
 
+def put_packed(access_url, name_prefix, paths):
+    backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
+    if not name_prefix.startswith('/'):
+        name_prefix = '/' + name_prefix
+    def iter_files():
+        for path in paths:
+            if os.path.isdir(path):
+                for (dirpath, dirnames, filenames) in os.walk(path):
+                    dirnames.sort()
+                    for filename in sorted(filenames):
+                        file_path = os.path.join(dirpath, filename)
+                        if os.path.isfile(file_path):
+                            yield read_pack_member(file_path)
+            else:
+                yield read_pack_member(path)
+    import restbackuppack
+    pack_names = restbackuppack.put_packed(backup_api, name_prefix,
+                                           iter_files())
+    for pack_name in pack_names:
+        print pack_name
+    return 0
+
+def read_pack_member(path):
+    return (path, restbackup.FileReader(path), int(os.path.getmtime(path)))
+
+def list_packed(access_url, name_prefix):
+    backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
+    if not name_prefix.startswith('/'):
+        name_prefix = '/' + name_prefix
+    import restbackuppack
+    for pack_name in restbackuppack.iter_packs(backup_api, name_prefix):
+        pack = restbackuppack.PackReader(backup_api, pack_name)
+        for member in pack.members():
+            print pack_name, member['size'], member['name']
+    return 0
+
+def get_packed(access_url, force, pack_name, member_name,
+               local_file_name=None):
+    backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
+    if not pack_name.startswith('/'):
+        pack_name = '/' + pack_name
+    if local_file_name == None:
+        local_file_name = os.path.basename(member_name)
+    if os.path.exists(local_file_name) and not force:
+        print >>sys.stderr, "Refusing to overwrite file %r" % local_file_name
+        return -1
+    import restbackuppack
+    reader = restbackuppack.PackReader(backup_api, pack_name).get(member_name)
+    with open(local_file_name, "wb") as local_file:
+        (bytes_copied, seconds) = restbackup.copy_stream(reader, local_file)
+    print >>sys.stderr, "Retrieved %s" % restbackup.format_throughput(
+        bytes_copied, seconds)
+    return 0
+
 def entry_point():
     sys.exit(main(sys.argv[1:]))
 
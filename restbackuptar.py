@@ -3,15 +3,12 @@ __author__ = 'Michael Leonhard'
 __license__ = 'Copyright (C) 2011 Rest Backup LLC.  Use of this software is subject to the RestBackup.com Terms of Use, http://www.restbackup.com/terms'
 __version__ = '1.1'
 
-import datetime
 import getopt
 import os
 import os.path
 import re
-import subprocess
 import sys
-import tempfile
-import threading
+import time
 
 import restbackup
 import restbackupcli
@@ -36,6 +33,9 @@ Commands:
  --incremental FILE1 ...       Perform an incremental backup
  --list                        List backup archives
  --restore ARCHIVE [FILE1 ...] Restore files from archive
+ --consolidate                 Merge the last full backup and its incremental
+                               backups into a new full backup, without reading
+                               the files.  Needs the python engine.
  --help                        Show this message
  --example                     Show example usage
 
@@ -52,6 +52,37 @@ Options:
  -p PASSPHRASE_FILE  file with encryption passphrase, default
                      ~/.restbackup-file-encryption-passphrase
                      Generate one with "restbackup-cli make-random-passphrase"
+ --mac-block-size SIZE
+                     with -e, authenticate archives in blocks of SIZE bytes,
+                     eg. 256k, or auto to choose by archive size.  Large
+                     blocks are faster for big archives.  Versions of
+                     restbackup-tar without this option cannot decrypt
+                     the archives.  Without it, archives keep the original
+                     format with 64k blocks.
+ --limit-rate RATE   limit upload and download speed in bytes per second,
+                     eg. 200k, 2M, or 08:00-18:00=200k,18:00-08:00=2M
+ --trace FILE        append timings of each request to FILE as JSON
+ --engine ENGINE     archive with 'gnu' tar or the in-process 'python' engine.
+                     Incremental backups use the engine of the full backup.
+                     Default: gnu
+ --scan-threads N    number of threads that list and stat files with the
+                     python engine, default 8.  Use more for network
+                     filesystems.
+ --volume-size SIZE  upload archives in volumes of SIZE bytes, eg. 500M or 2G.
+                     Each volume is encrypted and uploaded separately, so a
+                     failed upload is retried without restarting the backup.
+                     Needs free space in the temporary directory for
+                     VOLUME_THREADS + 2 volumes.
+ --volume-threads N  number of volumes to upload or download at once,
+                     default 4
+ --stream            upload each archive while it is written, instead of
+                     writing it to a temporary file first.  Needs no
+                     temporary space, but a failed upload is not retried
+                     and fails the backup.
+ --to-stdout         with --restore, write the contents of the files to stdout
+                     instead of extracting them, like 'tar -xO'.  Reads the
+                     archives from the newest to the oldest and stops once
+                     every file is found.
 """
 
 EXAMPLE="""Restbackup-tar Example Usage
@@ -65,16 +96,16 @@ Setup:
 Full Backup:
  $ restbackup-tar -n data -s data.snapshot --full data/
  Performing full backup to 'data-20110621T133947Z-full.tar.gz'
- Writing archive to temporary file
- Uploading 182 byte archive to https://us.restbackup.com/data-20110621T133947Z-full.tar.gz
+ Uploading archive to https://us.restbackup.com/data-20110621T133947Z-full.tar.gz
+ Uploaded 182 bytes
  Done.
 
 Incremental Backups:
  $ echo "new data" >data/file2
  $ restbackup-tar -n data -s data.snapshot --incremental data/
  Performing incremental backup to 'data-20110621T133947Z-inc1.tar.gz'
- Writing archive to temporary file
- Uploading 186 byte archive to https://us.restbackup.com/data-20110621T133947Z-inc1.tar.gz
+ Uploading archive to https://us.restbackup.com/data-20110621T133947Z-inc1.tar.gz
+ Uploaded 186 bytes
  Done.
  $ echo "a modification" >>data/file1
  $ rm -f data/file2
@@ -115,6 +146,13 @@ DEFAULT_SNAPSHOT_DIR=os.path.join("~",".restbackup-tar")
 DEFAULT_SNAPSHOT_FILE=os.path.join(DEFAULT_SNAPSHOT_DIR, "%(NAME)s.snapshot")
 DEFAULT_PASS_FILE=os.path.join("~", ".restbackup-file-encryption-passphrase")
 DEFAULT_NAME="backup"
+ENGINES = ["gnu", "python"]
+DEFAULT_ENGINE = "gnu"
+DEFAULT_VOLUME_THREADS = 4
+# Bytes copied at a time into and out of archive and volume spool files
+VOLUME_CHUNK_SIZE = 1024 * 1024
+# Bytes of each archive to read before choosing how to extract it
+RESTORE_PEEK_SIZE = 64 * 1024
 USER_AGENT = "restbackup-tar/%s" % __version__
 
 def cli_error(reason):
@@ -132,7 +170,11 @@ def main(args):
     # Parse arguments
     try:
         short_args = "u:b:n:s:ep:"
-        long_args = ["full","incremental","list","restore","help","example"]
+        long_args = ["full","incremental","list","restore","consolidate",
+                     "help","example",
+                     "limit-rate=","trace=","engine=","scan-threads=",
+                     "volume-size=","volume-threads=","to-stdout","stream",
+                     "mac-block-size="]
         opts, args = getopt.gnu_getopt(args, short_args, long_args)
     except getopt.GetoptError, e:
         return cli_error(e)
@@ -143,6 +185,13 @@ def main(args):
     snapshot_file=None
     encrypt=False
     passphrase=None
+    engine=None
+    scan_threads=None
+    volume_size=None
+    volume_threads=DEFAULT_VOLUME_THREADS
+    to_stdout=False
+    stream=False
+    mac_block_size=None
     
     for option, value in opts:
         if option == "--full":
@@ -153,6 +202,8 @@ def main(args):
             command = "list"
         elif option == "--restore":
             command = "restore"
+        elif option == "--consolidate":
+            command = "consolidate"
         elif option == "--help":
             print DESCRIPTION
             print USAGE
@@ -172,9 +223,57 @@ def main(args):
             encrypt=True
         elif option == "-p":
             passphrase = restbackupcli.read_secret_from_file(value)
+        elif option == "--mac-block-size":
+            try:
+                mac_block_size = restbackupcli.parse_mac_block_size(value)
+            except ValueError, e:
+                return cli_error("ERROR: %s" % e)
+        elif option == "--limit-rate":
+            try:
+                restbackupcli.set_rate_limit(value)
+            except ValueError, e:
+                return cli_error("ERROR: %s" % e)
+        elif option == "--trace":
+            restbackupcli.trace_requests(value)
+        elif option == "--engine":
+            if value not in ENGINES:
+                return cli_error("ERROR: Unknown engine %r" % value)
+            engine = value
+        elif option == "--scan-threads":
+            try:
+                scan_threads = int(value)
+            except ValueError:
+                scan_threads = 0
+            if scan_threads < 1:
+                return cli_error("ERROR: Invalid number of threads %r" % value)
+        elif option == "--volume-size":
+            try:
+                volume_size = restbackup.parse_size(value)
+            except ValueError:
+                return cli_error("ERROR: Invalid volume size %r" % value)
+        elif option == "--volume-threads":
+            try:
+                volume_threads = int(value)
+            except ValueError:
+                volume_threads = 0
+            if volume_threads < 1:
+                return cli_error("ERROR: Invalid number of threads %r" % value)
+        elif option == "--to-stdout":
+            to_stdout = True
+        elif option == "--stream":
+            stream = True
         else:
             assert False, "unhandled option %r" % ((option,value),)
     
+    if to_stdout and command != "restore":
+        return cli_error("ERROR: --to-stdout works only with --restore")
+    if stream and command not in ("full", "incremental", "consolidate"):
+        return cli_error("ERROR: --stream works only with backups")
+    if stream and volume_size != None:
+        return cli_error("ERROR: --stream cannot be used with --volume-size")
+    if mac_block_size != None and not encrypt:
+        return cli_error("ERROR: --mac-block-size works only with -e")
+    
     if encrypt and passphrase == None:
         passphrase = restbackupcli.read_secret_from_file(DEFAULT_PASS_FILE)
     if not encrypt:
@@ -196,11 +295,15 @@ def main(args):
         elif command == "full":
             if not args:
                 return cli_error("ERROR: No files specified")
-            return backup(command, url, name, snapshot_file, passphrase, args)
+            return backup(command, url, name, snapshot_file, passphrase, args,
+                          engine, scan_threads, volume_size, volume_threads,
+                          stream, mac_block_size)
         elif command == "incremental":
             if not args:
                 return cli_error("ERROR: No files specified")
-            return backup(command, url, name, snapshot_file, passphrase, args)
+            return backup(command, url, name, snapshot_file, passphrase, args,
+                          engine, scan_threads, volume_size, volume_threads,
+                          stream, mac_block_size)
         elif command == "list":
             if args:
                 return cli_error("ERROR: Unexpected arguments %r" % args)
@@ -208,34 +311,57 @@ def main(args):
         elif command == "restore":
             if not args:
                 return cli_error("ERROR: No archive specified")
-            return restore(url, passphrase, args)
+            return restore(url, passphrase, args, volume_threads, to_stdout)
+        elif command == "consolidate":
+            if args:
+                return cli_error("ERROR: Unexpected arguments %r" % args)
+            return consolidate(url, name, snapshot_file, passphrase,
+                               volume_size, volume_threads, stream,
+                               mac_block_size)
         else:
             assert False, "Unimplemented command %r" % command
     except restbackup.RestBackupException, e:
-        print >>sys.stdout, "ERROR: %s" % str(e)
+        # With --to-stdout, stdout carries the contents of the files
+        out = sys.stderr if to_stdout else sys.stdout
+        print >>out, "ERROR: %s" % str(e)
         return 1
 
 def list_files(access_url):
     backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
-    for (name,size,createtime) in backup_api.list():
+    for (name,size,createtime) in backup_api.iter_list():
         date = time.strftime("%Y%m%dT%H:%M:%SZ", time.gmtime(createtime))
         print "%s\t%s\t%s" % (date, size, name)
     return 0
 
-def backup(command, url, name, snapshot_file, passphrase, files):
+def backup(command, url, name, snapshot_file, passphrase, files,
+           engine=None, scan_threads=None, volume_size=None,
+           volume_threads=DEFAULT_VOLUME_THREADS, stream=False,
+           mac_block_size=None):
+    import datetime
+    import subprocess
     backup_api = restbackup.BackupApiCaller(url, USER_AGENT)
     backup_name_file = snapshot_file + ".backupname"
     last_backup_level_file = snapshot_file + ".lastbackuplevel"
+    # The snapshot format depends on the engine that wrote it
+    engine_file = snapshot_file + ".engine"
+    if volume_size == None:
+        suffix = ".tar.gz"
+    else:
+        suffix = ".v*"
     
     if command == "full":
         timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
         backup_name = "%s-%s" % (name, timestamp)
         with open(backup_name_file, "w") as f:
             f.write(backup_name)
+        engine = engine or DEFAULT_ENGINE
+        with open(engine_file, "w") as f:
+            f.write(engine)
         
         level = 0
         
-        archive_name = backup_name + "-full.tar.gz"
+        archive_base = backup_name + "-full"
+        archive_name = archive_base + suffix
         print "Performing full backup to %r" % archive_name
         
         if os.path.exists(snapshot_file):
@@ -258,40 +384,437 @@ def backup(command, url, name, snapshot_file, passphrase, files):
             last_backup_level = int(f.read().strip())
         level = last_backup_level + 1
         
-        archive_name = "%s-inc%s.tar.gz" % (backup_name, level)
+        last_engine = DEFAULT_ENGINE
+        if os.path.exists(engine_file):
+            with open(engine_file, "r") as f:
+                last_engine = f.read().strip()
+        if engine and engine != last_engine:
+            print >>sys.stderr, \
+                "ERROR: The full backup used the %s engine." % last_engine, \
+                "Perform a full backup to change engines."
+            return 1
+        engine = last_engine
+        
+        archive_base = "%s-inc%s" % (backup_name, level)
+        archive_name = archive_base + suffix
         print "Performing incremental backup to %r" % archive_name
     else:
         assert False, "Unimplemented command %r" % command
     
-    with tempfile.TemporaryFile(prefix='restbackup-tar.') as f:
+    tar = None
+    failures = (TarFailedException,)
+    if engine == "python":
+        import restbackuptarfile
+        errors = []
+        workers = scan_threads or restbackuptarfile.DEFAULT_SCAN_WORKERS
+        new_snapshot = restbackuptarfile.scan(files, workers, errors)
+        if errors:
+            for error in errors:
+                print >>sys.stderr, "ERROR: %s" % error
+            return 1
+        old_snapshot = restbackuptarfile.load_snapshot(snapshot_file)
+        reader = restbackuptarfile.ArchiveReader(old_snapshot, new_snapshot)
+        print "Archiving %s changed and %s deleted paths" % (
+            len(reader.changed), len(reader.deleted))
+        if reader.unchanged:
+            print "Skipping %s files with unchanged contents" % (
+                len(reader.unchanged),)
+        failures += (restbackuptarfile.ArchiveFailedException,)
+    else:
         # http://www.gnu.org/software/automake/manual/tar/Incremental-Dumps.html
-        print "Writing archive to temporary file"
         args = ["tar","-czg", snapshot_file] + files
-        tar = subprocess.Popen(args, stdout=f.fileno())
-        tar.wait()
-        if tar.returncode != 0:
-            return 1
-        
-        f.seek(0, os.SEEK_END)
-        size = f.tell()
-        f.seek(0)
-        reader = restbackup.FileObjectReader(f, size)
-        
-        remote_file_name = "/" + archive_name
-        endpoint = "%s://%s/" % (backup_api.scheme, backup_api.host)
-        print "Uploading %s byte archive to %s%s" % (size,endpoint,archive_name)
-        if passphrase == None:
-            backup_api.put(name=remote_file_name, data=reader)
-        else:
-            backup_api.put_encrypted(passphrase, name=remote_file_name,
-                                     data=reader)
+        tar = subprocess.Popen(args, stdout=subprocess.PIPE)
+        reader = TarOutputReader(tar)
     
+    endpoint = "%s://%s/" % (backup_api.scheme, backup_api.host)
+    print "Uploading archive to %s%s" % (endpoint, archive_name)
+    sys.stdout.flush()
+    try:
+        volumes = upload_archive(backup_api, passphrase, "/" + archive_base,
+                                 reader, volume_size, volume_threads, stream,
+                                 mac_block_size)
+    except failures, e:
+        print >>sys.stderr, "ERROR: %s" % str(e)
+        return 1
+    finally:
+        if tar == None:
+            reader.close()
+        elif tar.poll() == None:
+            tar.kill()
+            tar.wait()
+    if volumes == None:
+        print "Uploaded %s bytes" % reader.bytes_read
+    else:
+        print "Uploaded %s bytes in %s volumes" % (reader.bytes_read, volumes)
+    
+    if engine == "python":
+        restbackuptarfile.save_snapshot(snapshot_file, reader.snapshot)
     with open(last_backup_level_file, "w") as level_file:
         level_file.write(str(level))
     print "Done."
     return 0
 
-def restore(access_url, passphrase, args):
+def consolidate(url, name, snapshot_file, passphrase, volume_size=None,
+                volume_threads=DEFAULT_VOLUME_THREADS, stream=False,
+                mac_block_size=None):
+    """Merges the archives of the last full backup and its incremental
+    backups into a synthetic full archive and uploads it as a new full
+    backup, which later incremental backups build on."""
+    import datetime
+    import restbackuptarfile
+    backup_api = restbackup.BackupApiCaller(url, USER_AGENT)
+    endpoint = "%s://%s" % (backup_api.scheme, backup_api.host)
+    backup_name_file = snapshot_file + ".backupname"
+    last_backup_level_file = snapshot_file + ".lastbackuplevel"
+    engine_file = snapshot_file + ".engine"
+    for filename in (backup_name_file, last_backup_level_file):
+        if not os.path.exists(filename):
+            print >>sys.stderr, \
+                "ERROR: Cannot find file %r." % filename, \
+                "Have you already performed a full backup?"
+            return 1
+    with open(backup_name_file, "r") as f:
+        backup_name = f.read()
+    with open(last_backup_level_file, "r") as f:
+        level = int(f.read().strip())
+    engine = DEFAULT_ENGINE
+    if os.path.exists(engine_file):
+        with open(engine_file, "r") as f:
+            engine = f.read().strip()
+    if engine != "python":
+        print >>sys.stderr, \
+            "ERROR: The full backup used the %s engine." % engine, \
+            "Only backups made by the python engine can be consolidated."
+        return 1
+    if level == 0:
+        print "Nothing to consolidate, the last backup was a full backup"
+        return 0
+    
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    new_backup_name = "%s-%s" % (name, timestamp)
+    archive_base = new_backup_name + "-full"
+    if volume_size == None:
+        archive_name = archive_base + ".tar.gz"
+    else:
+        archive_name = archive_base + ".v*"
+    print "Consolidating %r through level %s into %r" % (
+        backup_name, level, archive_name)
+    
+    def archives():
+        # Newest first, so the first version of each path wins
+        for n in xrange(level, -1, -1):
+            (remote_name, reader) = open_archive(
+                backup_api, passphrase, archive_base_name(backup_name, n),
+                volume_threads)
+            print "Retrieving %s%s" % (endpoint, remote_name)
+            sys.stdout.flush()
+            yield (remote_name, reader)
+    reader = restbackuptarfile.ConsolidatingReader(archives())
+    print "Uploading archive to %s/%s" % (endpoint, archive_name)
+    sys.stdout.flush()
+    try:
+        volumes = upload_archive(backup_api, passphrase, "/" + archive_base,
+                                 reader, volume_size, volume_threads, stream,
+                                 mac_block_size)
+    except restbackuptarfile.ArchiveFailedException, e:
+        print >>sys.stderr, "ERROR: %s" % str(e)
+        return 1
+    finally:
+        reader.close()
+    if volumes == None:
+        print "Uploaded %s bytes" % reader.bytes_read
+    else:
+        print "Uploaded %s bytes in %s volumes" % (reader.bytes_read, volumes)
+    
+    # The snapshot already describes the files in the synthetic full
+    # backup, so incremental backups continue from it
+    with open(backup_name_file, "w") as f:
+        f.write(new_backup_name)
+    with open(last_backup_level_file, "w") as f:
+        f.write("0")
+    print "Done."
+    return 0
+
+def upload_archive(backup_api, passphrase, archive_base, reader,
+                   volume_size=None, volume_threads=DEFAULT_VOLUME_THREADS,
+                   stream=False, mac_block_size=None):
+    """Uploads the archive as ARCHIVE_BASE.tar.gz, or in volumes when
+    volume_size is not None.  A single archive is spooled to a
+    temporary file before the upload, so a failed upload is retried,
+    unless stream is true.  Mac_block_size is passed to
+    put_encrypted() when passphrase is not None.  Returns the number
+    of volumes, or None when the archive was uploaded as a single
+    file."""
+    if volume_size != None:
+        return upload_volumes(backup_api, passphrase, archive_base, reader,
+                              volume_size, volume_threads, mac_block_size)
+    if not stream:
+        reader = spool_archive(reader)
+    try:
+        if passphrase == None:
+            backup_api.put(name=archive_base + ".tar.gz", data=reader)
+        else:
+            backup_api.put_encrypted(passphrase,
+                                     name=archive_base + ".tar.gz",
+                                     data=reader,
+                                     mac_block_size=mac_block_size)
+    finally:
+        if not stream:
+            reader.close()
+    return None
+
+def spool_archive(reader):
+    """Reads the archive to its end into a temporary file.  Returns a
+    rewindable FileObjectReader of the file.  Raises the exception
+    that reading raised, such as TarFailedException, before anything
+    is uploaded."""
+    import tempfile
+    spool = tempfile.TemporaryFile(prefix="restbackup-tar.")
+    size = 0
+    try:
+        while True:
+            chunk = reader.read(VOLUME_CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+            size += len(chunk)
+    except:
+        spool.close()
+        raise
+    spool.seek(0)
+    return restbackup.FileObjectReader(spool, size)
+
+class TarFailedException(IOError):
+    pass
+
+class TarOutputReader(restbackup.PipeReader):
+    """Input stream of the archive that a tar process writes to its
+    stdout.  Waits for tar to exit at the end of the stream and raises
+    TarFailedException if it failed, so a partial archive is never
+    completed on the server."""
+    __slots__ = ('tar', 'bytes_read')
+    
+    def __init__(self, tar):
+        restbackup.PipeReader.__init__(self, tar.stdout)
+        self.tar = tar
+        self.bytes_read = 0
+    
+    def read_once(self, size):
+        chunk = restbackup.PipeReader.read_once(self, size)
+        self.bytes_read += len(chunk)
+        if not chunk and self.tar.wait() != 0:
+            raise TarFailedException("tar exited with status %s"
+                                     % self.tar.returncode)
+        return chunk
+
+def volume_name(archive_base, number):
+    """Returns the name of a volume, like '/NAME-full.v0001'"""
+    return "%s.v%04d" % (archive_base, number)
+
+def upload_volumes(backup_api, passphrase, archive_base, reader, volume_size,
+                   max_uploads=DEFAULT_VOLUME_THREADS, mac_block_size=None):
+    """Cuts the archive that reader yields into volumes of volume_size
+    bytes and uploads them as ARCHIVE_BASE.v0001, ARCHIVE_BASE.v0002,
+    and so on, encrypting each one separately with mac_block_size when
+    passphrase is not None.  Uploads up to max_uploads volumes at once while the archive
+    is still being read.  Spools each volume to a temporary file, so a
+    failed upload is retried without restarting the archive.  After
+    every volume is uploaded, uploads the ARCHIVE_BASE.volumes
+    manifest, which restore() needs to find the volumes.  Returns the
+    number of volumes.  Raises the first exception from reading or
+    uploading."""
+    import json
+    import Queue
+    import tempfile
+    import threading
+    volumes = Queue.Queue(1)
+    errors = []
+    def upload():
+        while True:
+            item = volumes.get()
+            if item == None:
+                return
+            (name, spool, size) = item
+            try:
+                if errors:
+                    continue # Discard volumes so the reading thread cannot block
+                data = restbackup.FileObjectReader(spool, size)
+                if passphrase == None:
+                    backup_api.put(name=name, data=data)
+                else:
+                    backup_api.put_encrypted(passphrase, name=name, data=data,
+                                             mac_block_size=mac_block_size)
+                sys.stdout.write("Uploaded %s (%s bytes)\n" % (name, size))
+                sys.stdout.flush()
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                spool.close()
+    threads = [threading.Thread(target=upload) for n in xrange(max_uploads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    count = 0
+    try:
+        while not errors:
+            spool = tempfile.TemporaryFile(prefix="restbackup-tar-volume.")
+            size = 0
+            try:
+                while size < volume_size:
+                    chunk = reader.read(min(VOLUME_CHUNK_SIZE,
+                                            volume_size - size))
+                    if not chunk:
+                        break
+                    spool.write(chunk)
+                    size += len(chunk)
+            except:
+                spool.close()
+                raise
+            if size == 0 and count > 0:
+                spool.close()
+                break
+            count += 1
+            spool.seek(0)
+            volumes.put((volume_name(archive_base, count), spool, size))
+            if size < volume_size:
+                break
+    finally:
+        for t in threads:
+            volumes.put(None)
+        for t in threads:
+            t.join()
+    if errors:
+        (exc_type, exc_value, exc_traceback) = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    manifest = json.dumps({'version':1, 'volumes':count})
+    if passphrase == None:
+        backup_api.put(name=archive_base + ".volumes", data=manifest)
+    else:
+        backup_api.put_encrypted(passphrase, name=archive_base + ".volumes",
+                                 data=manifest)
+    return count
+
+def get_file(backup_api, passphrase, name):
+    """Retrieves the file, decrypting it when passphrase is not None"""
+    if passphrase == None:
+        return backup_api.get(name=name)
+    return backup_api.get_encrypted(passphrase, name=name)
+
+def get_file_if_exists(backup_api, passphrase, name):
+    """Retrieves the file like get_file(), or returns None if it does
+    not exist"""
+    try:
+        return get_file(backup_api, passphrase, name)
+    except restbackup.RestBackup404NotFoundException:
+        # Returning drops the traceback, which holds the connection
+        return None
+
+def open_archive(backup_api, passphrase, archive_base,
+                 max_downloads=DEFAULT_VOLUME_THREADS):
+    """Returns a tuple (name, reader) for the ARCHIVE_BASE.tar.gz
+    archive, or for its volumes if it was uploaded with
+    upload_volumes(), whose name is like ARCHIVE_BASE.v0001-v0012.
+    Raises RestBackup404NotFoundException if neither exists."""
+    import json
+    reader = get_file_if_exists(backup_api, passphrase,
+                                archive_base + ".tar.gz")
+    if reader != None:
+        return (archive_base + ".tar.gz", reader)
+    manifest = get_file(backup_api, passphrase, archive_base + ".volumes")
+    count = json.loads(manifest.read())['volumes']
+    manifest.close()
+    names = [volume_name(archive_base, n) for n in xrange(1, count + 1)]
+    name = "%s.v0001-v%04d" % (archive_base, count)
+    return (name, VolumeReader(backup_api, passphrase, names,
+                                      max_downloads))
+
+class VolumeReader(restbackup.InputStream):
+    """Input stream of an archive that upload_volumes() uploaded.
+    Threads download up to max_downloads volumes at once into
+    temporary files, decrypting them when passphrase is not None, and
+    the stream yields the volumes in order.  Raises the exception
+    from a failed download when the stream reaches that volume."""
+    __slots__ = ('results', 'next_volume', 'volume', 'slots', 'closed')
+    
+    def __init__(self, backup_api, passphrase, names,
+                 max_downloads=DEFAULT_VOLUME_THREADS):
+        import Queue
+        import tempfile
+        import threading
+        restbackup.InputStream.__init__(self)
+        self.results = [Queue.Queue(1) for name in names]
+        self.next_volume = 0
+        self.volume = None
+        # Limits the volumes that are downloading or waiting to be read
+        self.slots = threading.Semaphore(max_downloads)
+        self.closed = False
+        pending = Queue.Queue()
+        for item in enumerate(names):
+            pending.put(item)
+        def download():
+            while True:
+                self.slots.acquire()
+                try:
+                    (n, name) = pending.get_nowait()
+                except Queue.Empty:
+                    self.slots.release()
+                    return
+                if self.closed:
+                    return
+                try:
+                    reader = get_file(backup_api, passphrase, name)
+                    spool = tempfile.TemporaryFile(
+                        prefix="restbackup-tar-volume.")
+                    try:
+                        while True:
+                            chunk = reader.read(VOLUME_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            spool.write(chunk)
+                    finally:
+                        reader.close()
+                    spool.seek(0)
+                    self.results[n].put((spool, None))
+                except Exception:
+                    self.results[n].put((None, sys.exc_info()))
+        for n in xrange(min(max_downloads, len(names))):
+            t = threading.Thread(target=download)
+            t.daemon = True
+            t.start()
+    
+    def read_once(self, size):
+        while True:
+            if self.volume == None:
+                if self.next_volume == len(self.results):
+                    return ''
+                (spool, error) = self.results[self.next_volume].get()
+                self.next_volume += 1
+                if error:
+                    (exc_type, exc_value, exc_traceback) = error
+                    raise exc_type, exc_value, exc_traceback
+                self.volume = spool
+            chunk = self.volume.read(size)
+            if chunk:
+                return chunk
+            self.volume.close()
+            self.volume = None
+            self.slots.release()
+    
+    def close(self):
+        # Stops the threads after their current downloads
+        if not self.closed:
+            self.closed = True
+            if self.volume != None:
+                self.volume.close()
+                self.volume = None
+            for n in xrange(len(self.results)):
+                self.slots.release()
+
+def restore(access_url, passphrase, args,
+            volume_threads=DEFAULT_VOLUME_THREADS, to_stdout=False):
+    import subprocess
+    import threading
+    import restbackuptarfile
     backup_api = restbackup.BackupApiCaller(access_url, USER_AGENT)
     endpoint = "%s://%s" % (backup_api.scheme, backup_api.host)
     archive_name = args[0]
@@ -299,41 +822,61 @@ def restore(access_url, passphrase, args):
     
     max_level = 99
     level_specified = False
-    if re.match(r"^.*-full(\.tar\.gz)?$", archive_name):
+    if re.match(r"^.*-full(\.tar\.gz|\.v[0-9]+|\.volumes)?$", archive_name):
         max_level = 0
         level_specified = True
     else:
-        m = re.match(r"^.*-inc([0-9]+)(\.tar\.gz)?$", archive_name)
+        m = re.match(r"^.*-inc([0-9]+)(\.tar\.gz|\.v[0-9]+|\.volumes)?$",
+                     archive_name)
         if m:
             max_level = int(m.group(1))
             level_specified = True
     
-    backup_name = re.match(r"/?(.*?)(-full|-inc[0-9]+)*(\.tar\.gz)*$",
-                           archive_name).group(1)
+    backup_name = re.match(
+        r"/?(.*?)(-full|-inc[0-9]+)*(\.tar\.gz|\.v[0-9]+|\.volumes)*$",
+        archive_name).group(1)
+    if to_stdout:
+        if not level_specified:
+            max_level = find_last_level(backup_api, backup_name)
+            if max_level == None:
+                print >>sys.stderr, "ERROR: Cannot find %r" % (
+                    "/%s-full.tar.gz" % backup_name)
+                return 1
+        return restore_to_stdout(backup_api, passphrase, backup_name,
+                                 max_level, files, volume_threads)
     restore_dir = backup_name.replace("/", "#")
     print "Restoring to %r" % (restore_dir + "/")
     if not os.path.isdir(restore_dir):
         os.mkdir(restore_dir)
     
-    remote_files = ["/%s-full.tar.gz" % backup_name]
-    for n in range(1, max_level + 1):
-        remote_files.append("/%s-inc%s.tar.gz" % (backup_name, n))
+    archive_bases = [archive_base_name(backup_name, n)
+                     for n in range(0, max_level + 1)]
     
     first = True
-    for remote_file in remote_files:
-        print "Retrieving %s%s" % (endpoint, remote_file)
+    for archive_base in archive_bases:
         try:
-            if passphrase == None:
-                reader = backup_api.get(name=remote_file)
-            else:
-                reader = backup_api.get_encrypted(passphrase, name=remote_file)
+            (remote_name, reader) = open_archive(backup_api, passphrase,
+                                                 archive_base, volume_threads)
             first = False
         except restbackup.RestBackup404NotFoundException, e:
+            print "Retrieving %s%s.tar.gz" % (endpoint, archive_base)
             if not level_specified and not first:
                 print "Not found"
                 break
             else:
                 raise
+        print "Retrieving %s%s" % (endpoint, remote_name)
+        
+        reader = restbackuptarfile.PeekedReader(
+            reader.read(RESTORE_PEEK_SIZE), reader)
+        if restbackuptarfile.is_archive(reader.head):
+            # Made by the python engine
+            start = time.time()
+            restbackuptarfile.restore(reader, restore_dir, files)
+            reader.close()
+            print "Retrieved %s" % restbackup.format_throughput(
+                reader.bytes_read, time.time() - start)
+            continue
         
         sys.stdout.flush()
         sys.stderr.flush()
@@ -347,16 +890,16 @@ def restore(access_url, passphrase, args):
         stderr_reader.daemon = True
         stderr_reader.start()
         
-        while True:
-            chunk = reader.read(65536)
-            if not chunk:
-                break
-            tar.stdin.write(chunk)
+        (bytes_copied, seconds) = restbackup.copy_stream(reader, tar.stdin)
+        reader.close()
         
         tar.stdin.flush()
         tar.stdin.close()
         tar.wait()
         stderr_reader.join()
+        sys.stdout.flush()
+        print "Retrieved %s" % restbackup.format_throughput(bytes_copied,
+                                                            seconds)
         if tar.returncode != 0:
             if files and not flag['value']:
                 # When restoring specific files from a set of
@@ -370,6 +913,62 @@ def restore(access_url, passphrase, args):
     print "Done."
     return 0
 
+def restore_to_stdout(backup_api, passphrase, backup_name, max_level, files,
+                      volume_threads=DEFAULT_VOLUME_THREADS):
+    """Writes the contents of the files, as they were after the backup
+    at max_level, to stdout.  Reads the archives in process, from the
+    newest to the oldest, and stops once every file is found.  Writes
+    messages to stderr, including the errors of downloading,
+    decrypting, and reading the archives."""
+    import tarfile
+    import restbackuptarfile
+    endpoint = "%s://%s" % (backup_api.scheme, backup_api.host)
+    def archives():
+        for n in xrange(max_level, -1, -1):
+            (remote_name, reader) = open_archive(
+                backup_api, passphrase, archive_base_name(backup_name, n),
+                volume_threads)
+            print >>sys.stderr, "Retrieving %s%s" % (endpoint, remote_name)
+            yield (remote_name, reader)
+    try:
+        missing = restbackuptarfile.extract_to_stream(archives(), sys.stdout,
+                                                      files)
+    except (IOError, tarfile.TarError), e:
+        sys.stdout.flush()
+        print >>sys.stderr, "ERROR: %s" % str(e)
+        return 1
+    sys.stdout.flush()
+    for name in missing:
+        print >>sys.stderr, "ERROR: %r not found in backup" % name
+    if missing:
+        return 1
+    return 0
+
+def archive_base_name(backup_name, level):
+    """Returns the name of the archive at level without its extension,
+    like '/NAME-full' or '/NAME-inc3'"""
+    if level == 0:
+        return "/%s-full" % backup_name
+    return "/%s-inc%s" % (backup_name, level)
+
+def find_last_level(backup_api, backup_name):
+    """Returns the level of the last archive in the unbroken chain of
+    the backup, from the list of files on the account, or None if it
+    has no full archive."""
+    pattern = re.compile(r"^/?%s-(full|inc([0-9]+))(\.tar\.gz|\.volumes)$"
+                         % re.escape(backup_name))
+    levels = set()
+    for (name, size, createtime) in backup_api.iter_list():
+        match_obj = pattern.match(name)
+        if match_obj:
+            levels.add(int(match_obj.group(2) or 0))
+    if 0 not in levels:
+        return None
+    level = 0
+    while level + 1 in levels:
+        level += 1
+    return level
+
 def stderr_filter(stderr, flag):
     """Reads stderr pipe and sets flag if tar or its child emits an unexpected
     error message"""
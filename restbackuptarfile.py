@@ -0,0 +1,942 @@
+#!/usr/bin/env python
+"""
+RestBackup(tm) Tar Engine Library
+
+Makes and restores the incremental archives of restbackup-tar's python
+engine in process, with the tarfile module, instead of running GNU
+tar.  Directories are listed and their contents stat'ed by a pool of
+threads, with the scandir module when it is installed.  Files that were
+touched or copied but kept their content are found by hashing them on
+a pool of threads and left out of the archive.  The archive is
+written by a thread into a pipe that the upload reads from, so members
+stream straight into the encrypt and upload pipeline.
+
+Snapshots map each path to a [KIND, INODE, MTIME, SIZE, SHA256, CTIME,
+MODE, UID, GID] entry, where KIND is 'f' for files, 'd' for
+directories, 'l' for symbolic links and 'o' for other files, and
+SHA256 is the hex digest of the archived content of files, or None.
+CTIME, MODE, UID and GID are None in entries read from snapshot files
+older than version 3.
+
+Snapshot file format, version 3:
+  8-byte magic 'RBTSNP03'
+  8-byte number of records, as a big-endian unsigned integer
+  zlib-compressed records sorted by path, each one:
+    struct '!HHcBQdQ': bytes shared with the previous path, length of
+                       the rest of the path, KIND, flags, INODE, MTIME,
+                       and SIZE
+    the rest of the path
+    struct '!dIII': CTIME, MODE, UID, and GID, if bit 1 of flags is set
+    32-byte SHA-256 digest, if bit 0 of flags is set
+
+Version 2 snapshot files have the magic 'RBTSNP02' and no CTIME, MODE,
+UID, or GID.  Version 1 snapshot files hold a JSON object
+{"version":1, "entries":{PATH:ENTRY, ...}}.  Both are read but no
+longer written.
+
+Archive format:
+  A gzip-compressed tar archive.  The first member is
+  .restbackup-tar-deletions, a JSON list of the paths deleted since
+  the previous backup.  Paths are byte strings, which are stored as
+  JSON strings of the characters with the same ordinals, so that any
+  file name survives.  The other
+  members are the directories, files, and links that are new or
+  changed since the previous backup.
+
+Archives can be extracted with standard tar, eg. 'tar -xzf ARCHIVE'.
+Standard tar does not apply the deletions, which restore() does.
+write_consolidated() merges a chain of archives into a synthetic full
+archive, without reading the files that were backed up.
+
+Example usage:
+
+import restbackup
+import restbackuptarfile
+backup_api = restbackup.BackupApiCaller(access_url, user_agent="Demo/1.0")
+
+# Backup the changes in a directory since the last backup
+old_snapshot = restbackuptarfile.load_snapshot('data.snapshot')
+new_snapshot = restbackuptarfile.scan(['data'])
+reader = restbackuptarfile.ArchiveReader(old_snapshot, new_snapshot)
+backup_api.put('/data-inc1.tar.gz', reader)
+restbackuptarfile.save_snapshot('data.snapshot', reader.snapshot)
+
+# Restore the archive
+reader = backup_api.get('/data-inc1.tar.gz')
+restbackuptarfile.restore(reader, 'restored')
+
+# Merge the chain into a synthetic full archive
+archives = [(name, backup_api.get(name))
+            for name in ['/data-inc1.tar.gz', '/data-full.tar.gz']]
+reader = restbackuptarfile.ConsolidatingReader(archives)
+backup_api.put('/data2-full.tar.gz', reader)
+"""
+
+__author__ = 'Michael Leonhard'
+__license__ = 'Copyright (C) 2011 Rest Backup LLC.  Use of this software is subject to the RestBackup.com Terms of Use, http://www.restbackup.com/terms'
+__version__ = '1.0'
+
+import copy
+import errno
+import gzip
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import stat
+import struct
+import sys
+import tarfile
+import tempfile
+import thread
+import threading
+import zlib
+
+import restbackup
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+SNAPSHOT_MAGIC = 'RBTSNP03'
+SNAPSHOT_V2_MAGIC = 'RBTSNP02'
+SNAPSHOT_COUNT = struct.Struct('!Q')
+SNAPSHOT_RECORD = struct.Struct('!HHcBQdQ')
+SNAPSHOT_METADATA = struct.Struct('!dIII')
+SNAPSHOT_HAS_SHA256 = 1
+SNAPSHOT_HAS_METADATA = 2
+SNAPSHOT_CHUNK_SIZE = 256 * 1024
+DELETIONS_MEMBER = '.restbackup-tar-deletions'
+DEFAULT_SCAN_WORKERS = 8
+# Directory entries that one worker stats at a time.  Large directories
+# are split into batches so that several workers stat them at once.
+SCAN_BATCH_SIZE = 256
+# Bytes hashed at a time.  hashlib releases the GIL while it hashes
+# large chunks, so files are hashed on all cores at once.
+HASH_CHUNK_SIZE = 1024 * 1024
+# Bytes read from the start of an archive for is_archive()
+ARCHIVE_HEAD_SIZE = 64 * 1024
+# GNU tar's gzip default.  tarfile's own 'w|gz' mode always uses level 9,
+# which is several times slower and saves little.
+COMPRESS_LEVEL = 6
+
+# Member type of the directory listings in GNU tar's incremental archives
+GNUTYPE_DUMPDIR = 'D'
+
+# Fields of snapshot entries
+KIND = 0
+INODE = 1
+MTIME = 2
+SIZE = 3
+SHA256 = 4
+CTIME = 5
+MODE = 6
+UID = 7
+GID = 8
+NO_METADATA = [None, None, None, None]
+
+class ArchiveFailedException(IOError): pass
+
+
+def encode_path(path):
+    """Returns the JSON string for a byte string path"""
+    return path.decode('latin-1')
+
+def decode_path(string):
+    return string.encode('latin-1')
+
+
+def load_snapshot(filename):
+    """Returns the entries of the snapshot file, a dict of path to
+    [kind, inode, mtime, size, sha256, ctime, mode, uid, gid] lists.
+    Returns an empty dict if the file does not exist.  Raises
+    ValueError if the file is damaged."""
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) not in (SNAPSHOT_MAGIC,
+                                               SNAPSHOT_V2_MAGIC):
+            f.seek(0)
+            return load_json_snapshot(f, filename)
+        count_data = f.read(SNAPSHOT_COUNT.size)
+        if len(count_data) != SNAPSHOT_COUNT.size:
+            raise ValueError("Snapshot file %r is truncated" % filename)
+        (count,) = SNAPSHOT_COUNT.unpack(count_data)
+        snapshot = {}
+        decompressor = zlib.decompressobj()
+        buffer = ''
+        offset = 0
+        path = ''
+        record_size = SNAPSHOT_RECORD.size
+        while True:
+            compressed = f.read(SNAPSHOT_CHUNK_SIZE)
+            try:
+                if compressed:
+                    data = decompressor.decompress(compressed)
+                else:
+                    data = decompressor.flush()
+            except zlib.error, e:
+                raise ValueError("Snapshot file %r is damaged: %s"
+                                 % (filename, e))
+            buffer = buffer[offset:] + data
+            offset = 0
+            while len(buffer) - offset >= record_size:
+                (shared, suffix_length, kind, flags, inode, mtime,
+                 size) = SNAPSHOT_RECORD.unpack_from(buffer, offset)
+                end = offset + record_size + suffix_length
+                if flags & SNAPSHOT_HAS_METADATA:
+                    end += SNAPSHOT_METADATA.size
+                if flags & SNAPSHOT_HAS_SHA256:
+                    end += 32
+                if end > len(buffer):
+                    break
+                start = offset + record_size
+                path = path[:shared] + buffer[start:start + suffix_length]
+                metadata = NO_METADATA
+                if flags & SNAPSHOT_HAS_METADATA:
+                    metadata = list(SNAPSHOT_METADATA.unpack_from(
+                        buffer, start + suffix_length))
+                sha256 = None
+                if flags & SNAPSHOT_HAS_SHA256:
+                    sha256 = buffer[end - 32:end].encode('hex')
+                snapshot[path] = [kind, inode, mtime, size, sha256] + metadata
+                offset = end
+            if not compressed:
+                break
+        if offset != len(buffer) or len(snapshot) != count:
+            raise ValueError("Snapshot file %r is truncated" % filename)
+    return snapshot
+
+def load_json_snapshot(f, filename):
+    try:
+        data = json.load(f)
+    except ValueError:
+        raise ValueError("Snapshot file %r is damaged" % filename)
+    if data.get('version') != 1:
+        raise ValueError("Unsupported snapshot version %r in %r"
+                         % (data.get('version'), filename))
+    snapshot = {}
+    for (path, (kind, inode, mtime, size, sha256)) in \
+            data['entries'].iteritems():
+        snapshot[decode_path(path)] = [str(kind), inode, mtime, size,
+                                       sha256 and str(sha256)] + NO_METADATA
+    return snapshot
+
+def save_snapshot(filename, snapshot):
+    """Writes the snapshot to a temporary file and renames it, so the
+    old snapshot survives a crash."""
+    temp_filename = filename + '.tmp'
+    compressor = zlib.compressobj(6)
+    with open(temp_filename, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(SNAPSHOT_COUNT.pack(len(snapshot)))
+        records = []
+        records_size = 0
+        previous = ''
+        for path in sorted(snapshot):
+            (kind, inode, mtime, size, sha256) = snapshot[path][:CTIME]
+            metadata = snapshot[path][CTIME:]
+            shared = 0
+            limit = min(len(previous), len(path), 0xffff)
+            while shared < limit and previous[shared] == path[shared]:
+                shared += 1
+            flags = SNAPSHOT_HAS_SHA256 if sha256 else 0
+            if metadata[0] != None:
+                flags |= SNAPSHOT_HAS_METADATA
+            records.append(SNAPSHOT_RECORD.pack(
+                shared, len(path) - shared, kind, flags, inode, mtime, size))
+            records.append(path[shared:])
+            if metadata[0] != None:
+                records.append(SNAPSHOT_METADATA.pack(*metadata))
+            if sha256:
+                records.append(sha256.decode('hex'))
+            records_size += SNAPSHOT_RECORD.size + len(path) - shared
+            previous = path
+            if records_size >= SNAPSHOT_CHUNK_SIZE:
+                f.write(compressor.compress(''.join(records)))
+                records = []
+                records_size = 0
+        f.write(compressor.compress(''.join(records)))
+        f.write(compressor.flush())
+    os.rename(temp_filename, filename)
+
+
+def stat_entry(st):
+    """Returns the snapshot entry of an os.lstat() result"""
+    if stat.S_ISREG(st.st_mode):
+        kind = 'f'
+    elif stat.S_ISDIR(st.st_mode):
+        kind = 'd'
+    elif stat.S_ISLNK(st.st_mode):
+        kind = 'l'
+    else:
+        kind = 'o'
+    size = st.st_size if kind == 'f' else 0
+    return [kind, st.st_ino, st.st_mtime, size, None, st.st_ctime,
+            st.st_mode, st.st_uid, st.st_gid]
+
+def same_stat(old_entry, entry):
+    """Returns True if the entries have the same kind, inode, mtime,
+    size, ctime, mode, and owner.  Entries without a ctime, from
+    snapshot files older than version 3, never match."""
+    return (old_entry[:SHA256] == entry[:SHA256]
+            and old_entry[CTIME:] == entry[CTIME:]
+            and old_entry[CTIME] != None)
+
+def scan(paths, workers=DEFAULT_SCAN_WORKERS, errors=None):
+    """Returns a snapshot of the paths and everything under them.
+    Lists directories and stats their contents on a pool of worker
+    threads, since each stat of a file on a network filesystem waits
+    for the server.  Splits large directories into batches of
+    SCAN_BATCH_SIZE entries, so that several workers stat them at
+    once.  Skips paths that disappear during the scan and sockets,
+    which tar cannot archive.  Appends a message to the errors list
+    for each path that cannot be stat'ed or listed."""
+    import Queue
+    if errors == None:
+        errors = []
+    snapshot = {}
+    lock = thread.allocate_lock()
+    # Holds directory paths to list and lists of (path, DirEntry or
+    # None) tuples to stat
+    tasks = Queue.Queue()
+    def add(path, dir_entry=None):
+        try:
+            if dir_entry == None:
+                st = os.lstat(path)
+            else:
+                st = dir_entry.stat(follow_symlinks=False)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                errors.append("Cannot stat %r: %s" % (path, e.strerror))
+            return
+        if stat.S_ISSOCK(st.st_mode):
+            return
+        entry = stat_entry(st)
+        with lock:
+            snapshot[path] = entry
+        if entry[KIND] == 'd':
+            tasks.put(path)
+    def list_directory(path):
+        try:
+            if scandir:
+                children = [(dir_entry.path, dir_entry)
+                            for dir_entry in scandir(path)]
+            else:
+                children = [(os.path.join(path, name), None)
+                            for name in os.listdir(path)]
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                errors.append("Cannot list %r: %s" % (path, e.strerror))
+            return
+        for start in xrange(0, len(children), SCAN_BATCH_SIZE):
+            tasks.put(children[start:start + SCAN_BATCH_SIZE])
+    def work():
+        while True:
+            task = tasks.get()
+            if task == None:
+                return
+            try:
+                if isinstance(task, str):
+                    list_directory(task)
+                else:
+                    for (path, dir_entry) in task:
+                        add(path, dir_entry)
+            except Exception, e:
+                errors.append("Cannot scan: %s" % e)
+            finally:
+                tasks.task_done()
+    threads = [threading.Thread(target=work) for n in xrange(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for path in paths:
+            path = os.path.normpath(path)
+            if not os.path.lexists(path):
+                errors.append("Cannot stat %r: No such file or directory"
+                              % path)
+                continue
+            add(path)
+        tasks.join()
+    finally:
+        for t in threads:
+            tasks.put(None)
+    return snapshot
+
+def compare(old_snapshot, new_snapshot):
+    """Returns a tuple (changed, deleted) of sorted lists of paths.
+    Changed paths are new or have a different kind, inode, mtime,
+    size, ctime, mode, or owner.  So changes of only the permissions or
+    owner, and rewrites that kept the size and mtime, are found by the
+    ctime.  Deleted paths are in the old snapshot and not the new
+    one."""
+    changed = []
+    for (path, entry) in new_snapshot.iteritems():
+        old_entry = old_snapshot.get(path)
+        if old_entry == None or not same_stat(old_entry, entry):
+            changed.append(path)
+    deleted = [path for path in old_snapshot if path not in new_snapshot]
+    changed.sort()
+    deleted.sort()
+    return (changed, deleted)
+
+def hash_file(path, size):
+    """Returns the hex SHA-256 digest of a file, or None if the file
+    is not size bytes long."""
+    sha256 = hashlib.sha256()
+    length = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+            length += len(chunk)
+    if length != size:
+        return None
+    return sha256.hexdigest()
+
+def find_unchanged(old_snapshot, new_snapshot, changed, workers=None):
+    """Returns a sorted list of the changed files whose content is the
+    same as in the old snapshot, such as files that were touched or
+    copied over with identical data.  Hashes only the files that have
+    the same size, mode, and owner and a hash in the old snapshot, on
+    a pool of workers threads, one per CPU by default.  Stores the
+    hashes in the entries of the new snapshot.  Files that cannot be
+    read are left changed, so that archiving reports them."""
+    import Queue
+    candidates = Queue.Queue()
+    for path in changed:
+        entry = new_snapshot[path]
+        old_entry = old_snapshot.get(path)
+        if (entry[KIND] == 'f' and old_entry != None
+            and old_entry[KIND] == 'f' and old_entry[SHA256] != None
+            and old_entry[SIZE] == entry[SIZE]
+            # Entries from before version 3 snapshots have no mode
+            and old_entry[MODE:] in (entry[MODE:], NO_METADATA[1:])):
+            candidates.put(path)
+    if candidates.empty():
+        return []
+    if workers == None:
+        import multiprocessing
+        workers = multiprocessing.cpu_count()
+    unchanged = []
+    def work():
+        while True:
+            try:
+                path = candidates.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                sha256 = hash_file(path, new_snapshot[path][SIZE])
+            except (OSError, IOError):
+                continue
+            if sha256 != None:
+                new_snapshot[path][SHA256] = sha256
+                if sha256 == old_snapshot[path][SHA256]:
+                    unchanged.append(path)
+    threads = [threading.Thread(target=work)
+               for n in xrange(min(workers, candidates.qsize()))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    unchanged.sort()
+    return unchanged
+
+def archive_name(path):
+    """Returns the member name of a path, without a leading '/' or
+    anything up to its last '..' component, like GNU tar.  So backups
+    of paths like '../data' restore into the restore directory."""
+    parts = path.split('/')
+    if '..' in parts:
+        parts = parts[len(parts) - parts[::-1].index('..'):]
+    return '/'.join(parts).lstrip('/') or '.'
+
+
+class HashingFile(object):
+    """Reads exactly size bytes of a file and computes their SHA-256
+    digest.  Pads with zeros if the file shrank after it was stat'ed,
+    like GNU tar, since the tar header already holds the size."""
+    def __init__(self, f, size):
+        self.file = f
+        self.remaining = size
+        self.sha256 = hashlib.sha256()
+        self.shrank = False
+    
+    def read(self, size):
+        size = min(size, self.remaining)
+        chunk = self.file.read(size)
+        if len(chunk) < size:
+            self.shrank = True
+            chunk += '\0' * (size - len(chunk))
+        self.remaining -= len(chunk)
+        self.sha256.update(chunk)
+        return chunk
+
+
+def write_archive(outfile, changed, deleted, snapshot, errors):
+    """Writes a gzip-compressed tar archive of the changed paths to
+    outfile, a file object, with the deletions member first.  Stores
+    the SHA-256 digest of each archived file in its snapshot entry.
+    Appends a message to the errors list for each path that cannot
+    be archived."""
+    gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=outfile,
+                              compresslevel=COMPRESS_LEVEL)
+    try:
+        tar = tarfile.open(fileobj=gzip_file, mode='w')
+        data = json.dumps([encode_path(path) for path in deleted])
+        info = tarfile.TarInfo(DELETIONS_MEMBER)
+        info.size = len(data)
+        tar.addfile(info, restbackup.StringReader(data))
+        for path in changed:
+            try:
+                info = tar.gettarinfo(path, archive_name(path))
+            except (OSError, IOError), e:
+                errors.append("Cannot stat %r: %s" % (path, e.strerror))
+                continue
+            if info == None:
+                continue # socket
+            if not info.isreg():
+                tar.addfile(info)
+                continue
+            try:
+                f = open(path, 'rb')
+            except IOError, e:
+                errors.append("Cannot open %r: %s" % (path, e.strerror))
+                continue
+            with f:
+                hashing_file = HashingFile(f, info.size)
+                tar.addfile(info, hashing_file)
+            if hashing_file.shrank:
+                errors.append("File %r shrank as we read it" % path)
+            snapshot[path][SHA256] = hashing_file.sha256.hexdigest()
+        tar.close()
+        gzip_file.close()
+    except:
+        # Do not let the garbage collector finish a partial archive
+        gzip_file.fileobj = None
+        raise
+
+
+class ThreadedArchiveReader(restbackup.PipeReader):
+    """Input stream of an archive that a thread writes into a pipe by
+    calling write(outfile, errors).  At the end of the stream, raises
+    ArchiveFailedException if the write function added any messages
+    to the errors list or raised an exception, so a partial archive is
+    never completed on the server."""
+    __slots__ = ('errors', 'thread', 'bytes_read')
+    
+    def __init__(self, write):
+        (read_fd, write_fd) = os.pipe()
+        restbackup.PipeReader.__init__(self, os.fdopen(read_fd, 'rb'))
+        self.errors = []
+        self.bytes_read = 0
+        outfile = os.fdopen(write_fd, 'wb')
+        def run():
+            try:
+                write(outfile, self.errors)
+            except Exception, e:
+                self.errors.append("Cannot write archive: %s" % e)
+            finally:
+                try:
+                    outfile.close()
+                except IOError:
+                    pass # The reader closed the pipe
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def read_once(self, size):
+        chunk = restbackup.PipeReader.read_once(self, size)
+        self.bytes_read += len(chunk)
+        if not chunk:
+            self.thread.join()
+            if self.errors:
+                raise ArchiveFailedException("; ".join(self.errors))
+        return chunk
+    
+    def close(self):
+        # The writing thread gets EPIPE and exits
+        if self.file:
+            restbackup.PipeReader.close(self)
+
+
+class ArchiveReader(ThreadedArchiveReader):
+    """Input stream of the archive of the changes between two
+    snapshots, which a thread writes into a pipe.  At the end of the
+    stream, raises ArchiveFailedException if any path could not be
+    archived.
+    
+    Before archiving, hashes the changed files that may have kept
+    their content, on hash_workers threads, and leaves out the ones
+    that did.  Their paths are in the unchanged attribute.
+    
+    The snapshot attribute holds the new snapshot with the content
+    hashes of archived and unchanged files.  Save it after a
+    successful upload."""
+    __slots__ = ('snapshot', 'changed', 'deleted', 'unchanged')
+    
+    def __init__(self, old_snapshot, new_snapshot, hash_workers=None):
+        (self.changed, self.deleted) = compare(old_snapshot, new_snapshot)
+        self.snapshot = new_snapshot
+        for (path, entry) in new_snapshot.iteritems():
+            old_entry = old_snapshot.get(path)
+            if old_entry != None and same_stat(old_entry, entry):
+                entry[SHA256] = old_entry[SHA256]
+        self.unchanged = find_unchanged(old_snapshot, new_snapshot,
+                                        self.changed, hash_workers)
+        if self.unchanged:
+            unchanged = set(self.unchanged)
+            self.changed = [path for path in self.changed
+                            if path not in unchanged]
+        changed = self.changed
+        deleted = self.deleted
+        def write(outfile, errors):
+            write_archive(outfile, changed, deleted, new_snapshot, errors)
+        ThreadedArchiveReader.__init__(self, write)
+
+
+class PeekedReader(restbackup.InputStream):
+    """Yields the head that was already read from the stream, followed
+    by the rest of the stream, and counts the bytes read."""
+    __slots__ = ('head', 'stream', 'bytes_read')
+    
+    def __init__(self, head, stream):
+        restbackup.InputStream.__init__(self)
+        self.head = head
+        self.stream = stream
+        self.bytes_read = 0
+    
+    def read_once(self, size):
+        head = self.head
+        if head:
+            chunk = head[:size]
+            self.head = head[size:]
+        else:
+            chunk = self.stream.read(size)
+        self.bytes_read += len(chunk)
+        return chunk
+    
+    def close(self):
+        self.stream.close()
+
+
+def is_archive(head):
+    """Returns True if head, the first bytes of a gzip-compressed tar
+    archive, is the start of an archive made by this module."""
+    try:
+        block = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, 512)
+    except zlib.error:
+        return False
+    return block[:100].rstrip('\0') == DELETIONS_MEMBER
+
+def is_safe_name(name):
+    """Returns False for member names that would extract outside of
+    the restore directory."""
+    return not (os.path.isabs(name) or '..' in name.split('/'))
+
+def is_selected(name, files):
+    """Returns True if files is empty or name is one of the files or
+    under one of them."""
+    if not files:
+        return True
+    for f in files:
+        f = archive_name(os.path.normpath(f))
+        if name == f or name.startswith(f + '/') or f == '.':
+            return True
+    return False
+
+def restore(reader, restore_dir, files=(), out=None):
+    """Applies an archive made by ArchiveReader to restore_dir.
+    Deletes the paths that the archive lists as deleted and extracts
+    the other members, printing their names to out like 'tar -v'.
+    When files is not empty, restores only the files and the
+    contents of the directories that it names.  Reader is an object
+    with a read(size) method, such as an InputStream."""
+    out = out or sys.stdout
+    tar = tarfile.open(fileobj=reader, mode='r|gz')
+    directories = []
+    try:
+        for info in tar:
+            if info.name == DELETIONS_MEMBER:
+                deleted = [decode_path(path) for path in
+                           json.loads(tar.extractfile(info).read())]
+                delete_paths(restore_dir, [path for path in deleted
+                                           if is_selected(archive_name(path),
+                                                          files)], out)
+                continue
+            if not is_safe_name(info.name):
+                print >>out, "Skipping unsafe member %r" % info.name
+                continue
+            if not is_selected(info.name, files):
+                continue
+            if info.isdir():
+                print >>out, info.name + '/'
+                # Set permissions and times after extracting contents,
+                # like TarFile.extractall()
+                directories.append(info)
+                info = copy.copy(info)
+                info.mode = 0700
+            else:
+                print >>out, info.name
+            clear_target(restore_dir, info)
+            tar.extract(info, restore_dir)
+    finally:
+        tar.close()
+    directories.sort(key=lambda info: info.name, reverse=True)
+    for info in directories:
+        path = os.path.join(restore_dir, info.name)
+        tar.chown(info, path)
+        tar.utime(info, path)
+        tar.chmod(info, path)
+
+def clear_target(restore_dir, info):
+    """Removes what is in the way of extracting the member, like GNU
+    tar: symlinks and files where its parent directories go, and the
+    existing entry at its path unless both are directories.  So
+    extracting never writes through a symlink, possibly to a file
+    outside restore_dir, or into a file that has other hard links."""
+    path = restore_dir
+    for part in info.name.split('/')[:-1]:
+        path = os.path.join(path, part)
+        if os.path.islink(path) or \
+                (os.path.lexists(path) and not os.path.isdir(path)):
+            os.unlink(path)
+    target = os.path.join(restore_dir, info.name)
+    if not os.path.lexists(target):
+        return
+    is_directory = os.path.isdir(target) and not os.path.islink(target)
+    if info.isdir():
+        if not is_directory:
+            os.unlink(target)
+    elif is_directory:
+        shutil.rmtree(target)
+    else:
+        os.unlink(target)
+
+def delete_paths(restore_dir, deleted, out):
+    for path in sorted(deleted, reverse=True):
+        name = archive_name(path)
+        if not is_safe_name(name):
+            continue
+        target = os.path.join(restore_dir, name)
+        if os.path.isdir(target) and not os.path.islink(target):
+            print >>out, "Deleting %r" % name
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            print >>out, "Deleting %r" % name
+            os.unlink(target)
+
+
+def write_consolidated(outfile, archives):
+    """Writes to outfile a full archive of the files that restoring a
+    chain of archives made by ArchiveReader would produce.  Archives
+    is an iterable of (name, reader) tuples for the archives of the
+    chain from the newest to the oldest.  Copies the newest version
+    of each member and leaves out members that a newer archive lists
+    as deleted.  Reads each archive once, in a single pass, and keeps
+    only the sets of copied and deleted names in memory.
+    
+    A hard link member refers to a file earlier in its own archive.
+    When that file is left out, the first link to it is written as a
+    regular file with its data, and later links refer to that link.
+    So the data of the files that an archive leaves out is kept in a
+    temporary file until the end of the archive.  Raises
+    ArchiveFailedException if an archive was not made by
+    ArchiveReader."""
+    gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=outfile,
+                              compresslevel=COMPRESS_LEVEL)
+    spool = tempfile.TemporaryFile(prefix='restbackup-tar.')
+    try:
+        tar = tarfile.open(fileobj=gzip_file, mode='w')
+        info = tarfile.TarInfo(DELETIONS_MEMBER)
+        info.size = 2
+        tar.addfile(info, restbackup.StringReader('[]'))
+        copied = set()
+        deleted = set()
+        for (name, reader) in archives:
+            try:
+                head = reader.read(ARCHIVE_HEAD_SIZE)
+                if not is_archive(head):
+                    raise ArchiveFailedException(
+                        "%s was not made by the python engine" % name)
+                source = tarfile.open(fileobj=PeekedReader(head, reader),
+                                      mode='r|gz')
+                newly_deleted = []
+                # Offsets and sizes in spool of the files left out of
+                # this archive, and the links that replace them
+                spooled = {}
+                relinked = {}
+                spool.seek(0)
+                spool.truncate()
+                for info in source:
+                    if info.name == DELETIONS_MEMBER:
+                        newly_deleted = json.loads(
+                            source.extractfile(info).read())
+                        continue
+                    if info.name in copied or info.name in deleted:
+                        if info.isreg():
+                            spooled[info.name] = (spool.tell(), info.size)
+                            shutil.copyfileobj(source.extractfile(info), spool)
+                        continue
+                    copied.add(info.name)
+                    if info.islnk() and info.linkname in relinked:
+                        info = copy.copy(info)
+                        info.linkname = relinked[info.linkname]
+                        tar.addfile(info)
+                    elif info.islnk() and info.linkname in spooled:
+                        relinked[info.linkname] = info.name
+                        (offset, size) = spooled[info.linkname]
+                        info = copy.copy(info)
+                        info.type = tarfile.REGTYPE
+                        info.linkname = ''
+                        info.size = size
+                        spool.seek(offset)
+                        tar.addfile(info, spool)
+                        spool.seek(0, os.SEEK_END)
+                    elif info.isreg():
+                        tar.addfile(info, source.extractfile(info))
+                    else:
+                        tar.addfile(info)
+                source.close()
+                # Deletions apply to the older archives of the chain
+                deleted.update(archive_name(decode_path(path))
+                               for path in newly_deleted)
+            finally:
+                reader.close()
+        tar.close()
+        gzip_file.close()
+    except:
+        gzip_file.fileobj = None
+        raise
+    finally:
+        spool.close()
+
+
+class ConsolidatingReader(ThreadedArchiveReader):
+    """Input stream of the synthetic full archive that
+    write_consolidated() makes from a chain of archives, which a
+    thread writes into a pipe.  At the end of the stream, raises
+    ArchiveFailedException if an archive of the chain could not be
+    read."""
+    __slots__ = ()
+    
+    def __init__(self, archives):
+        def write(outfile, errors):
+            write_consolidated(outfile, archives)
+        ThreadedArchiveReader.__init__(self, write)
+
+
+class GnuTarInfo(tarfile.TarInfo):
+    """TarInfo that reads the names in GNU tar's incremental archives.
+    Their headers hold the atime and ctime in the field that ustar
+    uses for the name prefix, which TarInfo would prepend to the
+    name.  GNU format headers never have a prefix."""
+    
+    @classmethod
+    def frombuf(cls, buf):
+        info = super(GnuTarInfo, cls).frombuf(buf)
+        if buf[257:265] == tarfile.GNU_MAGIC:
+            name = tarfile.nts(buf[0:100])
+            if info.isdir():
+                name = name.rstrip('/')
+            info.name = name
+        return info
+
+
+def parse_dumpdir(data):
+    """Returns the set of names in a directory listing of GNU tar's
+    incremental archives, which is a list of NUL-terminated names,
+    each prefixed with a flag character."""
+    return set(entry[1:] for entry in data.split('\0') if entry)
+
+def is_deleted(name, listings):
+    """Returns True if name or one of its parent directories is
+    missing from the listing of its parent directory in listings, a
+    dict of directory names to sets of names."""
+    while '/' in name:
+        (parent, base) = name.rsplit('/', 1)
+        listing = listings.get(parent)
+        if listing != None and base not in listing:
+            return True
+        name = parent
+    return False
+
+def extract_to_stream(archives, outfile, files=()):
+    """Writes the contents of the selected regular files, as they were
+    after the newest archive of a chain, to outfile, like 'tar -xO'.
+    When files is empty, writes every file.  Archives is an iterable
+    of (name, reader) tuples for the archives of the chain from the
+    newest to the oldest, made by ArchiveReader or by GNU tar
+    --listed-incremental, and compressed or not.
+    
+    Parses each archive in process with tarfile in stream mode and
+    skips the members that are not selected by reading past them,
+    without buffering them.  Takes each file from the newest archive
+    that has it and leaves out files that a newer archive lists as
+    deleted.  When every name in files is a file that was written or
+    found to be deleted, stops without reading the rest of the chain.
+    Returns the sorted list of the names in files that matched nothing
+    that exists after the newest archive."""
+    names = set(archive_name(os.path.normpath(f)) for f in files)
+    found = set()
+    resolved = set()
+    written = set()
+    deleted = set()
+    listings = {}
+    for (archive, reader) in archives:
+        try:
+            tar = tarfile.open(fileobj=reader, mode='r|*',
+                               tarinfo=GnuTarInfo)
+            newly_deleted = []
+            for info in tar:
+                if info.name == DELETIONS_MEMBER:
+                    newly_deleted = json.loads(tar.extractfile(info).read())
+                    continue
+                if info.type == GNUTYPE_DUMPDIR:
+                    directory = info.name.rstrip('/')
+                    if directory not in listings and (
+                        is_selected(directory, files)
+                        or any(name.startswith(directory + '/')
+                               for name in names)):
+                        listings[directory] = parse_dumpdir(
+                            tar.extractfile(info).read())
+                        resolved.update(name for name in names
+                                        if is_deleted(name, listings))
+                    continue
+                if (not is_selected(info.name, files)
+                    or info.name in written or info.name in deleted
+                    or is_deleted(info.name, listings)):
+                    continue
+                written.add(info.name)
+                found.update(name for name in names
+                             if info.name == name
+                             or info.name.startswith(name + '/'))
+                if info.isdir():
+                    continue
+                if info.name in names:
+                    resolved.add(info.name)
+                if info.isreg():
+                    source = tar.extractfile(info)
+                    if info.size > restbackup.MAX_COPY_CHUNK_SIZE:
+                        restbackup.copy_stream(source, outfile)
+                    else:
+                        outfile.write(source.read())
+                if names and resolved >= names:
+                    return sorted(names - found)
+            # Deletions apply to the older archives of the chain
+            for path in newly_deleted:
+                path = archive_name(decode_path(path))
+                deleted.add(path)
+                if path in names:
+                    resolved.add(path)
+            if names and resolved >= names:
+                break
+        finally:
+            reader.close()
+    return sorted(names - found)
@@ -11,7 +11,11 @@ setup(
     license = 'Copyright (C) 2011 Rest Backup LLC.  Use of this software is subject to the RestBackup.com Terms of Use, http://www.restbackup.com/terms',
     platforms = 'any',
     py_modules=['pyaes', 'chlorocrypt', 'restbackup', 'restbackupcli',
-                'restbackuptar', 'test-restbackup', 'test-chlorocrypt'],
+                'restbackuppack', 'restbackuptar', 'restbackuptarfile',
+                'test-restbackup', 'test-chlorocrypt', 'test-restbackuppack',
+                'test-restbackuptar', 'test-restbackuptarfile',
+                'bench-restbackup', 'stubserver',
+                'gen-pyaes-tables'],
     entry_points = {
         'console_scripts': [
             'chlorocrypt = chlorocrypt:entry_point',
@@ -1,3 +1,4 @@
+from restbackup import PipeReader
 from restbackup import StringReader
 from chlorocrypt import BadMacException
 from chlorocrypt import DataDamagedException
@@ -8,10 +9,26 @@ from chlorocrypt import PaddingAddingReader
 from chlorocrypt import PaddingStrippingReader
 from chlorocrypt import AesCbcEncryptingReader
 from chlorocrypt import AesCbcDecryptingReader
+from chlorocrypt import CompressingReader
+from chlorocrypt import DecompressingReader
 from chlorocrypt import EncryptingReader
+from chlorocrypt import read_format_header
 from chlorocrypt import DecryptingReader
+from chlorocrypt import FORMAT_HEADER_LENGTH
+from chlorocrypt import FORMAT_MAGIC
+from chlorocrypt import MAC_BATCH_SIZE
+from chlorocrypt import HmacSha256
+from chlorocrypt import LARGE_MAC_BLOCK_SIZE
+from chlorocrypt import MAC_BLOCK_SIZE
+from chlorocrypt import choose_mac_block_size
+from chlorocrypt import constant_time_equal
 from chlorocrypt import pbkdf2_256bit
+from chlorocrypt import python_constant_time_equal
+import hashlib
+import hmac
 import os
+import pyaes
+import StringIO
 import unittest
 
 
@@ -324,6 +341,25 @@ class TestMacCheckingReader(unittest.TestCase):
         self.assertEqual(reader.read(128*1024), 'a'*128*1024)
         self.assertRaises(BadMacException, reader.read, 1024*1024 + 1)
     
+    def test_batch_boundary(self):
+        batch_blocks = MAC_BATCH_SIZE / (64 * 1024)
+        for num_blocks in [batch_blocks, batch_blocks + 1]:
+            data = 'a' * 64 * 1024 * num_blocks
+            reader = MacCheckingReader(
+                MacAddingReader(StringReader(data), self.passphrase,
+                                self.salt, self.key),
+                self.passphrase, self.key)
+            self.assertEqual(reader.read(), data)
+            self.assertEqual(reader.read(1), '')
+    
+    def test_truncated_in_batch(self):
+        data = ['a'*64*1024 + self.a_macs.pop(0) for x in xrange(2)]
+        input = StringReader(self.salt + ''.join(data) + 'a')
+        reader = MacCheckingReader(input, self.passphrase, self.key)
+        self.assertEqual(reader.read(128*1024), 'a'*128*1024)
+        self.assertRaises(DataTruncatedException, reader.read, 1)
+        self.assertRaises(DataTruncatedException, reader.read, 1)
+    
     def test_real_key(self):
         mac = '+6ZSbYn460hpoowKHZkwTbxQFWkUAjlpXsbKByZGA+4='.decode('base64')
         input = StringReader(self.salt + '1234567' + mac)
@@ -663,6 +699,22 @@ class TestPaddingReaders(unittest.TestCase):
         self.assertEqual(stripping_reader.read(1), '')
         self.assertEqual(stripping_reader.read(1), '')
     
+    def test_read_sizes(self):
+        for length in [0, 1, 15, 16, 17, 1000]:
+            data = os.urandom(length)
+            for read_size in [1, 7, 16, 17, 4096]:
+                for stream in [StringReader(data),
+                               PipeReader(StringIO.StringIO(data))]:
+                    reader = PaddingStrippingReader(PaddingAddingReader(stream))
+                    chunks = []
+                    while True:
+                        chunk = reader.read_once(read_size)
+                        if not chunk:
+                            break
+                        self.assertTrue(len(chunk) <= read_size)
+                        chunks.append(chunk)
+                    self.assertEqual(''.join(chunks), data)
+    
 
 class TestAesCbcEncryptingReader(unittest.TestCase):
     def setUp(self):
@@ -1285,6 +1337,243 @@ class TestCryptingReaders(unittest.TestCase):
         self.assertEqual(decrypting_reader.read(1024*1024), data[42:])
         self.assertEqual(decrypting_reader.read(1), '')
         self.assertEqual(decrypting_reader.read(1), '')
+    
+    def test_tiny_reads(self):
+        data = os.urandom(64*1024) * 2 + os.urandom(42)
+        def new_encrypting_reader():
+            return EncryptingReader(StringReader(data), self.passphrase,
+                                    self.salt, self.iv, self.key,
+                                    compression='zlib', mac_block_size=16*1024)
+        def read_tiny(reader):
+            chunks = []
+            while True:
+                for size in xrange(1, 18):
+                    chunk = reader.read(size)
+                    if not chunk:
+                        return ''.join(chunks)
+                    self.assertTrue(len(chunk) <= size)
+                    chunks.append(chunk)
+        ciphertext = read_tiny(new_encrypting_reader())
+        self.assertEqual(ciphertext, new_encrypting_reader().read())
+        decrypting_reader = DecryptingReader(StringReader(ciphertext),
+                                             self.passphrase, self.key)
+        self.assertEqual(read_tiny(decrypting_reader), data)
+    
+    def test_unknown_length(self):
+        for size in (0, 1, 15, 16, 17, 64*1024, 64*1024 + 42):
+            data = os.urandom(size)
+            input = PipeReader(StringIO.StringIO(data))
+            encrypting_reader = EncryptingReader(input, self.passphrase,
+                                                 self.salt, self.iv, self.key)
+            self.assertRaises(TypeError, len, encrypting_reader)
+            ciphertext = encrypting_reader.read()
+            sized_reader = EncryptingReader(StringReader(data), self.passphrase,
+                                            self.salt, self.iv, self.key)
+            self.assertEqual(ciphertext, sized_reader.read())
+            input = PipeReader(StringIO.StringIO(ciphertext))
+            decrypting_reader = DecryptingReader(input, self.passphrase, self.key)
+            self.assertRaises(TypeError, len, decrypting_reader)
+            self.assertEqual(decrypting_reader.read(), data)
+            self.assertEqual(decrypting_reader.read(1), '')
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.passphrase = 'passphrase'
+        self.salt = 's' * 16
+        self.iv = 'i' * 16
+        self.key = 'k' * 32
+        self.text = ''.join(['line %s of a log file\n' % n for n in xrange(5000)])
+    
+    def encrypt(self, data, compression):
+        return EncryptingReader(StringReader(data), self.passphrase, self.salt,
+                                self.iv, self.key, compression).read()
+    
+    def decrypt(self, ciphertext):
+        return DecryptingReader(StringReader(ciphertext), self.passphrase,
+                                self.key).read()
+    
+    def test_compressing_reader(self):
+        for codec in ('none', 'zlib', 'bz2'):
+            reader = CompressingReader(StringReader(self.text), codec)
+            compressed = reader.read(100) + reader.read()
+            reader.rewind()
+            self.assertEqual(reader.read(), compressed)
+            decompressed = DecompressingReader(StringReader(compressed), codec)
+            self.assertEqual(decompressed.read(7) + decompressed.read(),
+                             self.text)
+        self.assertRaises(ValueError, CompressingReader, StringReader(''), 'x')
+    
+    def test_adaptive(self):
+        self.assertEqual(CompressingReader(StringReader(self.text)).codec,
+                         'zlib')
+        random_data = os.urandom(100000)
+        reader = CompressingReader(StringReader(random_data))
+        self.assertEqual(reader.codec, 'none')
+        self.assertEqual(len(reader), len(random_data))
+        self.assertEqual(reader.read(), random_data)
+        reader.rewind()
+        self.assertEqual(reader.read(), random_data)
+        self.assertEqual(CompressingReader(StringReader('')).codec, 'none')
+    
+    def test_round_trip(self):
+        for codec in ('none', 'zlib', 'bz2', 'auto'):
+            for data in ('', 'a', self.text):
+                ciphertext = self.encrypt(data, codec)
+                self.assertTrue(ciphertext.startswith(FORMAT_MAGIC))
+                self.assertEqual(self.decrypt(ciphertext), data)
+    
+    def test_compresses(self):
+        ciphertext = self.encrypt(self.text, 'zlib')
+        self.assertTrue(len(ciphertext) < len(self.text) / 4)
+    
+    def test_uncompressed_format(self):
+        ciphertext = self.encrypt(self.text, None)
+        self.assertFalse(ciphertext.startswith(FORMAT_MAGIC))
+        self.assertEqual(self.decrypt(ciphertext), self.text)
+    
+    def test_header_is_authenticated(self):
+        ciphertext = self.encrypt(self.text, 'none')
+        changed_codec = ciphertext[:9] + '\x01' + ciphertext[10:]
+        self.assertRaises(BadMacException, self.decrypt, changed_codec)
+        stripped = ciphertext[FORMAT_HEADER_LENGTH:]
+        self.assertRaises(BadMacException, self.decrypt, stripped)
+    
+    def test_unsupported_header(self):
+        ciphertext = self.encrypt(self.text, 'zlib')
+        self.assertRaises(DataDamagedException, self.decrypt,
+                          ciphertext[:8] + '\x09' + ciphertext[9:])
+        self.assertRaises(DataDamagedException, self.decrypt,
+                          ciphertext[:9] + '\x09' + ciphertext[10:])
+        self.assertRaises(DataTruncatedException, self.decrypt,
+                          ciphertext[:9])
+        self.assertRaises(DataTruncatedException, self.decrypt,
+                          ciphertext[:12])
+    
+    def test_damaged_compressed_data(self):
+        compressed = CompressingReader(StringReader(self.text), 'zlib').read()
+        damaged = compressed[:10] + 'x' * 10 + compressed[20:]
+        reader = DecompressingReader(StringReader(damaged), 'zlib')
+        self.assertRaises(DataDamagedException, reader.read)
+
+class TestMacBlockSize(unittest.TestCase):
+    def setUp(self):
+        self.passphrase = 'passphrase'
+        self.salt = 's' * 16
+        self.iv = 'i' * 16
+        self.key = 'k' * 32
+        self.text = os.urandom(5000)
+    
+    def encrypt(self, stream, mac_block_size, compression=None):
+        return EncryptingReader(stream, self.passphrase, self.salt, self.iv,
+                                self.key, compression, mac_block_size).read()
+    
+    def decrypt(self, ciphertext):
+        return DecryptingReader(StringReader(ciphertext), self.passphrase,
+                                self.key)
+    
+    def test_round_trip(self):
+        for mac_block_size in [1024, 1040, 4096, 'auto']:
+            for compression in [None, 'none', 'zlib']:
+                ciphertext = self.encrypt(StringReader(self.text),
+                                          mac_block_size, compression)
+                self.assertTrue(ciphertext.startswith(FORMAT_MAGIC))
+                self.assertEqual(self.decrypt(ciphertext).read(), self.text)
+    
+    def test_header(self):
+        ciphertext = self.encrypt(StringReader(self.text), 1024)
+        (header, codec, mac_block_size, stream) = \
+            read_format_header(StringReader(ciphertext))
+        self.assertEqual(len(header), FORMAT_HEADER_LENGTH)
+        self.assertEqual((codec, mac_block_size), ('none', 1024))
+        # MAC salt, then AES salt, IV and padded data in 5 MAC blocks
+        self.assertEqual(len(ciphertext),
+                         FORMAT_HEADER_LENGTH + 16 + 32 + 5008 + 5 * 32)
+        # The length is known when the data is not compressed
+        self.assertEqual(len(self.decrypt(ciphertext)), 5008)
+    
+    def test_choose(self):
+        self.assertEqual(choose_mac_block_size(None), LARGE_MAC_BLOCK_SIZE)
+        self.assertEqual(choose_mac_block_size(0), MAC_BLOCK_SIZE)
+        self.assertEqual(choose_mac_block_size(1024 * 1024), MAC_BLOCK_SIZE)
+        self.assertEqual(choose_mac_block_size(1024 * 1024 * 1024),
+                         LARGE_MAC_BLOCK_SIZE)
+        ciphertext = self.encrypt(PipeReader(StringIO.StringIO('abc')), 'auto')
+        (header, codec, mac_block_size, stream) = \
+            read_format_header(StringReader(ciphertext))
+        self.assertEqual(mac_block_size, LARGE_MAC_BLOCK_SIZE)
+    
+    def test_bad_size(self):
+        for mac_block_size in [0, 1023, 17 * 1024 * 1024]:
+            self.assertRaises(ValueError, EncryptingReader,
+                              StringReader('abc'), self.passphrase,
+                              self.salt, self.iv, self.key, None,
+                              mac_block_size)
+        ciphertext = self.encrypt(StringReader(self.text), 1024)
+        damaged = ciphertext[:10] + '\x00\x00\x00\x01' + ciphertext[14:]
+        self.assertRaises(DataDamagedException, self.decrypt, damaged)
+    
+    def test_version_2(self):
+        header = FORMAT_MAGIC + '\x02\x00'
+        ciphertext = MacAddingReader(
+            AesCbcEncryptingReader(PaddingAddingReader(StringReader(self.text)),
+                                   self.passphrase, self.salt, self.iv,
+                                   self.key),
+            self.passphrase, self.salt, self.key, header).read()
+        self.assertEqual(self.decrypt(ciphertext).read(), self.text)
+    
+    def test_version_1(self):
+        ciphertext = self.encrypt(StringReader(self.text), None)
+        self.assertFalse(ciphertext.startswith(FORMAT_MAGIC))
+        self.assertEqual(self.decrypt(ciphertext).read(), self.text)
+
+
+class TestSlots(unittest.TestCase):
+    def test_stream_classes_have_slots(self):
+        import chlorocrypt
+        import restbackup
+        for obj in vars(chlorocrypt).values():
+            if isinstance(obj, type) and issubclass(obj, restbackup.InputStream):
+                self.assertTrue('__slots__' in vars(obj), obj.__name__)
+    
+    def test_no_instance_dict(self):
+        reader = EncryptingReader(StringReader('abc'), 'passphrase',
+                                  's' * 16, 'i' * 16, 'k' * 32)
+        self.assertFalse(hasattr(reader, '__dict__'))
+        self.assertFalse(hasattr(reader.stream, '__dict__'))
+
+class TestHmacSha256(unittest.TestCase):
+    def test_digest(self):
+        for key in ['', 'k', 'k' * 32, 'k' * 64, 'k' * 65, os.urandom(100)]:
+            for data in ['', 'abc', os.urandom(1000)]:
+                expected = hmac.new(key, data, hashlib.sha256).digest()
+                self.assertEqual(HmacSha256(key).digest(data), expected)
+    
+    def test_rfc4231_vector(self):
+        mac = HmacSha256('\x0b' * 20).digest('Hi There')
+        self.assertEqual(mac.encode('hex'),
+                         'b0344c61d8db38535ca8afceaf0bf12b'
+                         '881dc200c9833da726e9376c2e32cff7')
+    
+    def test_running_message(self):
+        h = HmacSha256('key')
+        mac = h.start('header')
+        self.assertEqual(h.finish(mac), h.digest('header'))
+        mac.update('abc')
+        self.assertEqual(h.finish(mac), h.digest('headerabc'))
+        self.assertEqual(h.finish(mac), h.digest('headerabc'))
+        mac.update('def')
+        self.assertEqual(h.finish(mac), h.digest('headerabcdef'))
+
+
+class TestConstantTimeEqual(unittest.TestCase):
+    def test_equal(self):
+        for equal in [constant_time_equal, python_constant_time_equal]:
+            self.assertTrue(equal('', ''))
+            self.assertTrue(equal('a' * 32, 'a' * 32))
+            self.assertFalse(equal('a' * 32, 'a' * 31 + 'b'))
+            self.assertFalse(equal('b' + 'a' * 31, 'a' * 32))
+            self.assertFalse(equal('a' * 32, 'a' * 31))
+            self.assertFalse(equal('', 'a'))
 
 
 class TestPbkdf2(unittest.TestCase):
@@ -1302,4 +1591,38 @@ class TestPbkdf2(unittest.TestCase):
         key2 = 'H2emsRWOYFcO1iFe3V9AaimVe5UDGlR+OUH7dYjcUcI='
         self.assertEqual(key1, key2)
 
+
+class TestPyaes(unittest.TestCase):
+    def test_tables(self):
+        gen_pyaes_tables = __import__('gen-pyaes-tables')
+        self.assertEqual(gen_pyaes_tables.check_tables(), [])
+    
+    def test_fips_197_vectors(self):
+        plaintext = '00112233445566778899aabbccddeeff'.decode('hex')
+        vectors = [('000102030405060708090a0b0c0d0e0f',
+                    '69c4e0d86a7b0430d8cdb78070b4c55a'),
+                   ('000102030405060708090a0b0c0d0e0f1011121314151617',
+                    'dda97ca4864cdfe06eaf70a0ec0d7191'),
+                   ('000102030405060708090a0b0c0d0e0f'
+                    '101112131415161718191a1b1c1d1e1f',
+                    '8ea2b7ca516745bfeafc49904b496089')]
+        for (key, ciphertext) in vectors:
+            for n in xrange(2): # the second AES object uses the key cache
+                aes = pyaes.new(key.decode('hex'), pyaes.MODE_ECB)
+                self.assertEqual(aes.encrypt(plaintext).encode('hex'),
+                                 ciphertext)
+                self.assertEqual(aes.decrypt(ciphertext.decode('hex')),
+                                 plaintext)
+    
+    def test_key_cache(self):
+        key = os.urandom(32)
+        aes1 = pyaes.AES(key)
+        aes2 = pyaes.AES(key)
+        self.assertTrue(aes1.round_keys is aes2.round_keys)
+        self.assertEqual(len(aes1.round_keys), 15)
+        self.assertEqual(len(aes1.exkey), 15 * 16)
+        for n in xrange(pyaes.KEY_CACHE_SIZE * 2):
+            pyaes.AES(os.urandom(16))
+        self.assertTrue(len(pyaes.key_cache) <= pyaes.KEY_CACHE_SIZE)
+
 unittest.main()
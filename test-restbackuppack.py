@@ -0,0 +1,190 @@
+import restbackup
+from restbackup import StringReader
+from restbackuppack import MemberNotFoundException
+from restbackuppack import PackBuilder
+from restbackuppack import PackFormatException
+from restbackuppack import PackReader
+from restbackuppack import iter_packs
+from restbackuppack import put_packed
+import restbackuppack
+import struct
+import unittest
+
+class FakeBackupApiCaller():
+    """Stores files in memory and counts requests"""
+    def __init__(self):
+        self.files = {}
+        self.requests = 0
+    
+    def put(self, name, data):
+        self.requests += 1
+        self.files[name] = data.read()
+        data.rewind()
+        assert len(data) == len(self.files[name])
+    
+    def get_range(self, name, first_byte, last_byte=None):
+        self.requests += 1
+        data = self.files[name]
+        if first_byte < 0 or last_byte == None:
+            return StringReader(data[first_byte:])
+        return StringReader(data[first_byte:last_byte + 1])
+    
+    def iter_list(self):
+        self.requests += 1
+        for name in sorted(self.files):
+            yield (name, len(self.files[name]), 0)
+
+
+class ClosingReader(StringReader):
+    """Records whether it was closed"""
+    __slots__ = ('closed',)
+    
+    def __init__(self, data):
+        StringReader.__init__(self, data)
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+
+class TestPackBuilder(unittest.TestCase):
+    def test_empty(self):
+        builder = PackBuilder()
+        data = builder.finish().read()
+        self.assertTrue(data.startswith('{"members":[]}RBPACK01'))
+        self.assertEqual(len(data), 14 + restbackuppack.TRAILER_LENGTH)
+        builder.close()
+    
+    def test_members(self):
+        builder = PackBuilder()
+        builder.add('a', 'abc', 1234)
+        builder.add('b', StringReader(''))
+        builder.add('c', StringReader('defg'))
+        self.assertEqual(len(builder), 7)
+        self.assertEqual(builder.members,
+                         [{'name':'a', 'offset':0, 'size':3, 'mtime':1234},
+                          {'name':'b', 'offset':3, 'size':0, 'mtime':None},
+                          {'name':'c', 'offset':3, 'size':4, 'mtime':None}])
+        reader = builder.finish()
+        self.assertTrue(reader.read().startswith('abcdefg{'))
+        builder.close()
+        self.assertEqual(builder.members[0]['name'], 'a')
+
+
+class TestPutPacked(unittest.TestCase):
+    def setUp(self):
+        self.backup_api = FakeBackupApiCaller()
+        self.files = [('file%s' % n, 'data of file %s' % n, n)
+                      for n in xrange(1000)]
+    
+    def test_one_pack(self):
+        pack_names = put_packed(self.backup_api, '/set', self.files)
+        self.assertEqual(pack_names, ['/set-0001.pack'])
+        self.assertEqual(self.backup_api.requests, 1)
+    
+    def test_many_packs(self):
+        pack_names = put_packed(self.backup_api, '/set', self.files,
+                                pack_size=1000)
+        self.assertEqual(len(pack_names), 16)
+        self.assertEqual(pack_names[-1], '/set-0016.pack')
+        self.assertEqual(sorted(self.backup_api.files), pack_names)
+        members = []
+        for pack_name in pack_names:
+            members.extend(PackReader(self.backup_api, pack_name).members())
+        self.assertEqual([m['name'] for m in members],
+                         [f[0] for f in self.files])
+    
+    def test_closes_streams(self):
+        open_readers = []
+        def files():
+            for n in xrange(10):
+                # Each reader is closed before the next one is opened
+                self.assertEqual([r for r in open_readers if not r.closed], [])
+                reader = ClosingReader('data of file %s' % n)
+                open_readers.append(reader)
+                yield ('file%s' % n, reader)
+        pack_names = put_packed(self.backup_api, '/set', files(), pack_size=50)
+        self.assertEqual(len(pack_names), 3)
+        self.assertEqual([r.closed for r in open_readers], [True] * 10)
+    
+    def test_no_files(self):
+        self.assertEqual(put_packed(self.backup_api, '/set', []), [])
+        self.assertEqual(self.backup_api.requests, 0)
+    
+    def test_iter_packs(self):
+        pack_names = put_packed(self.backup_api, '/set', self.files,
+                                pack_size=4000)
+        self.assertEqual(len(pack_names), 4)
+        self.backup_api.files['/set-other.pack'] = ''
+        self.backup_api.files['/set2-0001.pack'] = ''
+        self.backup_api.files['/set-0001.pack.old'] = ''
+        self.assertEqual(list(iter_packs(self.backup_api, '/set')), pack_names)
+
+
+class TestPackReader(unittest.TestCase):
+    def setUp(self):
+        self.backup_api = FakeBackupApiCaller()
+        files = [('file%s' % n, 'data of file %s' % n) for n in xrange(100)]
+        files.append(('empty', ''))
+        put_packed(self.backup_api, '/set', files)
+        self.backup_api.requests = 0
+    
+    def test_get(self):
+        pack = PackReader(self.backup_api, '/set-0001.pack')
+        self.assertEqual(pack.get('file42').read(), 'data of file 42')
+        self.assertEqual(pack.get('file0').read(), 'data of file 0')
+        self.assertEqual(pack.get('empty').read(), '')
+        # One request for the index and one for each non-empty member
+        self.assertEqual(self.backup_api.requests, 3)
+    
+    def test_non_ascii_names(self):
+        # Names are byte strings, which need not be UTF-8
+        names = ['caf\xc3\xa9.txt', '\xff.txt', '\xe4\xb8\xad']
+        put_packed(self.backup_api, '/names',
+                   [(name, 'data of ' + name) for name in names])
+        pack = PackReader(self.backup_api, '/names-0001.pack')
+        self.assertEqual([member['name'] for member in pack.members()], names)
+        for name in names:
+            self.assertEqual(type(pack.get(name).read()), str)
+            self.assertEqual(pack.get(name).read(), 'data of ' + name)
+    
+    def test_utf8_index(self):
+        # Packs from before names were stored byte for byte
+        index = ('{"members":[{"name":"\\u4e2d","offset":0,"size":3,'
+                 '"mtime":null}]}')
+        self.backup_api.files['/old'] = 'abc' + index + \
+            restbackuppack.PACK_MAGIC + \
+            struct.pack(restbackuppack.TRAILER_FORMAT, 3, len(index))
+        pack = PackReader(self.backup_api, '/old')
+        self.assertEqual(pack.get('\xe4\xb8\xad').read(), 'abc')
+    
+    def test_missing_member(self):
+        pack = PackReader(self.backup_api, '/set-0001.pack')
+        self.assertRaises(MemberNotFoundException, pack.get, 'file100')
+        self.assertRaises(restbackup.RestBackupException, pack.get, 'file100')
+    
+    def test_large_index(self):
+        files = [('file%s' % n, 'x') for n in xrange(3000)]
+        put_packed(self.backup_api, '/large', files)
+        self.backup_api.requests = 0
+        pack = PackReader(self.backup_api, '/large-0001.pack')
+        self.assertEqual(len(pack.members()), 3000)
+        self.assertEqual(self.backup_api.requests, 2)
+        self.assertEqual(pack.get('file2999').read(), 'x')
+    
+    def test_not_a_pack(self):
+        self.backup_api.files['/other'] = 'some data that is not a pack'
+        pack = PackReader(self.backup_api, '/other')
+        self.assertRaises(PackFormatException, pack.members)
+        self.backup_api.files['/other'] = ''
+        self.assertRaises(PackFormatException, pack.members)
+    
+    def test_damaged_index(self):
+        data = self.backup_api.files['/set-0001.pack']
+        index_end = len(data) - restbackuppack.TRAILER_LENGTH
+        self.backup_api.files['/set-0001.pack'] = \
+            data[:index_end - 2] + 'xx' + data[index_end:]
+        pack = PackReader(self.backup_api, '/set-0001.pack')
+        self.assertRaises(PackFormatException, pack.members)
+
+unittest.main()
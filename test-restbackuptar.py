@@ -0,0 +1,304 @@
+import restbackup
+from restbackup import RestBackup404NotFoundException
+from restbackup import StringReader
+from restbackuptar import TarFailedException
+from restbackuptar import VolumeReader
+from restbackuptar import find_last_level
+from restbackuptar import restore_to_stdout
+from restbackuptar import open_archive
+from restbackuptar import upload_archive
+from restbackuptar import upload_volumes
+import json
+import os
+import StringIO
+import stubserver
+import sys
+import tarfile
+import threading
+import time
+import unittest
+
+class FakeBackupApi(object):
+    """In-memory backup account.  Stores encrypted files as (passphrase,
+    data) tuples.  Fails the uploads and downloads of the files named
+    in the fail set.  Each transfer takes delay seconds.  Records the
+    mac_block_size of each encrypted upload in mac_block_sizes."""
+    scheme = 'https'
+    host = 'us.restbackup.com'
+    
+    def __init__(self):
+        self.files = {}
+        self.fail = set()
+        self.delay = 0
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.mac_block_sizes = {}
+    
+    def transfer(self, name):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if name in self.fail:
+                raise restbackup.RestBackupException("500 Internal Error")
+        finally:
+            with self.lock:
+                self.active -= 1
+    
+    def put(self, name, data):
+        self.transfer(name)
+        if hasattr(data, 'read'):
+            data = data.read()
+        self.files[name] = data
+        return ''
+    
+    def put_encrypted(self, passphrase, name, data, compression=None,
+                      mac_block_size=None):
+        self.put(name, data)
+        self.files[name] = (passphrase, self.files[name])
+        self.mac_block_sizes[name] = mac_block_size
+        return ''
+    
+    def get(self, name):
+        self.transfer(name)
+        if name not in self.files:
+            raise RestBackup404NotFoundException("404 Not Found")
+        return StringReader(self.files[name])
+    
+    def iter_list(self):
+        for name in sorted(self.files):
+            yield (name, 0, 0)
+    
+    def get_encrypted(self, passphrase, name):
+        self.transfer(name)
+        if name not in self.files:
+            raise RestBackup404NotFoundException("404 Not Found")
+        (file_passphrase, data) = self.files[name]
+        assert file_passphrase == passphrase
+        return StringReader(data)
+
+
+class FailingReader(restbackup.InputStream):
+    """Yields data and then raises TarFailedException at the end"""
+    __slots__ = ('data',)
+    
+    def __init__(self, data):
+        restbackup.InputStream.__init__(self)
+        self.data = data
+    
+    def read_once(self, size):
+        chunk = self.data[:size]
+        self.data = self.data[size:]
+        if not chunk:
+            raise TarFailedException("tar exited with status 2")
+        return chunk
+
+
+class TestUploadArchive(unittest.TestCase):
+    """Uploads to a local server through a real BackupApiCaller, so
+    that the errors are the ones HttpCaller raises"""
+    def setUp(self):
+        self.server = stubserver.start_server()
+        self.backup_api = restbackup.BackupApiCaller(
+            stubserver.access_url(self.server), 'Test/1.0')
+    
+    def upload(self, passphrase):
+        try:
+            upload_archive(self.backup_api, passphrase, '/a-full',
+                           FailingReader('x' * 100000))
+        except Exception, e:
+            return e
+    
+    def test_archive_failure(self):
+        self.assertEqual(type(self.upload(None)), TarFailedException)
+        self.assertEqual(type(self.upload('secret')), TarFailedException)
+    
+    def test_retry(self):
+        self.backup_api.retry_policy = restbackup.RetryPolicy(
+            first_delay_seconds=0)
+        for passphrase in (None, 'secret'):
+            self.server.failed_puts = 1
+            reader = restbackup.PipeReader(StringIO.StringIO('x' * 100000))
+            upload_archive(self.backup_api, passphrase, '/a-full', reader)
+            self.assertEqual(self.server.failed_puts, 0)
+    
+    def test_stream_not_retried(self):
+        self.backup_api.retry_policy = restbackup.RetryPolicy(
+            first_delay_seconds=0)
+        self.server.failed_puts = 1
+        reader = restbackup.PipeReader(StringIO.StringIO('x' * 100000))
+        self.assertRaises(restbackup.RestBackupException, upload_archive,
+                          self.backup_api, None, '/a-full', reader,
+                          stream=True)
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestVolumes(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeBackupApi()
+        self.old_stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.old_stdout
+    
+    def upload(self, data, volume_size, passphrase=None):
+        return upload_volumes(self.api, passphrase, '/a-full',
+                              StringReader(data), volume_size, 3)
+    
+    def test_upload(self):
+        data = os.urandom(2500)
+        self.assertEqual(self.upload(data, 1000), 3)
+        self.assertEqual(sorted(self.api.files),
+                         ['/a-full.v0001', '/a-full.v0002', '/a-full.v0003',
+                          '/a-full.volumes'])
+        self.assertEqual(len(self.api.files['/a-full.v0001']), 1000)
+        self.assertEqual(self.api.files['/a-full.v0001'] +
+                         self.api.files['/a-full.v0002'] +
+                         self.api.files['/a-full.v0003'], data)
+        self.assertEqual(json.loads(self.api.files['/a-full.volumes']),
+                         {'version':1, 'volumes':3})
+    
+    def test_exact_multiple(self):
+        self.assertEqual(self.upload('x' * 2000, 1000), 2)
+        self.assertEqual(len(self.api.files['/a-full.v0002']), 1000)
+    
+    def test_empty(self):
+        self.assertEqual(self.upload('', 1000), 1)
+        self.assertEqual(self.api.files['/a-full.v0001'], '')
+    
+    def test_encrypted(self):
+        self.upload('x' * 1500, 1000, passphrase='secret')
+        self.assertEqual(self.api.files['/a-full.v0002'], ('secret', 'x' * 500))
+    
+    def test_mac_block_size(self):
+        # Archives keep the format that older versions can decrypt
+        # unless a MAC block size is requested
+        self.upload('x' * 1500, 1000, passphrase='secret')
+        upload_archive(self.api, 'secret', '/b-full', StringReader('x'))
+        self.assertEqual(self.api.mac_block_sizes['/a-full.v0001'], None)
+        self.assertEqual(self.api.mac_block_sizes['/b-full.tar.gz'], None)
+        upload_volumes(self.api, 'secret', '/c-full', StringReader('x'),
+                       1000, mac_block_size='auto')
+        upload_archive(self.api, 'secret', '/d-full', StringReader('x'),
+                       mac_block_size=262144)
+        self.assertEqual(self.api.mac_block_sizes['/c-full.v0001'], 'auto')
+        self.assertEqual(self.api.mac_block_sizes['/d-full.tar.gz'], 262144)
+        (name, reader) = open_archive(self.api, 'secret', '/a-full')
+        self.assertEqual(reader.read(), 'x' * 1500)
+    
+    def test_upload_failure(self):
+        self.api.fail.add('/a-full.v0002')
+        self.assertRaises(restbackup.RestBackupException, self.upload,
+                          'x' * 5000, 1000)
+        self.assertFalse('/a-full.volumes' in self.api.files)
+    
+    def test_archive_failure(self):
+        self.assertRaises(TarFailedException, upload_volumes, self.api, None,
+                          '/a-full', FailingReader('x' * 1500), 1000)
+        self.assertFalse('/a-full.volumes' in self.api.files)
+    
+    def test_open_archive(self):
+        data = os.urandom(10000)
+        self.api.delay = 0.01
+        self.upload(data, 1000)
+        self.assertTrue(2 <= self.api.max_active <= 3, self.api.max_active)
+        self.api.max_active = 0
+        (name, reader) = open_archive(self.api, None, '/a-full', 2)
+        self.assertEqual(name, '/a-full.v0001-v0010')
+        self.assertEqual(reader.read(1), data[:1])
+        self.assertEqual(reader.read(), data[1:])
+        reader.close()
+        self.assertEqual(self.api.max_active, 2)
+        self.api.files['/b-full.tar.gz'] = 'archive'
+        (name, reader) = open_archive(self.api, None, '/b-full')
+        self.assertEqual((name, reader.read()), ('/b-full.tar.gz', 'archive'))
+        self.assertRaises(RestBackup404NotFoundException, open_archive,
+                          self.api, None, '/c-full')
+    
+    def test_download_failure(self):
+        self.upload('x' * 3000, 1000)
+        self.api.fail.add('/a-full.v0003')
+        (name, reader) = open_archive(self.api, None, '/a-full', 2)
+        self.assertEqual(reader.read(2000), 'x' * 2000)
+        self.assertRaises(restbackup.RestBackupException, reader.read, 1000)
+        reader.close()
+    
+    def test_close_early(self):
+        self.upload('x' * 10000, 1000)
+        reader = VolumeReader(self.api, None,
+                              ['/a-full.v%04d' % n for n in xrange(1, 11)], 2)
+        self.assertEqual(reader.read(10), 'x' * 10)
+        reader.close()
+        self.assertFalse(hasattr(reader, '__dict__'))
+
+
+def make_tar(name, data):
+    """Returns a tar.gz archive with one file"""
+    f = StringIO.StringIO()
+    tar = tarfile.open(fileobj=f, mode='w:gz')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, StringIO.StringIO(data))
+    tar.close()
+    return f.getvalue()
+
+
+class TestRestoreToStdout(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeBackupApi()
+        self.api.files['/a-full.tar.gz'] = make_tar('data/b', 'old b')
+        self.api.files['/a-inc1.tar.gz'] = make_tar('data/a', 'new a')
+        (self.old_stdout, self.old_stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = StringIO.StringIO()
+        sys.stderr = StringIO.StringIO()
+    
+    def restore(self):
+        status = restore_to_stdout(self.api, None, 'a', 1,
+                                   ['data/a', 'data/b'])
+        return (status, sys.stdout.getvalue(), sys.stderr.getvalue())
+    
+    def test_restore(self):
+        (status, out, err) = self.restore()
+        self.assertEqual((status, out), (0, 'new aold b'))
+        self.assertTrue('Retrieving https://us.restbackup.com/a-full.tar.gz'
+                        in err)
+    
+    def test_download_failure(self):
+        self.api.fail.add('/a-full.tar.gz')
+        (status, out, err) = self.restore()
+        # Errors never go to stdout, which carries the file data
+        self.assertEqual((status, out), (1, 'new a'))
+        self.assertTrue('ERROR: 500 Internal Error' in err)
+    
+    def test_damaged_archive(self):
+        self.api.files['/a-full.tar.gz'] = 'damaged'
+        (status, out, err) = self.restore()
+        self.assertEqual((status, out), (1, 'new a'))
+        self.assertTrue('ERROR: ' in err)
+    
+    def tearDown(self):
+        (sys.stdout, sys.stderr) = (self.old_stdout, self.old_stderr)
+
+
+class TestFindLastLevel(unittest.TestCase):
+    def test_find_last_level(self):
+        api = FakeBackupApi()
+        self.assertEqual(find_last_level(api, 'host-20110101T000000Z'), None)
+        for name in ['/host-20110101T000000Z-full.volumes',
+                     '/host-20110101T000000Z-full.v0001',
+                     '/host-20110101T000000Z-inc1.tar.gz',
+                     '/host-20110101T000000Z-inc2.volumes',
+                     '/host-20110101T000000Z-inc4.tar.gz',
+                     '/host-20110202T000000Z-inc3.tar.gz']:
+            api.files[name] = ''
+        self.assertEqual(find_last_level(api, 'host-20110101T000000Z'), 2)
+        self.assertEqual(find_last_level(api, 'host-20110202T000000Z'), None)
+
+unittest.main()
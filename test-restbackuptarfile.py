@@ -0,0 +1,598 @@
+import restbackup
+from restbackuptarfile import ArchiveFailedException
+from restbackuptarfile import ArchiveReader
+from restbackuptarfile import ConsolidatingReader
+from restbackuptarfile import PeekedReader
+from restbackuptarfile import compare
+from restbackuptarfile import extract_to_stream
+from restbackuptarfile import find_unchanged
+from restbackuptarfile import is_archive
+from restbackuptarfile import load_snapshot
+from restbackuptarfile import restore
+from restbackuptarfile import save_snapshot
+from restbackuptarfile import scan
+from restbackuptarfile import write_consolidated
+import restbackuptarfile
+import json
+import os
+import os.path
+import shutil
+import StringIO
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def list_tree(top):
+    """Returns a sorted list of the paths under top, relative to top,
+    with the content of files"""
+    tree = []
+    for (dirpath, dirnames, filenames) in os.walk(top):
+        for name in dirnames:
+            tree.append(os.path.relpath(os.path.join(dirpath, name), top))
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            tree.append((os.path.relpath(path, top), read_file(path)))
+    return sorted(tree)
+
+def make_archive(old_snapshot, paths):
+    reader = ArchiveReader(old_snapshot, scan(paths))
+    data = reader.read()
+    reader.close()
+    return (data, reader.snapshot)
+
+
+class TarfileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp(prefix='test-restbackuptarfile.')
+        os.chdir(self.dir)
+        os.mkdir('data')
+        os.mkdir('data/sub')
+        write_file('data/file1', 'initial data')
+        write_file('data/sub/file2', 'x' * 100000)
+        os.symlink('file1', 'data/link')
+    
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir)
+    
+    def make_chain(self):
+        """Returns a list of the archives of a full and two incremental
+        backups, and the expected tree of the last one"""
+        (full, snapshot) = make_archive({}, ['data'])
+        write_file('data/file1', 'initial data, modified')
+        os.utime('data/file1', (1, 1))
+        shutil.rmtree('data/sub')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        os.mkdir('data/sub')
+        write_file('data/sub/file3', 'recreated')
+        os.unlink('data/link')
+        (inc2, snapshot) = make_archive(snapshot, ['data'])
+        return ([full, inc1, inc2], list_tree('data'))
+
+
+class TestScan(TarfileTestCase):
+    def test_scan(self):
+        snapshot = scan(['data/'])
+        self.assertEqual(sorted(snapshot), ['data', 'data/file1', 'data/link',
+                                            'data/sub', 'data/sub/file2'])
+        self.assertEqual(snapshot['data'][0], 'd')
+        self.assertEqual(snapshot['data/link'][0], 'l')
+        entry = snapshot['data/sub/file2']
+        st = os.lstat('data/sub/file2')
+        self.assertEqual(entry, ['f', st.st_ino, st.st_mtime, 100000, None,
+                                 st.st_ctime, st.st_mode, st.st_uid,
+                                 st.st_gid])
+    
+    def test_one_worker(self):
+        self.assertEqual(scan(['data'], workers=1), scan(['data']))
+    
+    def test_missing_path(self):
+        errors = []
+        snapshot = scan(['data/file1', 'missing'], errors=errors)
+        self.assertEqual(sorted(snapshot), ['data/file1'])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('missing' in errors[0])
+    
+    def test_compare(self):
+        old_snapshot = scan(['data'])
+        write_file('data/file1', 'changed data')
+        os.utime('data/file1', (1, 1))
+        os.unlink('data/sub/file2')
+        write_file('data/file3', 'new')
+        (changed, deleted) = compare(old_snapshot, scan(['data']))
+        # Adding and removing files changes the mtime of directories
+        self.assertEqual(changed, ['data', 'data/file1', 'data/file3',
+                                   'data/sub'])
+        self.assertEqual(deleted, ['data/sub/file2'])
+    
+    def test_compare_ctime(self):
+        write_file('data/file3', 'abc')
+        old_snapshot = scan(['data'])
+        os.chmod('data/file1', 0600)
+        # Same size and mtime, different content
+        st = os.stat('data/file3')
+        write_file('data/file3', 'xyz')
+        os.utime('data/file3', (st.st_atime, st.st_mtime))
+        new_snapshot = scan(['data'])
+        (changed, deleted) = compare(old_snapshot, new_snapshot)
+        self.assertEqual(changed, ['data/file1', 'data/file3'])
+        # Entries from version 2 snapshots have no ctime
+        for entry in old_snapshot.itervalues():
+            entry[restbackuptarfile.CTIME:] = restbackuptarfile.NO_METADATA
+        (changed, deleted) = compare(old_snapshot, new_snapshot)
+        self.assertEqual(changed, sorted(new_snapshot))
+    
+    def test_snapshot_file(self):
+        write_file('data/\xff\xfe', 'name is not UTF-8')
+        snapshot = scan(['data'])
+        snapshot['data/file1'][restbackuptarfile.SHA256] = 'ab' * 32
+        save_snapshot('snapshot', snapshot)
+        self.assertEqual(load_snapshot('snapshot'), snapshot)
+        self.assertEqual(load_snapshot('missing'), {})
+        self.assertTrue(read_file('snapshot').startswith('RBTSNP03'))
+    
+    def test_version_2_snapshot_file(self):
+        entries = {'data/\xff':['f', 1, 2.5, 3, 'ab' * 32, None, None, None,
+                                None],
+                   'data':['d', 4, 5.0, 0, None, None, None, None, None]}
+        save_snapshot('snapshot', entries)
+        # Without a ctime, mode, uid and gid, the records are the same
+        # as in version 2
+        write_file('snapshot', 'RBTSNP02' + read_file('snapshot')[8:])
+        self.assertEqual(load_snapshot('snapshot'), entries)
+    
+    def test_version_1_snapshot_file(self):
+        entries = {u'data/\xff':['f', 1, 2.5, 3, 'ab' * 32],
+                   u'data':['d', 4, 5.0, 0, None]}
+        write_file('snapshot', json.dumps({'version':1, 'entries':entries}))
+        snapshot = load_snapshot('snapshot')
+        self.assertEqual(snapshot,
+                         {'data/\xff':['f', 1, 2.5, 3, 'ab' * 32, None, None,
+                                       None, None],
+                          'data':['d', 4, 5.0, 0, None, None, None, None,
+                                  None]})
+        save_snapshot('snapshot', snapshot)
+        self.assertEqual(load_snapshot('snapshot'), snapshot)
+    
+    def test_damaged_snapshot_file(self):
+        save_snapshot('snapshot', scan(['data']))
+        data = read_file('snapshot')
+        for length in (4, 12, len(data) / 2):
+            write_file('snapshot', data[:length])
+            self.assertRaises(ValueError, load_snapshot, 'snapshot')
+        write_file('snapshot', 'not a snapshot')
+        self.assertRaises(ValueError, load_snapshot, 'snapshot')
+    
+    def test_large_snapshot_file(self):
+        snapshot = {}
+        for n in xrange(20000):
+            snapshot['data/%s/file%s' % (n % 100, n)] = \
+                ['f', n, n + 0.5, n * 10, '%064x' % n, n + 0.25, 0100644,
+                 n % 7, n % 11]
+        save_snapshot('snapshot', snapshot)
+        self.assertEqual(load_snapshot('snapshot'), snapshot)
+    
+    def test_batches(self):
+        old_batch_size = restbackuptarfile.SCAN_BATCH_SIZE
+        restbackuptarfile.SCAN_BATCH_SIZE = 3
+        try:
+            for n in xrange(20):
+                write_file('data/sub/new%s' % n, '')
+            snapshot = scan(['data'])
+        finally:
+            restbackuptarfile.SCAN_BATCH_SIZE = old_batch_size
+        self.assertEqual(len(snapshot), 25)
+        self.assertEqual(snapshot, scan(['data']))
+    
+    def test_scandir(self):
+        class FakeDirEntry(object):
+            def __init__(self, path):
+                self.path = path
+            def stat(self, follow_symlinks=True):
+                assert not follow_symlinks
+                return os.lstat(self.path)
+        def fake_scandir(path):
+            return [FakeDirEntry(os.path.join(path, name))
+                    for name in os.listdir(path)]
+        old_scandir = restbackuptarfile.scandir
+        restbackuptarfile.scandir = fake_scandir
+        try:
+            snapshot = scan(['data'])
+        finally:
+            restbackuptarfile.scandir = old_scandir
+        self.assertEqual(snapshot, scan(['data']))
+
+
+class TestArchive(TarfileTestCase):
+    def test_full_and_incremental(self):
+        (full, snapshot) = make_archive({}, ['data'])
+        expected_full = list_tree('data')
+        write_file('data/file1', 'initial data, modified')
+        os.utime('data/file1', (1, 1))
+        shutil.rmtree('data/sub')
+        write_file('data/file3', 'more new data')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        expected_inc1 = list_tree('data')
+        self.assertTrue(len(inc1) < len(full))
+    
+        restore(restbackup.StringReader(full), 'restored',
+                out=StringIO.StringIO())
+        self.assertEqual(list_tree('restored/data'), expected_full)
+        self.assertEqual(os.readlink('restored/data/link'), 'file1')
+        out = StringIO.StringIO()
+        restore(restbackup.StringReader(inc1), 'restored', out=out)
+        self.assertEqual(list_tree('restored/data'), expected_inc1)
+        self.assertEqual(os.stat('restored/data/file1').st_mtime, 1)
+        self.assertTrue("Deleting 'data/sub'\n" in out.getvalue())
+    
+    def test_hashes(self):
+        import hashlib
+        (data, snapshot) = make_archive({}, ['data'])
+        self.assertEqual(snapshot['data/sub/file2'][restbackuptarfile.SHA256],
+                         hashlib.sha256('x' * 100000).hexdigest())
+        self.assertEqual(snapshot['data'][restbackuptarfile.SHA256], None)
+        # Unchanged files keep their hashes
+        (data, snapshot) = make_archive(snapshot, ['data'])
+        self.assertEqual(snapshot['data/sub/file2'][restbackuptarfile.SHA256],
+                         hashlib.sha256('x' * 100000).hexdigest())
+    
+    def test_unchanged_contents(self):
+        (data, snapshot) = make_archive({}, ['data'])
+        os.utime('data/sub/file2', (1, 1))
+        write_file('data/file1', 'initial DATA')
+        os.utime('data/file1', (2, 2))
+        reader = ArchiveReader(snapshot, scan(['data']))
+        data = reader.read()
+        reader.close()
+        self.assertEqual(reader.unchanged, ['data/sub/file2'])
+        names = tarfile.open(fileobj=StringIO.StringIO(data)).getnames()
+        self.assertTrue('data/file1' in names)
+        self.assertFalse('data/sub/file2' in names)
+        entry = reader.snapshot['data/sub/file2']
+        self.assertEqual(entry[restbackuptarfile.MTIME], 1)
+        self.assertEqual(entry[restbackuptarfile.SHA256],
+                         snapshot['data/sub/file2'][restbackuptarfile.SHA256])
+        (changed, deleted) = compare(reader.snapshot, scan(['data']))
+        self.assertEqual(changed, [])
+    
+    def test_mode_change(self):
+        # A file whose content kept its hash but whose permissions
+        # changed is archived again
+        (data, snapshot) = make_archive({}, ['data'])
+        os.chmod('data/sub/file2', 0600)
+        (data, snapshot) = make_archive(snapshot, ['data'])
+        self.assertEqual(
+            tarfile.open(fileobj=StringIO.StringIO(data)).getnames(),
+            [restbackuptarfile.DELETIONS_MEMBER, 'data/sub/file2'])
+    
+    def test_find_unchanged(self):
+        (data, old_snapshot) = make_archive({}, ['data'])
+        os.utime('data/file1', (1, 1))
+        os.utime('data/sub/file2', (1, 1))
+        new_snapshot = scan(['data'])
+        os.unlink('data/file1')
+        (changed, deleted) = compare(old_snapshot, new_snapshot)
+        self.assertEqual(find_unchanged(old_snapshot, new_snapshot, changed,
+                                        workers=1), ['data/sub/file2'])
+        self.assertEqual(new_snapshot['data/file1'][restbackuptarfile.SHA256],
+                         None)
+    
+    def test_standard_tar(self):
+        (data, snapshot) = make_archive({}, ['data'])
+        tar = tarfile.open(fileobj=StringIO.StringIO(data), mode='r:gz')
+        self.assertEqual(tar.getnames()[0], restbackuptarfile.DELETIONS_MEMBER)
+        self.assertEqual(sorted(tar.getnames()[1:]),
+                         ['data', 'data/file1', 'data/link', 'data/sub',
+                          'data/sub/file2'])
+        child = subprocess.Popen(['tar', '-tz'], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+        output = child.communicate(data)[0]
+        self.assertEqual(child.returncode, 0)
+        self.assertTrue('data/sub/file2\n' in output)
+    
+    def test_is_archive(self):
+        (data, snapshot) = make_archive({}, ['data'])
+        self.assertTrue(is_archive(data[:100]))
+        child = subprocess.Popen(['tar', '-cz', 'data'],
+                                 stdout=subprocess.PIPE)
+        self.assertFalse(is_archive(child.communicate()[0]))
+        self.assertFalse(is_archive('not gzip data'))
+    
+    def test_vanished_file(self):
+        new_snapshot = scan(['data'])
+        os.unlink('data/sub/file2')
+        reader = ArchiveReader({}, new_snapshot)
+        self.assertRaises(ArchiveFailedException, reader.read)
+        reader.close()
+    
+    def test_close_early(self):
+        write_file('data/big', os.urandom(1024*1024))
+        reader = ArchiveReader({}, scan(['data']))
+        reader.read(100)
+        reader.close()
+        reader.thread.join(5)
+        self.assertFalse(reader.thread.isAlive())
+    
+    def restore_chain(self, chain):
+        for data in chain:
+            restore(restbackup.StringReader(data), 'restored',
+                    out=StringIO.StringIO())
+    
+    def test_symlink_replaced_by_file(self):
+        write_file('victim', 'original')
+        os.unlink('data/sub/file2')
+        os.symlink(os.path.abspath('victim'), 'data/sub/file2')
+        (full, snapshot) = make_archive({}, ['data'])
+        os.unlink('data/sub/file2')
+        write_file('data/sub/file2', 'new content')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        self.restore_chain([full, inc1])
+        self.assertEqual(read_file('victim'), 'original')
+        self.assertFalse(os.path.islink('restored/data/sub/file2'))
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+    
+    def test_directory_symlink_replaced_by_directory(self):
+        os.mkdir('outside')
+        shutil.rmtree('data/sub')
+        os.symlink(os.path.abspath('outside'), 'data/sub')
+        (full, snapshot) = make_archive({}, ['data'])
+        os.unlink('data/sub')
+        os.mkdir('data/sub')
+        write_file('data/sub/file2', 'new content')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        self.restore_chain([full, inc1])
+        self.assertEqual(os.listdir('outside'), [])
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+    
+    def test_directory_replaced_by_file(self):
+        (full, snapshot) = make_archive({}, ['data'])
+        shutil.rmtree('data/sub')
+        write_file('data/sub', 'now a file')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        self.restore_chain([full, inc1])
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+    
+    def test_file_replaced_by_directory(self):
+        (full, snapshot) = make_archive({}, ['data'])
+        os.unlink('data/file1')
+        os.mkdir('data/file1')
+        write_file('data/file1/inner', 'inner')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        self.restore_chain([full, inc1])
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+    
+    def test_hard_links(self):
+        os.link('data/file1', 'data/hardlink')
+        (full, snapshot) = make_archive({}, ['data'])
+        os.unlink('data/file1')
+        write_file('data/file1', 'new file')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        self.restore_chain([full, inc1])
+        self.assertEqual(read_file('restored/data/hardlink'), 'initial data')
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+    
+    def test_restore_selected_files(self):
+        (data, snapshot) = make_archive({}, ['data'])
+        restore(restbackup.StringReader(data), 'restored', ['data/sub'],
+                out=StringIO.StringIO())
+        self.assertEqual(list_tree('restored'),
+                         ['data', 'data/sub', ('data/sub/file2', 'x' * 100000)])
+    
+    def test_parent_directory_path(self):
+        # Member names drop leading '../' like GNU tar, so that the
+        # members are not skipped as unsafe
+        os.mkdir('work')
+        os.chdir('work')
+        (full, snapshot) = make_archive({}, ['../data'])
+        os.unlink('../data/sub/file2')
+        (inc1, snapshot) = make_archive(snapshot, ['../data'])
+        self.restore_chain([full, inc1])
+        self.assertEqual(list_tree('restored/data'), list_tree('../data'))
+        restore(restbackup.StringReader(full), 'selected', ['../data/sub'],
+                out=StringIO.StringIO())
+        self.assertEqual(list_tree('selected'),
+                         ['data', 'data/sub', ('data/sub/file2', 'x' * 100000)])
+    
+    def test_unsafe_member(self):
+        f = StringIO.StringIO()
+        import gzip
+        gzip_file = gzip.GzipFile(filename='', mode='wb', fileobj=f)
+        tar = tarfile.open(fileobj=gzip_file, mode='w|')
+        for (name, data) in [(restbackuptarfile.DELETIONS_MEMBER, '[]'),
+                             ('../escaped', 'x'), ('/absolute', 'x'),
+                             ('safe', 'x')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        tar.close()
+        gzip_file.close()
+        os.mkdir('restored')
+        out = StringIO.StringIO()
+        restore(restbackup.StringReader(f.getvalue()), 'restored', out=out)
+        self.assertEqual(os.listdir('restored'), ['safe'])
+        self.assertFalse(os.path.exists('escaped'))
+        self.assertTrue("Skipping unsafe member '../escaped'" in out.getvalue())
+    
+    def test_peeked_reader(self):
+        reader = PeekedReader('abc', restbackup.StringReader('defg'))
+        self.assertEqual(reader.read(2), 'ab')
+        self.assertEqual(reader.read(), 'cdefg')
+        self.assertEqual(reader.bytes_read, 7)
+
+
+class ClosingReader(restbackup.StringReader):
+    """StringReader that records whether it was closed"""
+    __slots__ = ('closed',)
+    
+    def __init__(self, data):
+        restbackup.StringReader.__init__(self, data)
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+
+class TestConsolidate(TarfileTestCase):
+    def test_consolidate(self):
+        (chain, expected) = self.make_chain()
+        readers = [ClosingReader(data) for data in reversed(chain)]
+        out = StringIO.StringIO()
+        write_consolidated(out, [('archive', reader) for reader in readers])
+        self.assertEqual([reader.closed for reader in readers],
+                         [True, True, True])
+        data = out.getvalue()
+        self.assertTrue(is_archive(data))
+        tar = tarfile.open(fileobj=StringIO.StringIO(data), mode='r:gz')
+        self.assertEqual(sorted(tar.getnames()),
+                         [restbackuptarfile.DELETIONS_MEMBER, 'data',
+                          'data/file1', 'data/sub', 'data/sub/file3'])
+        restore(restbackup.StringReader(data), 'restored',
+                out=StringIO.StringIO())
+        self.assertEqual(list_tree('restored/data'), expected)
+        self.assertEqual(os.stat('restored/data/file1').st_mtime, 1)
+    
+    def consolidate_and_restore(self, chain):
+        out = StringIO.StringIO()
+        write_consolidated(out, [('archive', restbackup.StringReader(data))
+                                 for data in reversed(chain)])
+        restore(restbackup.StringReader(out.getvalue()), 'restored',
+                out=StringIO.StringIO())
+        return tarfile.open(fileobj=StringIO.StringIO(out.getvalue()),
+                            mode='r:gz')
+    
+    def test_hard_link_target_deleted(self):
+        write_file('data/hl1', 'linked data')
+        os.link('data/hl1', 'data/hl2')
+        os.link('data/hl1', 'data/hl3')
+        (full, snapshot) = make_archive({}, ['data'])
+        self.assertTrue(tarfile.open(fileobj=StringIO.StringIO(full),
+                                     mode='r:gz').getmember('data/hl2').islnk())
+        os.unlink('data/hl1')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        tar = self.consolidate_and_restore([full, inc1])
+        self.assertTrue(tar.getmember('data/hl2').isreg())
+        self.assertEqual(tar.getmember('data/hl3').linkname, 'data/hl2')
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+        self.assertEqual(os.stat('restored/data/hl2').st_ino,
+                         os.stat('restored/data/hl3').st_ino)
+    
+    def test_hard_link_target_replaced(self):
+        write_file('data/hl1', 'linked data')
+        os.link('data/hl1', 'data/hl2')
+        (full, snapshot) = make_archive({}, ['data'])
+        os.unlink('data/hl1')
+        write_file('data/hl1', 'new data')
+        (inc1, snapshot) = make_archive(snapshot, ['data'])
+        tar = self.consolidate_and_restore([full, inc1])
+        self.assertTrue(tar.getmember('data/hl2').isreg())
+        self.assertEqual(list_tree('restored/data'), list_tree('data'))
+    
+    def test_consolidating_reader(self):
+        (chain, expected) = self.make_chain()
+        reader = ConsolidatingReader(
+            [('archive', restbackup.StringReader(data))
+             for data in reversed(chain)])
+        data = reader.read()
+        reader.close()
+        restore(restbackup.StringReader(data), 'restored',
+                out=StringIO.StringIO())
+        self.assertEqual(list_tree('restored/data'), expected)
+    
+    def test_gnu_archive(self):
+        (full, snapshot) = make_archive({}, ['data'])
+        child = subprocess.Popen(['tar', '-cz', 'data'],
+                                 stdout=subprocess.PIPE)
+        gnu_archive = child.communicate()[0]
+        reader = ConsolidatingReader(
+            [('/a-inc1.tar.gz', restbackup.StringReader(gnu_archive)),
+             ('/a-full.tar.gz', restbackup.StringReader(full))])
+        try:
+            reader.read()
+            self.fail()
+        except ArchiveFailedException, e:
+            self.assertTrue('/a-inc1.tar.gz' in str(e))
+        reader.close()
+
+
+class TestExtractToStream(TarfileTestCase):
+    def extract(self, chain, files):
+        """Returns the output, the missing files, and the number of
+        archives that were opened"""
+        opened = []
+        def archives():
+            for data in reversed(chain):
+                opened.append(data)
+                yield ('archive', ClosingReader(data))
+        out = StringIO.StringIO()
+        missing = extract_to_stream(archives(), out, files)
+        return (out.getvalue(), missing, len(opened))
+    
+    def test_file(self):
+        (chain, expected) = self.make_chain()
+        self.assertEqual(self.extract(chain, ['data/sub/file3']),
+                         ('recreated', [], 1))
+        self.assertEqual(self.extract(chain, ['data/file1']),
+                         ('initial data, modified', [], 2))
+        self.assertEqual(self.extract(chain[:1], ['./data/file1']),
+                         ('initial data', [], 1))
+        # Stops once both files are found, without opening the full backup
+        self.assertEqual(self.extract(chain, ['data/file1', 'data/sub/file3']),
+                         ('recreatedinitial data, modified', [], 2))
+    
+    def test_deleted_file(self):
+        (chain, expected) = self.make_chain()
+        self.assertEqual(self.extract(chain, ['data/sub/file2']),
+                         ('', ['data/sub/file2'], 2))
+        self.assertEqual(self.extract(chain[:1], ['data/sub/file2']),
+                         ('x' * 100000, [], 1))
+        self.assertEqual(self.extract(chain, ['data/missing', 'data/file1']),
+                         ('initial data, modified', ['data/missing'], 3))
+    
+    def test_directory(self):
+        (chain, expected) = self.make_chain()
+        self.assertEqual(self.extract(chain, ['data']),
+                         ('recreatedinitial data, modified', [], 3))
+        self.assertEqual(self.extract(chain, []),
+                         ('recreatedinitial data, modified', [], 3))
+    
+    def test_uncompressed(self):
+        f = StringIO.StringIO()
+        tar = tarfile.open(fileobj=f, mode='w')
+        tar.add('data')
+        tar.close()
+        self.assertEqual(self.extract([f.getvalue()], ['data/sub/file2']),
+                         ('x' * 100000, [], 1))
+    
+    def test_gnu_incremental(self):
+        def gnu_tar():
+            child = subprocess.Popen(['tar', '-czg', 'snapshot', 'data'],
+                                     stdout=subprocess.PIPE)
+            data = child.communicate()[0]
+            self.assertEqual(child.returncode, 0)
+            return data
+        long_name = 'data/sub/' + 'x' * 120
+        write_file(long_name, 'long')
+        full = gnu_tar()
+        shutil.rmtree('data/sub')
+        write_file('data/file3', 'new')
+        inc1 = gnu_tar()
+        chain = [full, inc1]
+        self.assertEqual(self.extract(chain, [long_name]),
+                         ('', [long_name], 1))
+        self.assertEqual(self.extract(chain[:1], [long_name]), ('long', [], 1))
+        self.assertEqual(self.extract(chain, ['data/file1']),
+                         ('initial data', [], 2))
+        self.assertEqual(self.extract(chain, ['data']),
+                         ('newinitial data', [], 2))
+
+unittest.main()